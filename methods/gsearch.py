@@ -1,8 +1,23 @@
 """
 Perform a grid search for libfm parameter values.
 
+Parameter points are evaluated on a pool of worker processes. With successive
+halving, every point is first evaluated with a small number of iterations, and
+only the best fraction of the points advance to the next round, which uses
+more iterations. Each result is appended to a TSV log as soon as it arrives,
+and points already in the log are not evaluated again, so an interrupted search
+can be resumed by running it again with the same log. Failed points are logged
+with a NaN score and evaluated again on resume. The log starts with a hash of
+the objective and its args, and a log from a different search is refused.
+
 """
-import scipy as sp
+import os
+import hashlib
+import logging
+import itertools as it
+import multiprocessing as mp
+
+import numpy as np
 
 from libfm import libfm_model
 from scaffold import *
@@ -40,21 +55,249 @@ def als_objective(params, *args):
         cvals, rvals, previous)
 
 
+# Objective and extra args shared with worker processes. Set in the parent
+# before the pool is created, so forked workers inherit the data instead of
+# having it pickled along with every job.
+_OBJECTIVE = None
+_ARGS = ()
+
+
+def _evaluate_point(job):
+    """Evaluate the shared objective at one point with the given iterations.
+
+    Args:
+        job (tuple): (point, iterations, iter_index), where `iter_index` is the
+            position of the iterations in the objective's extra args.
+    Return:
+        outcome (tuple): (point, iterations, score); the score is NaN if the
+            objective failed.
+    """
+    point, iterations, iter_index = job
+    args = list(_ARGS)
+    args[iter_index] = iterations
+    try:
+        score = _OBJECTIVE(point, *args)
+    except Exception as err:
+        logging.error('evaluation failed at %s: %s' % (str(point), err))
+        score = np.nan
+    return (point, iterations, score)
+
+
+def grid_points(ranges):
+    """All points of the grid given by `ranges`, as for `scipy.optimize.brute`:
+    each range is a slice (start, stop, step), with stop excluded.
+    """
+    axes = [np.arange(r.start, r.stop, r.step) if isinstance(r, slice)
+            else np.asarray(r) for r in ranges]
+    return [tuple(float(v) for v in point) for point in it.product(*axes)]
+
+
+def search_id(objective, args, iter_index=1):
+    """Hash identifying a search: the objective's name and its extra args,
+    except the iterations at `iter_index`, which vary between rounds.
+    """
+    digest = hashlib.sha1()
+    digest.update('%s.%s' % (objective.__module__, objective.__name__))
+    for i, arg in enumerate(args):
+        if i == iter_index:
+            continue
+        digest.update('|%d|' % i)
+        if isinstance(arg, pd.DataFrame):
+            digest.update(repr(list(arg.columns)))
+            for col in arg.columns:
+                values = arg[col].values
+                if values.dtype.kind == 'O':
+                    values = values.astype(unicode)
+                digest.update(np.ascontiguousarray(values).tostring())
+        else:
+            digest.update(repr(arg))
+    return digest.hexdigest()
+
+
+SEARCH_HEADER = '# search %s'
+
+
+def _log_key(point, iterations):
+    return (int(iterations),) + tuple(round(v, 10) for v in point)
+
+
+def read_log(logfile, ident=None):
+    """Read the results of a search from its TSV log. Failed (NaN) results
+    are left out, so they are evaluated again.
+
+    Args:
+        logfile (str): Path of the log.
+        ident (str): If given, the `search_id` the log must have been
+            written for.
+    Return:
+        results (dict): Map from (iterations, point...) to score.
+    Raises:
+        ValueError: if the log is from a search other than `ident`.
+    """
+    results = {}
+    if not logfile or not os.path.exists(logfile):
+        return results
+    with open(logfile) as f:
+        first = f.readline().strip()
+        if ident is not None and first != SEARCH_HEADER % ident:
+            raise ValueError(
+                'log %s is from a different search (%s); remove it or use '
+                'another log' % (logfile, first))
+        f.readline()  # column names
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) < 3:
+                continue  # partially written line
+            values = map(float, fields)
+            if np.isnan(values[-1]):
+                continue
+            results[_log_key(values[1:-1], values[0])] = values[-1]
+    return results
+
+
+def evaluate(objective, points, iterations, args, iter_index=1,
+             processes=None, logfile=None):
+    """Evaluate `objective` at each point with the given iterations.
+
+    Args:
+        objective (callable): Called as objective(point, *args); must be
+            defined at module level.
+        points (list of tuple): The parameter points.
+        iterations (int): Value placed at `args[iter_index]` for every run.
+        args (tuple): Extra args for the objective.
+        iter_index (int): Position of the iterations in `args`.
+        processes (int): Number of worker processes; defaults to the number of
+            CPUs.
+        logfile (str): TSV file results are appended to as they arrive.
+            Points already logged with the same iterations are not evaluated
+            again, unless they failed.
+    Return:
+        scores (dict): Map from point to score (lower is better).
+    Raises:
+        ValueError: if `logfile` was written by a different search.
+    """
+    ident = search_id(objective, args, iter_index)
+    logged = read_log(logfile, ident)
+    scores = {}
+    jobs = []
+    for point in points:
+        key = _log_key(point, iterations)
+        if key in logged:
+            scores[point] = logged[key]
+        else:
+            jobs.append((point, iterations, iter_index))
+    logging.info('evaluating %d points with %d iterations (%d logged)' % (
+        len(jobs), iterations, len(points) - len(jobs)))
+    if not jobs:
+        return scores
+
+    global _OBJECTIVE, _ARGS
+    _OBJECTIVE, _ARGS = objective, tuple(args)
+    log = None
+    if logfile:
+        new_log = not os.path.exists(logfile)
+        log = open(logfile, 'a')
+        if new_log:
+            names = ['p%d' % i for i in range(len(points[0]))]
+            log.write(SEARCH_HEADER % ident + '\n')
+            log.write('\t'.join(['iter'] + names + ['score']) + '\n')
+
+    pool = mp.Pool(processes)
+    try:
+        for point, iters, score in pool.imap_unordered(_evaluate_point, jobs):
+            scores[point] = score
+            logging.info('%s (iter=%d): %.6f' % (str(point), iters, score))
+            if log is not None:
+                fields = [str(iters)] + map(repr, point) + [repr(score)]
+                log.write('\t'.join(fields) + '\n')
+                log.flush()
+    finally:
+        pool.close()
+        pool.join()
+        if log is not None:
+            log.close()
+        _OBJECTIVE, _ARGS = None, ()
+
+    return scores
+
+
+def _ranked(scores):
+    """Points sorted by score, with failed (NaN) points last."""
+    return sorted(scores, key=lambda p: (np.isnan(scores[p]), scores[p]))
+
+
+def grid_search(objective, ranges, args, iter_index=1, processes=None,
+                logfile=None):
+    """Evaluate every point of the grid with the iterations in `args`; see
+    `evaluate` and `grid_points`.
+
+    Return:
+        best (tuple): The best point.
+        scores (dict): Map from point to score.
+    """
+    points = grid_points(ranges)
+    scores = evaluate(objective, points, args[iter_index], args, iter_index,
+                      processes, logfile)
+    return _ranked(scores)[0], scores
+
+
+def successive_halving(objective, ranges, args, min_iter, max_iter, eta=3,
+                       iter_index=1, processes=None, logfile=None):
+    """Search the grid with successive halving over the iterations.
+
+    All points are evaluated with `min_iter` iterations. The best 1/`eta` of
+    them advance to the next round, which uses `eta` times as many iterations,
+    until a round uses `max_iter` iterations or one point remains.
+
+    Return:
+        best (tuple): The best point in the final round.
+        rounds (list of tuple): (iterations, scores) for each round, where
+            scores maps each point evaluated in the round to its score.
+    """
+    candidates = grid_points(ranges)
+    iterations = min_iter
+    rounds = []
+    while True:
+        scores = evaluate(objective, candidates, iterations, args, iter_index,
+                          processes, logfile)
+        rounds.append((iterations, scores))
+        ranked = _ranked(scores)
+        if iterations >= max_iter or len(candidates) <= 1:
+            return ranked[0], rounds
+
+        candidates = ranked[:max(1, len(candidates) // eta)]
+        iterations = min(iterations * eta, max_iter)
+        logging.info('%d points advance to %d iterations' % (
+            len(candidates), iterations))
+
+
 def make_parser():
     parser = base_parser('Grid search for LibFM parameter values')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=None,
+        help='number of worker processes; default is number of CPUs')
+    parser.add_argument(
+        '-l', '--log', default='gsearch-log.tsv',
+        help='TSV log of results; an existing log resumes the search')
+    parser.add_argument(
+        '-sh', '--halving', action='store_true', default=False,
+        help='use successive halving over the number of iterations')
+    parser.add_argument(
+        '--min-iter', type=int, default=10,
+        help='iterations in the first round of successive halving')
+    parser.add_argument(
+        '--eta', type=int, default=3,
+        help='fraction of points (1/eta) that advance each round')
     return parser
 
 
-# TODO: replace use of scipy.optimize.brute with custom multiprocessing grid
-# search function. Lift code from scipy and refine using `multiprocessing`
-# module.
 if __name__ == "__main__":
     args = setup(make_parser)
     data = pd.read_csv(args.data_file).sort(['sid', 'termnum'])
 
     # params = (slice(0, 1, 0.05), slice(1,11,1))
     # args = (data, 100, 1, 1, 'grdpts', None, None, False)
-    # result = sp.optimize.brute(mcmc_objective, params, args=args, finish=None)
+    # result, _ = grid_search(mcmc_objective, params, args)
 
     reg_grid = slice(0, 1, 0.25)
     params = (slice(0.1,1,0.1),         # std
@@ -67,7 +310,13 @@ if __name__ == "__main__":
     #           slice(0.25, 0.26, 0.01),
     #           slice(0.5, 0.51, 0.01),
     #           slice(0.75, 0.76, 0.01))
-    args = (data, 100, 1, 1, 'grdpts', None, None, False)
-    result = sp.optimize.brute(als_objective, params, args=args, finish=None)
+    obj_args = (data, 100, 1, 1, 'grdpts', None, None, False)
+    if args.halving:
+        result, _ = successive_halving(
+            als_objective, params, obj_args, args.min_iter, obj_args[1],
+            args.eta, processes=args.processes, logfile=args.log)
+    else:
+        result, _ = grid_search(als_objective, params, obj_args,
+                                processes=args.processes, logfile=args.log)
     print result
 
@@ -8,7 +8,7 @@ from sklearn import preprocessing
 
 from writer import write_libfm
 from scaffold import *
-from wlibfm import FM
+from wlibfm import FM, CACHE_DIR
 
 
 def libfm(train, test, userid='sid', itemid='cid', target='grdpts',
@@ -16,14 +16,13 @@ def libfm(train, test, userid='sid', itemid='cid', target='grdpts',
           train_file='train.csv', test_file='test.csv',
           method='mcmc', task='r', iter=100, std=0.1, dim=8,
           fbias=True, gbias=True, lrate=0.1, r0=0.0, r1=0.0, r2=0.0,
-          outdir='tmp', logfile=''):
-    fm = FM(method, task, iter, std, dim, fbias, gbias, lrate, r0, r1, r2,
-            outdir, logfile)
-    fm.write(train, test, userid, itemid, target, cvals, rvals, previous,
-             outfile, train_file, test_file)
-    predictions = fm.run()
-    fm.teardown()
-    return predictions
+          outdir='tmp', logfile='', binary=False, relations=None,
+          cache_dir=CACHE_DIR):
+    with FM(method, task, iter, std, dim, fbias, gbias, lrate, r0, r1, r2,
+            outdir, logfile, binary=binary, cache_dir=cache_dir) as fm:
+        fm.write(train, test, userid, itemid, target, cvals, rvals, previous,
+                 outfile, train_file, test_file, relations)
+        return fm.run()
 
 
 def libfm_model(train, test, *args, **kwargs):
@@ -4,29 +4,52 @@ written to disk before use and that the results be written to disk after
 predictions. Naturally, this can be quite slow in some cases. It is an
 expeditious solution with an acceptable offline runtime at this time.
 
-NOTE: the current implementation does not support binary data format, meta
-groupings or relations. It also does not support SGDA (since that requires
+With `binary=True`, the data is written in libFM's binary format, so libFM
+does not have to parse text, and the transposed design needed by MCMC and ALS
+is written alongside it.
+
+With a `cache_dir`, written data files are kept in a `DataCache`, keyed by a
+hash of the input frames and the writer arguments. Writing the same data again
+(e.g. for every point of a parameter sweep) then reuses the cached files.
+
+Entity attributes can be written as libFM relations (block structure) by
+passing `relations` to `FM.write`, so that each distinct row of a student's or
+course's attributes is stored once. libFM only supports relations for MCMC
+and ALS.
+
+Each FM writes its data and predictions to its own `Workspace`, a uniquely
+named directory that is removed by `FM.teardown`, so any number of FMs can
+run at once. Workspaces are created in RAM-backed /dev/shm when it has room
+for them, and each reserves and is limited to a quota of bytes, which also
+counts the run's data in the cache.
+
+libFM processes are run by a `LibFMRunner`, which runs many of them at once
+within a budget of cores. Each run is a `LibFMJob` that reads libFM's output
+line by line as it runs, so large outputs cannot block the process, and
+records the train and test error of every iteration.
+
+NOTE: the current implementation does not support meta groupings. It also does not support SGDA (since that requires
 extending the writer to write a validation set).
 
 """
 import os
+import re
+import json
 import time
+import errno
+import fcntl
+import atexit
 import shutil
+import hashlib
+import tempfile
 import logging
-import datetime
+import threading
 import subprocess as sub
+import multiprocessing as mp
 
 import numpy as np
 
-from writer import write_libfm
-
-
-def silent_mkdir(dirname):
-    """Create a directory if it does not exist, else do nothing."""
-    try:
-        os.mkdir(dirname)
-    except OSError:
-        pass
+from writer import write_libfm, write_libfm_binary, write_libfm_relational
 
 
 class LibFMFailed(Exception):
@@ -34,10 +57,547 @@ class LibFMFailed(Exception):
     pass
 
 
-def gen_ts():
-    ts = time.time()
-    st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d-%H-%M-%S')
-    return st
+class LibFMTimeout(LibFMFailed):
+    """LibFM was killed for running longer than its timeout."""
+    pass
+
+
+class WorkspaceQuotaExceeded(Exception):
+    """The files in a workspace are larger than its quota."""
+    pass
+
+
+# libFM prints a line like this for every iteration of learning.
+ITER_PATTERN = re.compile(r'#Iter=\s*(\d+)\s+Train=(\S+)\s+Test=(\S+)')
+
+
+class LibFMJob(object):
+    """A libFM run, submitted to a `LibFMRunner`; a future for its result.
+
+    While libFM runs, its output is read line by line. The train and test
+    error of each iteration are appended to `train_errors` and `test_errors`
+    and all other lines are kept in `output`.
+    """
+
+    def __init__(self, args, outfile='', timeout=None, cores=1):
+        """
+        Args:
+            args (list of str): Command line for libFM, without a shell.
+            outfile (str): Path libFM writes its predictions to, if any.
+            timeout (float): Seconds after which libFM is killed, if given.
+            cores (int): Number of cores the job takes from the budget.
+        """
+        self.args = list(args)
+        self.outfile = outfile
+        self.timeout = timeout
+        self.cores = cores
+        self.train_errors = []
+        self.test_errors = []
+        self.output = []
+        self.returncode = None
+        self.timed_out = False
+        self.error = None
+        self._proc = None
+        self._done = threading.Event()
+
+    @property
+    def cmd(self):
+        return ' '.join(self.args)
+
+    @property
+    def errors(self):
+        """The (train, test) error of the last iteration so far."""
+        if not self.train_errors:
+            return (np.nan, np.nan)
+        return (self.train_errors[-1], self.test_errors[-1])
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for libFM to finish; return True if it has."""
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """Wait for libFM to finish and return its predictions.
+
+        Args:
+            timeout (float): Seconds to wait; by default, wait until done.
+        Return:
+            predictions (np.ndarray): The predictions read from `outfile`, or
+                None if the job has no outfile. For classification, these are
+                probabilities.
+        Raises:
+            LibFMTimeout: if libFM was killed for exceeding its timeout.
+            LibFMFailed: if libFM could not be run, returned a non-zero exit
+                code or is still running after `timeout` seconds.
+        """
+        if not self.wait(timeout):
+            raise LibFMFailed("libFM is still running.\n%s" % self.cmd)
+        if self.timed_out and self.returncode:  # not if it exited first
+            raise LibFMTimeout("libFM timed out after %ss.\n%s" % (
+                self.timeout, self.cmd))
+        if self.error is not None or self.returncode:
+            raise LibFMFailed("libFM failed to execute.\n%s\n%s" % (
+                self.cmd, self.error or '\n'.join(self.output[-10:])))
+
+        if not self.outfile:
+            return None
+        with open(self.outfile) as f:
+            return np.array([float(num) for num in f if num.strip()])
+
+    def _parse(self, line):
+        match = ITER_PATTERN.search(line)
+        if match:
+            self.train_errors.append(float(match.group(2)))
+            self.test_errors.append(float(match.group(3)))
+        else:
+            self.output.append(line.rstrip())
+
+    def _kill(self):
+        """Kill libFM if it is still running; only then is it timed out."""
+        if self._proc.poll() is not None:
+            return
+        try:
+            self._proc.kill()
+        except OSError:  # finished since the poll
+            return
+        self.timed_out = True
+
+    def _run(self):
+        """Run libFM, reading its output until it exits."""
+        logging.debug(self.cmd)
+        timer = None
+        try:
+            self._proc = sub.Popen(self.args, stdout=sub.PIPE,
+                                   stderr=sub.STDOUT, bufsize=1)
+            if self.timeout:
+                timer = threading.Timer(self.timeout, self._kill)
+                timer.daemon = True
+                timer.start()
+
+            # Read with readline; iterating over the pipe reads ahead.
+            for line in iter(self._proc.stdout.readline, ''):
+                self._parse(line)
+            self.returncode = self._proc.wait()
+        except OSError as err:
+            self.error = err
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._done.set()
+
+
+class LibFMRunner(object):
+    """Run libFM jobs concurrently within a budget of cores.
+
+    Each submitted job is started on its own thread, which waits until enough
+    cores are free. libFM runs on a single core, so by default a job takes
+    one core.
+    """
+
+    def __init__(self, cores=None):
+        """
+        Args:
+            cores (int): Number of cores to use; defaults to the CPU count.
+        """
+        self.cores = cores if cores else mp.cpu_count()
+        self._free = self.cores
+        self._lock = threading.Condition()
+
+    def submit(self, args, outfile='', timeout=None, cores=1):
+        """Start a libFM job as soon as cores are free; see `LibFMJob`.
+
+        Return:
+            job (LibFMJob): The job, which is a future for its result.
+        """
+        job = LibFMJob(args, outfile, timeout, min(cores, self.cores))
+        thread = threading.Thread(target=self._run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def _run(self, job):
+        with self._lock:
+            while self._free < job.cores:
+                self._lock.wait()
+            self._free -= job.cores
+        try:
+            job._run()
+        finally:
+            with self._lock:
+                self._free += job.cores
+                self._lock.notify_all()
+
+
+_RUNNER = None
+
+def default_runner():
+    """Return the shared runner, which uses all CPUs."""
+    global _RUNNER
+    if _RUNNER is None:
+        _RUNNER = LibFMRunner()
+    return _RUNNER
+
+
+def dir_size(path):
+    """Total size in bytes of the files under `path`."""
+    return sum(os.path.getsize(os.path.join(dirpath, fname))
+               for dirpath, _, fnames in os.walk(path)
+               for fname in fnames)
+
+
+# Directories workspaces are created in, in order of preference; the first
+# that is writable and has room for the quota is used.
+WORKSPACE_ROOTS = ('/dev/shm', '.tmp')
+WORKSPACE_QUOTA = 2 * 2 ** 30
+
+# Workspaces that have not been closed, as (pid, path); removed at exit by the
+# process that created them, so forked children leave their parent's alone.
+_OPEN_WORKSPACES = set()
+
+
+@atexit.register
+def _close_workspaces():
+    for pid, path in list(_OPEN_WORKSPACES):
+        if pid == os.getpid():
+            shutil.rmtree(path, ignore_errors=True)
+            _OPEN_WORKSPACES.discard((pid, path))
+
+
+def free_bytes(path):
+    """Number of bytes available to unprivileged users at `path`."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+class ByteLimit(object):
+    """Count the bytes written through the files it wraps and raise
+    WorkspaceQuotaExceeded as soon as they pass `limit`, rather than after
+    the files are complete.
+    """
+
+    def __init__(self, limit, where=''):
+        """
+        Args:
+            limit (int): Number of bytes allowed; None for no limit.
+            where (str): Name of the place written to, for the error message.
+        """
+        self.limit = limit
+        self.where = where
+        self.used = 0
+
+    def spend(self, nbytes):
+        self.used += nbytes
+        if self.limit is not None and self.used > self.limit:
+            raise WorkspaceQuotaExceeded(
+                'writing more than the %d bytes left in the quota to %s' % (
+                    self.limit, self.where))
+
+    def wrap(self, f):
+        """Return a file-like object writing to `f` within the limit."""
+        return _LimitedFile(f, self)
+
+
+class _LimitedFile(object):
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.limit = limit
+
+    def write(self, data):
+        self.limit.spend(len(data))
+        self.f.write(data)
+
+
+class Workspace(object):
+    """A uniquely named temporary directory for the files of one run.
+
+    Workspaces are created in a `dirname` directory under the first of
+    `roots` whose free space, less the space reserved by the other live
+    workspaces there, covers the `quota`. Each workspace reserves its quota
+    until it is closed: the reservation is recorded in the workspace, and
+    roots are chosen under a lock, so concurrent runs never overcommit a root.
+    Workspaces left behind by processes that died are removed when a root is
+    chosen.
+
+    A workspace is removed by `close`, at the end of a `with` block, or at
+    interpreter exit if it was never closed.
+    """
+    dirname = 'libfm-workspaces'
+    reservation_fname = '.reservation'
+    lock_fname = '.lock'
+
+    def __init__(self, prefix='', quota=WORKSPACE_QUOTA, roots=WORKSPACE_ROOTS):
+        """
+        Args:
+            prefix (str): Start of the directory name.
+            quota (int): Maximum total size of the files in bytes; None for
+                no limit (and no reservation).
+            roots (iterable of str): Candidate parent directories, in order of
+                preference. The last is used, and created, if none has room.
+        """
+        self.quota = quota
+        prefix = '%s-' % prefix if prefix else 'libfm-'
+        roots = list(roots)
+        for root in roots[:-1]:
+            if os.path.isdir(root) and os.access(root, os.W_OK):
+                self.path = self._reserve(root, prefix, quota, must_fit=True)
+                if self.path is not None:
+                    break
+        else:
+            self.path = self._reserve(roots[-1], prefix, quota)
+
+        self.root = os.path.dirname(os.path.dirname(self.path))
+        self._key = (os.getpid(), self.path)
+        _OPEN_WORKSPACES.add(self._key)
+        logging.debug('created workspace %s' % self.path)
+
+    @classmethod
+    def _reserve(cls, root, prefix, quota, must_fit=False):
+        """Create a workspace under `root` reserving `quota` bytes, and return
+        its path. If `must_fit`, return None instead when the space left after
+        the other reservations is less than the quota.
+        """
+        base = os.path.join(root, cls.dirname)
+        try:
+            os.makedirs(base)
+        except OSError:  # already exists
+            pass
+
+        with open(os.path.join(base, cls.lock_fname), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                available = free_bytes(base) - cls.reserved(base)
+                if must_fit and quota is not None and available < quota:
+                    return None
+
+                path = tempfile.mkdtemp(prefix=prefix, dir=base)
+                with open(os.path.join(path, cls.reservation_fname), 'w') as f:
+                    f.write('%d %d' % (os.getpid(), quota or 0))
+                return path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @classmethod
+    def reserved(cls, base):
+        """Bytes reserved but not yet used by the live workspaces in `base`.
+        Workspaces of processes that are no longer running are removed.
+        """
+        total = 0
+        for name in os.listdir(base):
+            path = os.path.join(base, name)
+            try:
+                with open(os.path.join(path, cls.reservation_fname)) as f:
+                    pid, quota = map(int, f.read().split())
+            except (IOError, ValueError):
+                continue  # not a workspace, or being created
+
+            if not pid_alive(pid):
+                logging.info('removing abandoned workspace %s' % path)
+                shutil.rmtree(path, ignore_errors=True)
+            elif quota:
+                total += max(quota - dir_size(path), 0)
+        return total
+
+    @property
+    def size(self):
+        return dir_size(self.path)
+
+    def remaining(self, extra=0):
+        """Bytes left in the quota (None for no limit), counting `extra`
+        bytes kept outside the workspace for this run.
+        """
+        if self.quota is None:
+            return None
+        return self.quota - self.size - extra
+
+    def check(self, extra=0):
+        """Raise WorkspaceQuotaExceeded if the files, and `extra` bytes kept
+        outside the workspace for this run, exceed the quota.
+        """
+        remaining = self.remaining(extra)
+        if remaining is not None and remaining < 0:
+            raise WorkspaceQuotaExceeded(
+                'workspace %s uses %d bytes; quota is %d' % (
+                    self.path, self.quota - remaining, self.quota))
+
+    def close(self):
+        """Remove the directory and everything in it."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        _OPEN_WORKSPACES.discard(self._key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def pid_alive(pid):
+    """True if a process with id `pid` is running on this host."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+# Default location and size limit (in bytes) of the written data cache.
+CACHE_DIR = os.path.join('.tmp', 'libfm-cache')
+CACHE_SIZE = 10 * 2 ** 30
+
+
+class DataCache(object):
+    """Persistent, content-addressed cache of written libFM data files.
+
+    Each entry is a directory named by a hash of the train and test frames
+    and of the arguments the files were written with. Entries are written to
+    a temporary directory and renamed into place, so a partially written
+    entry is never used. Using an entry marks it as recently used; when the
+    cache grows past its size limit, the least recently used entries are
+    evicted.
+
+    Entries in use are never evicted. An entry is in use while it holds a
+    lease (see `lease`) from a running process, and for `grace` seconds after
+    it was last used, which covers the time between `get` and `lease`.
+    """
+    manifest_fname = 'manifest.json'
+    lease_prefix = '.lease-'
+    grace = 300  # seconds
+    version = 1  # bump when the written file format changes
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created concurrently
+                pass
+
+    def key(self, train, test, spec):
+        """Hash the frames and the writer arguments in `spec`.
+
+        Only the columns the writer can read are hashed: the target, ids,
+        features and, for previous grades, the term numbers.
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps(
+            dict(spec, version=self.version), sort_keys=True))
+
+        columns = set([spec['target'], spec['userid'], spec['itemid']] +
+                      spec['cvals'] + spec['rvals'])
+        if spec['previous']:
+            columns.add('termnum')
+        for frame in (train, test):
+            digest.update(str(len(frame)))
+            for col in sorted(columns):
+                if col not in frame.columns:
+                    continue
+                values = frame[col].values
+                if values.dtype.kind == 'O':
+                    values = values.astype(unicode)
+                digest.update(col)
+                digest.update(np.ascontiguousarray(values).tostring())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the directory of the entry for `key`, or None if absent."""
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(path, self.manifest_fname)):
+            return None
+        os.utime(path, None)  # mark as recently used
+        return path
+
+    def put(self, key, write):
+        """Add an entry for `key`.
+
+        Args:
+            key (str): As returned by `key`.
+            write (callable): Writes the files to the directory it is given
+                and returns a JSON serializable manifest of them.
+        Return:
+            path (str): The directory of the entry.
+        """
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            manifest = write(tmp_path)
+            with open(os.path.join(tmp_path, self.manifest_fname), 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            # Another process added the same entry first; use that one.
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+
+        self.evict(keep=path)
+        return path
+
+    def lease(self, path):
+        """Mark the entry at `path` as in use until the lease is released.
+
+        Return:
+            lease (str): Path of the lease file; pass it to `release`.
+        Raises:
+            OSError: if the entry no longer exists.
+        """
+        fd, lease = tempfile.mkstemp(
+            prefix='%s%d-' % (self.lease_prefix, os.getpid()), dir=path)
+        os.close(fd)
+        return lease
+
+    @staticmethod
+    def release(lease):
+        """Release a lease returned by `lease`."""
+        try:
+            os.remove(lease)
+        except OSError:  # entry already gone
+            pass
+
+    def in_use(self, path):
+        """True if the entry at `path` holds a lease from a live process."""
+        for name in os.listdir(path):
+            if not name.startswith(self.lease_prefix):
+                continue
+            pid = name[len(self.lease_prefix):].split('-')[0]
+            if pid.isdigit() and pid_alive(int(pid)):
+                return True
+        return False
+
+    def manifest(self, path):
+        """Read the manifest of the entry at `path`."""
+        with open(os.path.join(path, self.manifest_fname)) as f:
+            return json.load(f)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache is within its
+        size limit. The entry at `keep` and entries in use are never removed.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), dir_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep or now - mtime < self.grace:
+                continue
+            if self.in_use(path):
+                continue
+            logging.info('evicting cached libFM data %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
 
 LIBFM = '/home/msweene2/ers-data/libfm-1.42.src/bin/libFM'
@@ -46,7 +606,9 @@ class FM(object):
 
     def __init__(self, method='mcmc', task='r', iter=100, std=0.1, dim=8,
                  fbias=True, gbias=True, lrate=0.1, r0=0.0, r1=0.0, r2=0.0,
-                 outdir='', logfile='', verbosity=0, bin=LIBFM):
+                 outdir='', logfile='', verbosity=0, bin=LIBFM, binary=False,
+                 cache_dir=None, cache_size=CACHE_SIZE,
+                 workspace_quota=WORKSPACE_QUOTA):
         """
         Args:
             method (str): Learning method for inference, mcmc by default.
@@ -64,13 +626,22 @@ class FM(object):
             r0 (float): Bias regularization term, 0.0 by default.
             r1 (float): 1-way regularization term, 0.0 by default.
             r2 (float): 2-way regularization term 0.0 by default.
-            outdir (str): Name of directory to write LibFM-formatted input to,
-                as well as the prediction outputs.
+            outdir (str): Name prefix of the workspace directory that
+                LibFM-formatted input and the prediction outputs are written
+                to; see `setup`.
             logfile (str): Name of the logfile for LibFM logging, which can be
                 made more verbose by increasing the level with the `verbosity`
                 parameter. By default, no logfile is written.
             verbosity (int): Verbosity level. Higher integers are more verbose.
                 Set to 0 by default.
+            binary (bool): If True, write the data in libFM's binary format
+                instead of text, False by default.
+            cache_dir (str): If given, keep written data in a `DataCache` in
+                this directory and reuse it when the same data is written
+                again. By default, data is written to `outdir` every time.
+            cache_size (int): Size limit of the cache in bytes.
+            workspace_quota (int): Size limit of the workspace in bytes; None
+                for no limit.
 
         """
         for (k, v) in locals().iteritems():
@@ -80,27 +651,38 @@ class FM(object):
         self.setup(outdir)
 
     def setup(self, outdir):
-        """Ensure output directory is present in cwd.
+        """Create a workspace for this FM's files.
 
         This wrapper requires writing input data frames to disk before calling
         LibFM and retrieving the output of LibFM from disk in order to return it
-        back in memory. The outdir holds these temporary files, and it must
-        exist before using the wrapper.
+        back in memory. The outdir holds these temporary files. It is a new,
+        uniquely named directory, so FMs never share files.
 
         """
-        tmpdir = '.tmp'
-        silent_mkdir(tmpdir)
-        if not outdir:
-            outdir = gen_ts()
-        self.outdir = os.path.join(tmpdir, outdir)
-        silent_mkdir(self.outdir)
+        self.workspace = Workspace(
+            os.path.basename(outdir.rstrip(os.sep)), self.workspace_quota)
+        self.outdir = self.workspace.path
+
+    def release_cache(self):
+        """Release the cache entry used by this FM, if any."""
+        if getattr(self, 'cache_lease', None):
+            DataCache.release(self.cache_lease)
+        self.cache_lease = None
 
     def teardown(self):
-        shutil.rmtree(self.outdir)
+        """Remove the workspace and all files in it."""
+        self.release_cache()
+        self.workspace.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.teardown()
 
     def write(self, train, test, userid='sid', itemid='cid', target='grdpts',
              cvals=None, rvals=None, previous=False, outfile='predict.csv',
-             train_file='train.csv', test_file='test.csv'):
+             train_file='train.csv', test_file='test.csv', relations=None):
         """
         Args:
             train (DataFrame): Training dataset; take care that it has columns
@@ -123,17 +705,115 @@ class FM(object):
                 training data.
             test_file (str): Filename for temporary LibFM-formatted file for
                 testing data.
+            relations (dict): If given, write these entity attributes as libFM
+                relations (block structure) in binary format; see
+                `writer.write_libfm_relational` for the format.
+
+        Raises:
+            ValueError: if relations are given for a method other than MCMC
+                or ALS.
 
         """
         self.outfile = os.path.join(self.outdir, outfile)
-        self.train_file = os.path.join(self.outdir, train_file)
-        self.test_file = os.path.join(self.outdir, test_file)
+        if relations and self.method not in ('mcmc', 'als'):
+            raise ValueError(
+                'libFM relations require mcmc or als, not %s' % self.method)
+
+        spec = {
+            'userid': userid, 'itemid': itemid, 'target': target,
+            'cvals': list(cvals) if cvals else [],
+            'rvals': list(rvals) if rvals else [],
+            'previous': bool(previous),
+            'relations': relations if relations else {},
+            'binary': bool(self.binary or relations),
+            'transpose': self.method != 'sgd'
+        }
+        # Data counts against the workspace quota even when it is cached, and
+        # writing stops as soon as the data would exceed it.
+        def write_files(dirname):
+            return self.write_files(
+                dirname, train_file, test_file, train, test, spec,
+                limit=self.workspace.remaining())
+
+        if not self.cache_dir:
+            self.use_files(self.outdir, write_files(self.outdir))
+            return
+
+        cache = DataCache(self.cache_dir, self.cache_size)
+        key = cache.key(train, test, spec)
+        entry = cache.get(key)
+        if entry is not None:
+            logging.info('reusing cached libFM data %s' % entry)
+            try:
+                lease = cache.lease(entry)
+            except OSError:  # evicted since the get
+                entry = None
+        if entry is None:
+            entry = cache.put(key, write_files)
+            lease = cache.lease(entry)
+
+        # Hold the entry until teardown, so it is not evicted while in use.
+        self.release_cache()
+        self.cache_lease = lease
+        self.workspace.check(extra=dir_size(entry))
+        self.use_files(entry, cache.manifest(entry))
+
+    def write_files(self, dirname, train_file, test_file, train, test, spec,
+                    limit=None):
+        """Write the data files to `dirname`; see `write` for the args.
+
+        libFM takes the file stems (paths without extension) as the -train and
+        -test args for binary data.
 
-        # Write data in libFM format to temporary files.
-        with open(self.train_file, 'w') as ftrain,\
-             open(self.test_file, 'w') as ftest:
-            write_libfm(ftrain, ftest, train, test, target, userid,
-                        itemid, cvals, rvals, previous)
+        Args:
+            limit (int): Number of bytes the files may take. Text files are
+                stopped as soon as they pass it; binary files are checked
+                once written.
+        Raises:
+            WorkspaceQuotaExceeded: if the files take more than `limit`.
+
+        Return:
+            manifest (dict): Names of the 'train' and 'test' files (or stems)
+                and of the 'relations' stems, relative to `dirname`.
+        """
+        train_path = os.path.join(dirname, train_file)
+        test_path = os.path.join(dirname, test_file)
+        args = (spec['target'], spec['userid'], spec['itemid'], spec['cvals'],
+                spec['rvals'], spec['previous'])
+        relations = []
+        budget = ByteLimit(limit, dirname)
+        if spec['binary']:
+            train_path = os.path.splitext(train_path)[0]
+            test_path = os.path.splitext(test_path)[0]
+
+        if spec['relations']:
+            stems = write_libfm_relational(
+                train_path, test_path, train, test, spec['relations'], *args)
+            relations = [os.path.basename(stem) for stem in stems or []]
+            budget.spend(dir_size(dirname))
+        elif spec['binary']:
+            write_libfm_binary(train_path, test_path, train, test, *args,
+                               transpose=spec['transpose'])
+            budget.spend(dir_size(dirname))
+        else:
+            # Write data in libFM format to temporary files.
+            with open(train_path, 'w') as ftrain,\
+                 open(test_path, 'w') as ftest:
+                write_libfm(budget.wrap(ftrain), budget.wrap(ftest),
+                            train, test, *args)
+
+        return {
+            'train': os.path.basename(train_path),
+            'test': os.path.basename(test_path),
+            'relations': relations
+        }
+
+    def use_files(self, dirname, manifest):
+        """Point libFM at the data files in `dirname` listed in `manifest`."""
+        self.train_file = os.path.join(dirname, manifest['train'])
+        self.test_file = os.path.join(dirname, manifest['test'])
+        self.relation_files = [os.path.join(dirname, stem)
+                               for stem in manifest['relations']]
 
     @property
     def cmd_args(self):
@@ -151,6 +831,8 @@ class FM(object):
         ]
         if self.logfile:
             args += ['-rlog', self.logfile]
+        if getattr(self, 'relation_files', None):
+            args += ['-relation', ','.join(self.relation_files)]
         if self.method != 'mcmc':
             args += ['-regular', '%f,%f,%f' % (self.r0, self.r1, self.r2)]
         if self.method == 'sgd':
@@ -161,23 +843,24 @@ class FM(object):
     def cmd(self):
         return ' '.join(self.cmd_args)
 
-    def run(self):
-        """Note that probabilities are returned for classification."""
-        logging.debug(self.cmd)
+    def submit(self, runner=None, timeout=None):
+        """Start libFM on the written data without waiting for it.
 
-        logging.info('spawning libFM subprocess')
-        proc = sub.Popen(self.cmd, shell=True, stdout=sub.PIPE)
-        retcode = proc.wait()
-        logging.info('libFM finished running')
-        if retcode:
-            raise LibFMFailed("libFM failed to execute.\n%s" % self.cmd)
+        Args:
+            runner (LibFMRunner): Runner to use; the shared one by default.
+            timeout (float): Seconds after which libFM is killed, if given.
+        Return:
+            job (LibFMJob): The job; its result is the predictions.
+        """
+        runner = runner if runner is not None else default_runner()
+        logging.info('submitting libFM job')
+        return runner.submit(self.cmd_args, self.outfile, timeout)
 
-        # read output and return predictions
-        with open(self.outfile) as f:
-            logging.info('reading predictions output by libFM')
-            predictions = np.array([float(num) for num in f if num])
-            logging.info('done reading predictions')
-            return predictions
+    def run(self, runner=None, timeout=None):
+        """Note that probabilities are returned for classification."""
+        predictions = self.submit(runner, timeout).result()
+        logging.info('libFM finished running')
+        return predictions
 
 
 if __name__ == "__main__":
@@ -189,9 +872,9 @@ if __name__ == "__main__":
     test = data[data.termnum == 5]
 
     # Predict new grades.
-    fm = FM(method='als')
-    fm.write(train, test)
-    predictions = fm.run()
+    with FM(method='als') as fm:
+        fm.write(train, test)
+        predictions = fm.run()
 
     # Evaluate predictions.
     err = (test.grdpts.values - predictions)
@@ -1,30 +1,395 @@
 import os
+import struct
 import logging
 
 import numpy as np
 import pandas as pd
+import scipy as sp
+import scipy.sparse
 
 
-def make_prev_crecord_fmter(data):
-    """Create a function closure with a cache. Return the internal function
-    which formats the previous course grades in libFM format.
+# Number of rows formatted and written at a time when streaming libFM files.
+CHUNKSIZE = 100000
+
+
+def prior_record_slices(sids, terms, include):
+    """Find the previous course records of each record in linear time.
+
+    The records to draw from (those selected by `include`) are sorted once by
+    (sid, termnum). The previous records of any record are then the run of
+    that order with the same sid and an earlier term, so each record gets a
+    slice of the sorted order rather than a scan of all the records.
+
+    Args:
+        sids (np.ndarray): Student id of each record, with -1 for null.
+        terms (np.ndarray): Term number of each record (may have NaN).
+        include (np.ndarray): Mask of records that can be previous records.
+    Return:
+        order (np.ndarray): Positions of the included records sorted by
+            (sid, termnum); the shared buffer the slices index into.
+        starts (np.ndarray): Start of each record's slice of `order`.
+        ends (np.ndarray): End of each record's slice of `order`; records
+            without a sid or term get empty slices.
+    """
+    known = (sids >= 0) & ~np.isnan(terms)
+    include = include & known
+    levels, term_codes = np.unique(terms[known], return_inverse=True)
+    keys = np.full(len(sids), -1, dtype=np.int64)
+    keys[known] = sids[known].astype(np.int64) * len(levels) + term_codes
+
+    order = np.flatnonzero(include)
+    order = order[np.argsort(keys[order], kind='mergesort')]
+    sorted_keys = keys[order]
+
+    starts = np.zeros(len(sids), dtype=np.int64)
+    ends = np.zeros(len(sids), dtype=np.int64)
+    first_key = sids[known].astype(np.int64) * len(levels)
+    starts[known] = np.searchsorted(sorted_keys, first_key, side='left')
+    ends[known] = np.searchsorted(sorted_keys, keys[known], side='left')
+    return order, starts, ends
+
+
+def stack_row_blocks(parts, nrows, ncols):
+    """Combine row-aligned sparse blocks side by side into one CSR matrix.
+
+    The entries of each row are kept in order: all of the row's entries from
+    the first block, followed by those from the second, and so on. Duplicate
+    entries are kept as well, since libFM files may repeat feature ids.
+
+    Args:
+        parts (list of tuple): (indptr, indices, values) for each block, with
+            `nrows` rows and indptr starting at 0.
+        nrows (int): Number of rows.
+        ncols (int): Number of columns of the combined matrix.
+    Return:
+        matrix (sp.sparse.csr_matrix): The combined matrix.
+    """
+    counts = np.zeros(nrows, dtype=np.int64)
+    for indptr, _, _ in parts:
+        counts += np.diff(indptr)
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    values = np.empty(indptr[-1], dtype=np.float64)
+    offset = indptr[:-1].copy()
+    for part_indptr, part_indices, part_values in parts:
+        part_counts = np.diff(part_indptr)
+        rows = np.repeat(np.arange(nrows), part_counts)
+        pos = offset[rows] + np.arange(len(part_indices)) - part_indptr[rows]
+        indices[pos] = part_indices
+        values[pos] = part_values
+        offset += part_counts
+
+    return sp.sparse.csr_matrix((values, indices, indptr), shape=(nrows, ncols))
+
+
+def _dense_block(ids, values):
+    """Convert (# rows x # attributes) arrays of feature ids and values, with
+    negative ids for missing entries, to a row-aligned sparse block.
+    """
+    present = ids >= 0
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(present.sum(axis=1), out=indptr[1:])
+    return indptr, ids[present], values[present]
+
+
+def format_rows(matrix, target, onehot_end):
+    """Format the rows of a feature matrix as libFM text, all at once.
+
+    Entries in columns below `onehot_end` are written as `<id>:1` and all
+    others as `<id>:<value>`. Each row is preceded by its target value.
+
+    Return:
+        text (str): The lines for all rows, separated by newlines, without a
+            trailing newline.
+    """
+    nrows = matrix.shape[0]
+    if not nrows:
+        return ''
+
+    indptr = matrix.indptr - matrix.indptr[0]
+    indices = matrix.indices[matrix.indptr[0]:matrix.indptr[-1]]
+    values = matrix.data[matrix.indptr[0]:matrix.indptr[-1]]
+
+    tokens = np.empty(len(indices), dtype=object)
+    onehot = indices < onehot_end
+    tokens[onehot] = np.char.mod('%d:1', indices[onehot])
+    tokens[~onehot] = np.char.add(np.char.mod('%d:', indices[~onehot]),
+                                  np.char.mod('%f', values[~onehot]))
+
+    # Lay out each row as its target followed by its tokens, then interleave
+    # the pieces with spaces, using newlines after the last piece of a row.
+    npieces = nrows + len(tokens)
+    starts = indptr[:-1] + np.arange(nrows)
+    is_target = np.zeros(npieces, dtype=bool)
+    is_target[starts] = True
+    pieces = np.empty(npieces * 2, dtype=object)
+    pieces[0::2][is_target] = np.char.mod('%f', target)
+    pieces[0::2][~is_target] = tokens
+    pieces[1::2] = ' '
+    pieces[1::2][indptr[1:] + np.arange(nrows)] = '\n'
+    return ''.join(pieces[:-1])
+
+
+def write_rows(f, matrix, target, onehot_end, chunksize=CHUNKSIZE):
+    """Write the rows of a feature matrix to the open file `f` as libFM data,
+    formatting `chunksize` rows at a time (see `format_rows`).
+    """
+    for start in xrange(0, matrix.shape[0], chunksize):
+        end = start + chunksize
+        if start:
+            f.write('\n')
+        f.write(format_rows(matrix[start:end], target[start:end], onehot_end))
+
+
+def write_lines(f, lines, chunksize=CHUNKSIZE):
+    """Write already formatted libFM lines to the open file `f`, joining
+    `chunksize` lines at a time.
+    """
+    for start in xrange(0, len(lines), chunksize):
+        if start:
+            f.write('\n')
+        f.write('\n'.join(lines[start:start + chunksize]))
+
+
+def _layout_names(cvals, rvals, userid, itemid, id_features=True):
+    """Order the cvals (with the user and item ids, unless `id_features` is
+    False) and rvals the way they are laid out in a libFM file.
+    """
+    cvals = list(cvals) if cvals else []
+    if id_features:
+        cvals.insert(0, itemid)
+        cvals.insert(0, userid)
+    rvals = list(rvals) if rvals else []
+    return list(set(cvals)), list(set(rvals))
+
+
+class FeatureBlocks(object):
+    """Sparse libFM feature blocks for a set of records, one per attribute.
+
+    Each cval is a one-hot block whose width is its max id + 1, stored as the
+    id of each record (-1 for null). Each rval is a block of width 1, stored
+    as its values (NaN for null). A libFM file for any subset of the
+    attributes is a projection onto the chosen blocks, laid out exactly as
+    `libfm_lines` lays out that subset. So the superset of features can be
+    encoded once and the file for every feature combination written from it.
     """
-    cache = {}
-    data['pcgrade'] = data[['pcid', 'grdpts']].apply(
-        lambda s: '%d:%f' % tuple(s.values), axis=1)
-    def prior_cgrades(sid, termnum):
-        try:
-            return cache[(sid, termnum)]
-        except KeyError:
-            df = data[(data.sid == sid) & (data.termnum < termnum)]
-            if not len(df):
-                cache[(sid, termnum)] = []
-                return []
-            string = ' '.join(df.pcgrade)
-            cache[(sid, termnum)] = [string]
-            return [string]
 
-    return prior_cgrades
+    def __init__(self, target, codes, reals, terms=None):
+        """
+        Args:
+            target (np.ndarray): Target value of each record.
+            codes (dict of np.ndarray): Map from cval name to the int id of
+                each record, with -1 for null values.
+            reals (dict of np.ndarray): Map from rval name to the float value
+                of each record, with NaN for null values.
+            terms (np.ndarray): Term number of each record; only needed to
+                include previous course grades.
+        """
+        self.target = np.asarray(target, dtype=np.float64)
+        self.codes = codes
+        self.reals = reals
+        self.terms = terms
+
+    def __len__(self):
+        return len(self.target)
+
+    @classmethod
+    def from_frame(cls, data, target='grdpts', cvals=None, rvals=None):
+        """Encode the `cvals` and `rvals` columns of `data` as blocks. The
+        termnum column is kept as well if present. If `target` is None, the
+        target values are all 0.
+
+        Raises:
+            KeyError: if the target or any of the columns is not in `data`.
+        """
+        cvals = cvals if cvals else []
+        rvals = rvals if rvals else []
+        cols = data.columns
+        if target is not None and target not in cols:
+            raise KeyError("target: %s not in DataFrame" % target)
+        for colname in list(cvals) + list(rvals):
+            if colname not in cols:
+                raise KeyError("colname %s not in DataFrame" % colname)
+
+        codes = {}
+        for cval in cvals:
+            ids = data[cval].values.astype(np.float64)
+            codes[cval] = np.where(np.isnan(ids), -1, ids).astype(np.int64)
+        reals = {rval: data[rval].values.astype(np.float64) for rval in rvals}
+        terms = data['termnum'].values if 'termnum' in cols else None
+        target = (np.zeros(len(data)) if target is None
+                  else data[target].values)
+        return cls(target, codes, reals, terms)
+
+    def to_arrays(self):
+        """Return a dict of arrays for storage, e.g. with `np.savez`."""
+        arrays = {'target': self.target}
+        if self.terms is not None:
+            arrays['termnum'] = self.terms
+        for name, codes in self.codes.items():
+            arrays['cval__%s' % name] = codes
+        for name, values in self.reals.items():
+            arrays['rval__%s' % name] = values
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Mirror function for `to_arrays`; extra keys are ignored."""
+        codes, reals = {}, {}
+        for key in arrays:
+            kind, _, name = key.partition('__')
+            if kind == 'cval':
+                codes[name] = arrays[key]
+            elif kind == 'rval':
+                reals[name] = arrays[key]
+        terms = arrays['termnum'] if 'termnum' in arrays else None
+        return cls(arrays['target'], codes, reals, terms)
+
+    def width(self, cval):
+        """Number of feature ids taken up by the block for `cval`."""
+        codes = self.codes[cval]
+        return int(codes.max()) + 1 if len(codes) else 0
+
+    def layout(self, cvals=None, rvals=None, userid='sid', itemid='cid',
+               prev_cgrades=False, id_features=True):
+        """Lay out the feature ids for the given attributes. The user and item
+        ids are included as cvals unless `id_features` is False; they are
+        still used to find previous course grades.
+
+        Return:
+            cvals (list of str): cvals (with the user and item ids) in order.
+            rvals (list of str): rvals in order.
+            offsets (dict): Map from each attribute (and 'prev_cgrades' if
+                requested) to the first feature id of its block.
+            nfeatures (int): Total number of feature ids.
+        Raises:
+            KeyError: if any of the attributes was not encoded.
+        """
+        cvals, rvals = _layout_names(
+            cvals, rvals, userid, itemid, id_features)
+        for name in cvals:
+            if name not in self.codes:
+                raise KeyError("cval %s not in feature blocks" % name)
+        for name in rvals:
+            if name not in self.reals:
+                raise KeyError("rval %s not in feature blocks" % name)
+
+        offsets = {}
+        max_idx = 0
+        for cval in cvals:
+            offsets[cval] = max_idx
+            max_idx += self.width(cval)
+
+        # Previous course ids come next; there is one id per distinct course.
+        if prev_cgrades:
+            offsets['prev_cgrades'] = max_idx
+            cids = self.codes[itemid]
+            max_idx += len(np.unique(cids[cids >= 0])) + (cids < 0).any() + 1
+
+        for rval in rvals:
+            offsets[rval] = max_idx
+            max_idx += 1
+        return cvals, rvals, offsets, max_idx
+
+    def matrix(self, cvals=None, rvals=None, userid='sid', itemid='cid',
+               prev_cgrades=False, id_features=True):
+        """Project the records onto the blocks for the given attributes; see
+        `layout` for the args.
+
+        Return:
+            matrix (sp.sparse.csr_matrix): The libFM feature vector of each
+                record, with each row's entries in libFM file order.
+            onehot_end (int): Feature ids below this are one-hot cvals.
+        Raises:
+            KeyError: if any of the attributes was not encoded.
+            ValueError: if previous course grades are requested but the
+                records have no term numbers.
+        """
+        cvals, rvals, offsets, nfeatures = self.layout(
+            cvals, rvals, userid, itemid, prev_cgrades, id_features)
+        nrows = len(self)
+
+        parts = []
+        if cvals:
+            ids = np.column_stack(
+                [np.where(self.codes[cval] >= 0,
+                          self.codes[cval] + offsets[cval], -1)
+                 for cval in cvals])
+            parts.append(_dense_block(ids, np.ones(ids.shape)))
+        onehot_end = sum(self.width(cval) for cval in cvals)
+
+        # If requested, include ids for previous course grades.
+        if prev_cgrades:
+            if self.terms is None:
+                raise ValueError('term numbers needed for previous grades')
+            logging.info('accumulating previous course grades...')
+            parts.append(self._prior_cgrades(
+                userid, itemid, offsets['prev_cgrades']))
+            logging.info('done accumulating previous course grades')
+
+        if rvals:
+            values = np.column_stack([self.reals[rval] for rval in rvals])
+            ids = np.tile([offsets[rval] for rval in rvals], (nrows, 1))
+            ids[np.isnan(values)] = -1
+            parts.append(_dense_block(ids, values))
+
+        return stack_row_blocks(parts, nrows, nfeatures), onehot_end
+
+    def lines(self, cvals=None, rvals=None, userid='sid', itemid='cid',
+              prev_cgrades=False, id_features=True):
+        """Project the records onto the blocks for the given attributes and
+        encode them as libFM lines (see `write_libfm` for the format).
+
+        Return:
+            lines (np.ndarray): The encoded line for each record, in order.
+        """
+        if not len(self):
+            return np.array([], dtype=object)
+        matrix, onehot_end = self.matrix(
+            cvals, rvals, userid, itemid, prev_cgrades, id_features)
+        lines = []
+        for start in xrange(0, len(self), CHUNKSIZE):
+            end = start + CHUNKSIZE
+            text = format_rows(
+                matrix[start:end], self.target[start:end], onehot_end)
+            lines.extend(text.split('\n'))
+        return np.array(lines, dtype=object)
+
+    def _prior_cgrades(self, userid, itemid, start):
+        """Return the previous course grade entries of each record as a
+        row-aligned sparse block, with course ids laid out from `start`.
+        Each record's entries are ordered by term.
+        """
+        sids, cids = self.codes[userid], self.codes[itemid]
+        known = cids >= 0
+        cid_min = cids[known].min() if known.any() else 0
+        order, starts, ends = prior_record_slices(sids, self.terms, known)
+
+        # Gather each record's slice of the shared (sid, termnum) order.
+        counts = ends - starts
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+        positions = order[np.repeat(starts, counts) + offsets]
+        return (indptr, cids[positions] - cid_min + start,
+                self.target[positions])
+
+
+def libfm_lines(data, target='grdpts', userid='sid', itemid='cid',
+                cvals=None, rvals=None, prev_cgrades=False):
+    """Encode each record in the DataFrame as a line of libFM data (see
+    `write_libfm` for the format). The feature ids are laid out using all of
+    the records in `data`, so lines for records encoded together can be
+    combined freely into train and test files. The DataFrame is not modified.
+
+    Return:
+        lines (np.ndarray): The encoded line for each record, in order.
+    """
+    cvals, rvals = _layout_names(cvals, rvals, userid, itemid)
+    blocks = FeatureBlocks.from_frame(data, target, cvals, rvals)
+    return blocks.lines(cvals, rvals, userid, itemid, prev_cgrades)
 
 
 def write_libfm(ftrain, ftest, train, test, target='grdpts', userid='sid',
@@ -57,19 +422,35 @@ def write_libfm(ftrain, ftest, train, test, target='grdpts', userid='sid',
     gets a single id. They are written in the order passed in the `rvals`
     parameter.
     """
-    # Make sure we have data.
-    if (len(test) == 0) or (len(train) == 0):
+    encoded = encode_train_test(train, test, target, userid, itemid,
+                                cvals, rvals, prev_cgrades)
+    if encoded is None:
         return
+    matrix, target, onehot_end = encoded
+
+    ntrain = len(train)
+    logging.info('writing train file')
+    write_rows(ftrain, matrix[:ntrain], target[:ntrain], onehot_end)
 
-    # Set up values, inserting user and item ids into the cvals.
-    cvals = cvals if cvals else []
-    cvals.insert(0, itemid)
-    cvals.insert(0, userid)
-    cvals = list(set(cvals))
+    logging.info('writing test file')
+    write_rows(ftest, matrix[ntrain:], target[ntrain:], onehot_end)
 
-    rvals = rvals if rvals else []
-    rvals = list(set(rvals))
-    allvals = cvals + rvals
+
+def encode_train_test(train, test, target='grdpts', userid='sid',
+                      itemid='cid', cvals=None, rvals=None, prev_cgrades=False):
+    """Encode the train and test frames together so they share the same
+    feature ids; see `write_libfm`.
+
+    Return:
+        encoded (tuple): (matrix, target, onehot_end) for the train records
+            followed by the test records (see `FeatureBlocks.matrix`), or
+            None if either frame is empty.
+    Raises:
+        ValueError: if the train and test columns do not match.
+    """
+    # Make sure we have data.
+    if (len(test) == 0) or (len(train) == 0):
+        return None
 
     # Sanity check; make sure train/test columns are the same.
     train_cols = np.sort(train.columns.values)
@@ -80,65 +461,199 @@ def write_libfm(ftrain, ftest, train, test, target='grdpts', userid='sid',
                 ','.join(map(str, train.columns)),
                 ','.join(map(str, test.columns))))
 
-    # More sanity checking; make sure all columns passed are in DataFrame.
-    cols = train.columns  # we now know train/test have same columns
-    if target not in cols:
-        raise KeyError("target: %s not in DataFrame" % target)
-    for colname in allvals:
-        if colname not in cols:
-            raise KeyError("colname %s not in DataFrame" % colname)
-
-    # First, let's update the values for all cvals.
-    logging.info('updating cvals to create contiguous feature vector IDs')
-    max_idx = 0
-    for cval in cvals:
-        train[cval] += max_idx
-        test[cval] += max_idx
-        max_idx = max(
-            np.nanmax(train[cval].values), np.nanmax(test[cval].values)) + 1
-
-    # If requested, include ids for previous course grades.
-    # This relies on the presence of a 'pcid' key for previous course id.
-    if prev_cgrades:
-        logging.info('accumulating previous course grades...')
-        alldata = pd.concat((train, test))
-        cid_range = alldata.cid.max() - alldata.cid.min()
-        ids_between = max_idx - alldata.cid.max()
-        diff = cid_range + ids_between
-        alldata['pcid'] = alldata['cid'] + diff
-        prior_cgrades = make_prev_crecord_fmter(alldata)
-        max_idx += len(alldata.cid.unique()) + 1
-        logging.info('done accumulating previous course grades')
-
-    rval_indices = np.arange(len(rvals)) + max_idx
-
-    # Now we need to actually extract the cvals.
-    # This will be slow, because we must check each one for nan values.
-    def extract_row(series):
-        pieces = ['%f' % series[target]]
-        cval_part = \
-            ['%d:1' % series[cval] for cval in cvals if ~np.isnan(series[cval])]
-        rval_part = \
-            ['%d:%f' % (idx, series[key])
-             for idx, key in zip(rval_indices, rvals) if ~np.isnan(series[key])]
-        if prev_cgrades:
-            pieces = (pieces + cval_part +
-                      prior_cgrades(series['sid'], series['termnum']) +
-                      rval_part)
-        else:
-            pieces = pieces + cval_part + rval_part
-        return ' '.join(pieces)
-
-    # TODO: consider adding chunksize param to reduce memory overhead.
-    logging.info('writing train file')
-    lines = train.apply(extract_row, axis=1)
-    # print lines
-    ftrain.write('\n'.join(lines))
+    data = pd.concat((train, test))
+    cvals, rvals = _layout_names(cvals, rvals, userid, itemid)
+    blocks = FeatureBlocks.from_frame(data, target, cvals, rvals)
+    matrix, onehot_end = blocks.matrix(
+        cvals, rvals, userid, itemid, prev_cgrades)
+    return matrix, blocks.target, onehot_end
 
-    logging.info('writing test file')
-    lines = test.apply(extract_row, axis=1)
-    # print lines
-    ftest.write('\n'.join(lines))
+
+# libFM binary files are written in native (little-endian) byte order.
+# Each matrix file starts with this header: a file id, the size of the float
+# type, the number of entries, the number of rows and the number of columns.
+BINARY_FILE_ID = 2
+BINARY_HEADER = struct.Struct('<IIQII')
+
+
+def _write_binary_matrix(f, matrix, chunksize=CHUNKSIZE):
+    """Write a sparse matrix to the open file `f` in libFM's binary format.
+    After the header, each row is its number of entries followed by (uint id,
+    float value) pairs.
+    """
+    nrows, ncols = matrix.shape
+    f.write(BINARY_HEADER.pack(
+        BINARY_FILE_ID, 4, matrix.nnz, nrows, ncols))
+
+    for start in xrange(0, nrows, chunksize):
+        chunk = matrix[start:start + chunksize]
+        counts = np.diff(chunk.indptr)
+        values = chunk.data.astype('<f4').view('<u4')
+
+        # Each row takes one word for its count and two for each entry, so
+        # entry k of row r has its id at word 2k + r + 1.
+        words = np.empty(len(counts) + 2 * chunk.nnz, dtype='<u4')
+        words[2 * chunk.indptr[:-1] + np.arange(len(counts))] = counts
+        rows = np.repeat(np.arange(len(counts)), counts)
+        id_pos = 2 * np.arange(chunk.nnz) + rows + 1
+        words[id_pos] = chunk.indices
+        words[id_pos + 1] = values
+        f.write(words.tostring())
+
+
+def write_binary(stem, matrix, target, transpose=False):
+    """Write a feature matrix and its targets as libFM binary data files.
+
+    libFM reads binary data when given the file stem (without extension) as
+    its -train or -test argument, which skips parsing text entirely. The
+    transposed design, which MCMC and ALS learning need, is read from the
+    .xt file if it exists instead of being built in memory.
+
+    Args:
+        stem (str): Path the files are written to, without extension.
+        matrix (sp.sparse.csr_matrix): The feature vectors, one per row.
+        target (np.ndarray): The target value of each row.
+        transpose (bool): Also write the transposed matrix to `stem`.xt.
+    """
+    with open('%s.x' % stem, 'wb') as f:
+        _write_binary_matrix(f, matrix)
+
+    with open('%s.y' % stem, 'wb') as f:
+        f.write(struct.pack('<I', len(target)))
+        f.write(np.asarray(target, dtype='<f4').tostring())
+
+    if transpose:
+        # Converting to CSC keeps duplicate entries, like the text format.
+        transposed = matrix.tocsc()
+        transposed = sp.sparse.csr_matrix(
+            (transposed.data, transposed.indices, transposed.indptr),
+            shape=(matrix.shape[1], matrix.shape[0]))
+        with open('%s.xt' % stem, 'wb') as f:
+            _write_binary_matrix(f, transposed)
+
+
+def write_libfm_binary(train_stem, test_stem, train, test, target='grdpts',
+                       userid='sid', itemid='cid', cvals=None, rvals=None,
+                       prev_cgrades=False, transpose=False):
+    """Write the train and test frames as libFM binary data files, with the
+    same feature layout as `write_libfm`. See `write_binary`.
+
+    Return:
+        written (bool): False if either frame is empty and nothing was written.
+    """
+    encoded = encode_train_test(train, test, target, userid, itemid,
+                                cvals, rvals, prev_cgrades)
+    if encoded is None:
+        return False
+    matrix, target, onehot_end = encoded
+
+    ntrain = len(train)
+    logging.info('writing binary train files')
+    write_binary(train_stem, matrix[:ntrain], target[:ntrain], transpose)
+
+    logging.info('writing binary test files')
+    write_binary(test_stem, matrix[ntrain:], target[ntrain:], transpose)
+    return True
+
+
+# Student and course attributes that can be written as libFM relations.
+ENTITY_RELATIONS = {
+    'student': ('sid', ['major', 'hs', 'zip', 'sex', 'srace', 'cohort',
+                        'age', 'hsgpa', 'sat']),
+    'course': ('cid', ['cdisc', 'clevel', 'iid', 'iclass', 'irank',
+                       'itenure'])
+}
+
+
+def relation_rows(data, columns):
+    """Find the distinct rows of `data[columns]` and map each record to one.
+
+    Return:
+        block (DataFrame): The distinct rows, in order of first occurrence.
+        rows (np.ndarray): The row of `block` for each record in `data`.
+    """
+    block = data[columns].drop_duplicates()
+    block.index = np.arange(len(block))
+    keys = block.reset_index().rename(columns={'index': '_relrow'})
+    rows = data[columns].merge(keys, how='left', on=columns)['_relrow']
+    return block, rows.values.astype(np.int64)
+
+
+def write_libfm_relational(train_stem, test_stem, train, test, relations,
+                           target='grdpts', userid='sid', itemid='cid',
+                           cvals=None, rvals=None, prev_cgrades=False):
+    """Write the train and test frames as libFM relational block-structure
+    (BS) data, in libFM's binary format.
+
+    Attributes that belong to an entity, such as a student's major or a
+    course's discipline, repeat on every record for that entity. With block
+    structure, each distinct row of an entity's attributes is stored once in
+    the relation's own design matrix, and each record only refers to its row.
+    For each relation, the design matrix is written to <rel>.x/.xt (and .y)
+    and the row of each train and test record to the text files <rel>.train
+    and <rel>.test, where <rel> is `rel.<name>` next to `train_stem`. The
+    relation stems are passed to libFM with -relation; feature ids start at 0
+    in each block, since libFM offsets them itself.
+
+    The main design holds the target, the cvals and rvals that are not in a
+    relation and the previous course grades, if requested. The user and item
+    ids are only written in the main design if they are not relation keys.
+
+    Args:
+        relations (dict): Map from relation name to a tuple (key, attributes),
+            e.g. {'student': ('sid', ['major', 'sex', 'hsgpa'])}. Of the
+            attributes, those in `cvals` and `rvals` are written in the
+            relation; see `ENTITY_RELATIONS`.
+        See `write_libfm` for the other args.
+    Return:
+        stems (list of str): The relation stems, in order, or None if either
+            frame is empty and nothing was written.
+    """
+    if (len(test) == 0) or (len(train) == 0):
+        return None
+
+    cvals = list(cvals) if cvals else []
+    rvals = list(rvals) if rvals else []
+    data = pd.concat((train, test))
+    ntrain = len(train)
+
+    # Write the design matrix and row mappings for each relation.
+    in_relation = set()
+    stems = []
+    outdir = os.path.dirname(train_stem)
+    for name, (key, attributes) in sorted(relations.items()):
+        rel_cvals = [cval for cval in cvals if cval in attributes]
+        rel_rvals = [rval for rval in rvals if rval in attributes]
+        in_relation |= set([key] + rel_cvals + rel_rvals)
+        block, rows = relation_rows(data, [key] + rel_cvals + rel_rvals)
+
+        logging.info('writing relation %s with %d rows' % (name, len(block)))
+        blocks = FeatureBlocks.from_frame(
+            block, None, [key] + rel_cvals, rel_rvals)
+        matrix, _ = blocks.matrix(
+            [key] + rel_cvals, rel_rvals, id_features=False)
+        stem = os.path.join(outdir, 'rel.%s' % name)
+        write_binary(stem, matrix, blocks.target, transpose=True)
+        np.savetxt('%s.train' % stem, rows[:ntrain], fmt='%d')
+        np.savetxt('%s.test' % stem, rows[ntrain:], fmt='%d')
+        stems.append(stem)
+
+    # The main design holds everything not stored in a relation.
+    main_cvals = [cval for cval in [userid, itemid] + cvals
+                  if cval not in in_relation]
+    main_rvals = [rval for rval in rvals if rval not in in_relation]
+    blocks = FeatureBlocks.from_frame(
+        data, target, list(set([userid, itemid] + cvals)), rvals)
+    matrix, _ = blocks.matrix(main_cvals, main_rvals, userid, itemid,
+                              prev_cgrades, id_features=False)
+
+    logging.info('writing binary train files')
+    write_binary(train_stem, matrix[:ntrain], blocks.target[:ntrain],
+                 transpose=True)
+    logging.info('writing binary test files')
+    write_binary(test_stem, matrix[ntrain:], blocks.target[ntrain:],
+                 transpose=True)
+    return stems
 
 
 def write_triples(f, data, userid='sid', itemid='cid', rating='grdpts'):
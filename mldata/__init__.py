@@ -1,11 +1,17 @@
 from mldata import (
-    FeatureGuide, PandasDataset, PandasFullDataset, PandasTrainTestSplit)
+    FeatureGuide, FeatureMap, PandasDataset, PandasFullDataset,
+    PandasTrainTestSplit)
 from model import (
     Model, SklearnModel, ResultsBase, Results, RegressionResults, ResultsSet,
-    SklearnRegressionRunner, RegressionResultsSet)
+    SklearnRegressionRunner, RegressionResultsSet, LeanResults,
+    LeanRegressionResults)
+from sweep import SklearnRegressionSweep, summarize_sweep
+from serve import FeatureEncoder, PredictionService
+from fm import FactorizationMachine
 
 __all__ = [
     'FeatureGuide',
+    'FeatureMap',
     'PandasDataset',
     'PandasFullDataset',
     'PandasTrainTestSplit',
@@ -16,5 +22,12 @@ __all__ = [
     'RegressionResults',
     'ResultsSet',
     'SklearnRegressionRunner',
-    'RegressionResultsSet'
+    'RegressionResultsSet',
+    'LeanResults',
+    'LeanRegressionResults',
+    'SklearnRegressionSweep',
+    'summarize_sweep',
+    'FeatureEncoder',
+    'PredictionService',
+    'FactorizationMachine'
 ]
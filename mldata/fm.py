@@ -0,0 +1,323 @@
+"""
+In-process factorization machine (FM) with a scikit-learn compatible API. It
+works directly on the (sparse) feature matrices returned by
+`PandasTrainTestSplit.preprocess`, so it can be wrapped in a `SklearnModel`
+and used with the runners and sweeps without writing any data to disk or
+calling out to libFM.
+
+The model is the second-order FM used by libFM:
+
+    y(x) = w0 + sum_j w_j x_j + sum_{j<l} <v_j, v_l> x_j x_l
+
+and it can be learned with the same three methods:
+
+    als:  alternating least squares (coordinate descent), as in libFM.
+    mcmc: Gibbs sampling with hyperpriors on the regularization, as in libFM;
+          predictions are averaged over the samples drawn after burn-in.
+          The biases and weights are kept as running means; the latent
+          factors of up to `n_samples` evenly spaced samples are kept, since
+          the prediction is not linear in them.
+    sgd:  mini-batch stochastic gradient descent on the squared error.
+
+For ALS and MCMC, each parameter update depends only on the rows where its
+feature is active. The columns of a one-hot encoded attribute are never active
+in the same row, so all of them are updated at once with a few vectorized
+operations, which gives exactly the same result as updating them one by one.
+The attributes are read from the one-hot column ranges of the `FeatureMap`
+passed as `feature_indices` to `fit` (the feature map from `preprocess`);
+without them, every column is updated on its own.
+"""
+import logging
+import multiprocessing.pool
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.utils import check_random_state
+
+
+def feature_groups(fmap, nfeatures):
+    """Group the columns of a feature matrix so that no two columns in a group
+    can be nonzero in the same row. Groups are in column order.
+
+    Args:
+        fmap (FeatureMap): The feature map returned by `preprocess`; each
+            of its one-hot ranges is a group. Without one-hot ranges (e.g. a
+            plain list or None), each column is its own group.
+        nfeatures (int): Number of columns.
+    Return:
+        groups (list of np.ndarray): Column indices of each group.
+    """
+    groups = []
+    col = 0
+    for start, end in sorted(getattr(fmap, 'onehot_ranges', None) or []):
+        end = min(end, nfeatures)
+        groups.extend(np.array([j]) for j in range(col, start))
+        if end > max(start, col):
+            groups.append(np.arange(max(start, col), end))
+        col = max(col, end)
+    groups.extend(np.array([j]) for j in range(col, nfeatures))
+    return groups
+
+
+class _ColumnGroup(object):
+    """Nonzero entries of a group of columns, for vectorized updates."""
+
+    def __init__(self, X_csc, cols):
+        sub = X_csc[:, cols]
+        self.cols = cols
+        self.rows = sub.indices
+        self.values = sub.data
+        self.local = np.repeat(np.arange(len(cols)), np.diff(sub.indptr))
+
+    def sums(self, weights):
+        """Sum `weights` (one per entry) for each column of the group."""
+        return np.bincount(self.local, weights=weights,
+                           minlength=len(self.cols))
+
+
+class FactorizationMachine(BaseEstimator, RegressorMixin):
+    """Second-order factorization machine regressor; see the module docs."""
+
+    def __init__(self, method='als', n_iter=100, rank=8, init_stdev=0.1,
+                 reg0=0.0, reg1=0.0, reg2=0.0, learning_rate=0.01,
+                 batch_size=1000, burn_in=0, n_samples=20, n_jobs=1,
+                 random_state=None):
+        """
+        Args:
+            method (str): Learning method; 'als', 'mcmc' or 'sgd'.
+            n_iter (int): Number of passes over the parameters (or epochs).
+            rank (int): Number of latent factors per feature.
+            init_stdev (float): Standard deviation of the Gaussian the latent
+                factors are initialized from.
+            reg0 (float): Regularization of the global bias (ALS, SGD).
+            reg1 (float): Regularization of the 1-way weights (ALS, SGD).
+            reg2 (float): Regularization of the latent factors (ALS, SGD).
+            learning_rate (float): Step size for SGD.
+            batch_size (int): Number of records per SGD step.
+            burn_in (int): Number of MCMC samples drawn before the samples
+                predictions are averaged over.
+            n_samples (int): Maximum number of MCMC samples whose latent
+                factors are kept, evenly spaced after burn-in. The model holds
+                (# features x rank x n_samples) floats for them.
+            n_jobs (int): Number of threads used to compute predictions over
+                chunks of rows.
+            random_state (int | np.random.RandomState): Seed for the
+                initialization, sampling and shuffling.
+        """
+        self.method = method
+        self.n_iter = n_iter
+        self.rank = rank
+        self.init_stdev = init_stdev
+        self.reg0 = reg0
+        self.reg1 = reg1
+        self.reg2 = reg2
+        self.learning_rate = learning_rate
+        self.batch_size = batch_size
+        self.burn_in = burn_in
+        self.n_samples = n_samples
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y, feature_indices=None):
+        """Learn the model parameters.
+
+        Args:
+            X (np.ndarray | sp.sparse.spmatrix): Feature vectors.
+            y (np.ndarray): Target values.
+            feature_indices (FeatureMap): Feature map of X from `preprocess`;
+                its one-hot ranges are updated together.
+        Return:
+            self (FactorizationMachine): The fitted model.
+        Raises:
+            ValueError: for an unknown learning method.
+        """
+        if self.method not in ('als', 'mcmc', 'sgd'):
+            raise ValueError('unknown learning method: %s' % self.method)
+
+        X = sp.sparse.csr_matrix(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        rng = check_random_state(self.random_state)
+
+        self.w0_ = 0.0
+        self.w_ = np.zeros(X.shape[1])
+        self.V_ = rng.normal(0, self.init_stdev, (X.shape[1], self.rank))
+
+        logging.info('fitting FM with %s on %d x %d matrix' % (
+            self.method, X.shape[0], X.shape[1]))
+        if self.method == 'sgd':
+            self._fit_sgd(X, y, rng)
+        else:
+            groups = [_ColumnGroup(X.tocsc(), cols)
+                      for cols in feature_groups(feature_indices, X.shape[1])]
+            if self.method == 'als':
+                self._fit_als(X, y, groups)
+            else:
+                self._fit_mcmc(X, y, groups, rng)
+        return self
+
+    def predict(self, X):
+        """Predict the target for each feature vector in X. For MCMC, the
+        predictions are averaged over the kept samples.
+        """
+        X = sp.sparse.csr_matrix(X, dtype=np.float64)
+        if not getattr(self, 'n_samples_', 0):
+            return self._predict_chunks(X, self.w0_, self.w_, self.V_)
+
+        # The pairwise term of the mean prediction is that of the factors of
+        # all kept samples side by side, divided by the number of samples.
+        pred = self._predict_chunks(X, 0.0, np.zeros(X.shape[1]),
+                                    self.V_samples_)
+        return (self.w0_mean_ + X.dot(self.w_mean_) +
+                pred / self.n_samples_)
+
+    def _predict_chunks(self, X, w0, w, V):
+        """Compute predictions over chunks of rows on `n_jobs` threads."""
+        if self.n_jobs <= 1 or X.shape[0] < 2 * self.n_jobs:
+            return self._decision(X, w0, w, V)
+
+        bounds = np.linspace(0, X.shape[0], self.n_jobs + 1).astype(int)
+        chunks = [X[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.pool.ThreadPool(self.n_jobs)
+        try:
+            parts = pool.map(lambda chunk: self._decision(chunk, w0, w, V),
+                             chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return np.concatenate(parts)
+
+    @staticmethod
+    def _decision(X, w0, w, V):
+        XV = X.dot(V)
+        pairwise = 0.5 * ((XV ** 2).sum(axis=1) -
+                          X.multiply(X).dot(V ** 2).sum(axis=1))
+        return w0 + X.dot(w) + np.asarray(pairwise).ravel()
+
+    def _fit_als(self, X, y, groups):
+        err = self._decision(X, self.w0_, self.w_, self.V_) - y
+        for iteration in range(self.n_iter):
+            self._sweep(X, err, groups, self._solve)
+            logging.debug('iteration %d: train rmse=%.4f' % (
+                iteration, np.sqrt((err ** 2).mean())))
+
+    def _solve(self, theta, h2, he, reg, kind):
+        """Closed-form coordinate update for the parameters `theta`, given
+        the sums of squared derivatives `h2` and derivative-weighted errors
+        `he`. Parameters of features with no active rows are unchanged.
+        """
+        denom = h2 + reg
+        active = denom > 0
+        new = theta.copy()
+        new[active] = (theta[active] * h2[active] - he[active]) / denom[active]
+        return new
+
+    def _sweep(self, X, err, groups, update):
+        """Update every parameter once, keeping the error `err` (prediction
+        minus target) up to date. `update` gives the new values of a set of
+        parameters; see `_solve`.
+        """
+        # Global bias; its derivative is 1 for every row.
+        n = float(len(err))
+        w0 = update(np.array([self.w0_]), np.array([n]),
+                    np.array([err.sum()]), self.reg0, 'w0')[0]
+        err += w0 - self.w0_
+        self.w0_ = w0
+
+        # 1-way weights; the derivative of w_j is x_j.
+        for group in groups:
+            x = group.values
+            old = self.w_[group.cols]
+            new = update(old, group.sums(x * x),
+                         group.sums(x * err[group.rows]), self.reg1, 'w')
+            err[group.rows] += x * (new - old)[group.local]
+            self.w_[group.cols] = new
+
+        # Latent factors; the derivative of v_jf is x_j (q_f - v_jf x_j).
+        for f in range(self.rank):
+            q = X.dot(self.V_[:, f])
+            for group in groups:
+                x = group.values
+                old = self.V_[group.cols, f]
+                h = x * (q[group.rows] - old[group.local] * x)
+                new = update(old, group.sums(h * h),
+                             group.sums(h * err[group.rows]), self.reg2,
+                             ('v', f))
+                delta = (new - old)[group.local]
+                err[group.rows] += h * delta
+                q[group.rows] += x * delta
+                self.V_[group.cols, f] = new
+
+    def _fit_mcmc(self, X, y, groups, rng):
+        """Gibbs sampling as in Bayesian FMs: the noise precision and the mean
+        and precision of the priors on the weights and on each factor are
+        sampled along with the parameters, with flat Gamma(1, 1) hyperpriors.
+        """
+        err = self._decision(X, self.w0_, self.w_, self.V_) - y
+        n = len(y)
+        n_kept = max(self.n_iter - self.burn_in, 0)
+        step = int(np.ceil(n_kept / float(max(self.n_samples, 1)))) or 1
+        w0_sum, w_sum, V_samples = 0.0, np.zeros(X.shape[1]), []
+        for iteration in range(self.n_iter):
+            alpha = rng.gamma((1.0 + n) / 2, 2.0 / (1.0 + (err ** 2).sum()))
+            priors = {'w0': (0.0, 0.0), 'w': self._sample_prior(self.w_, rng)}
+            for f in range(self.rank):
+                priors[('v', f)] = self._sample_prior(self.V_[:, f], rng)
+
+            def sample(theta, h2, he, reg, kind):
+                mu, lam = priors[kind]
+                var = 1.0 / (alpha * h2 + lam)
+                mean = var * (alpha * (theta * h2 - he) + mu * lam)
+                return mean + np.sqrt(var) * rng.standard_normal(len(theta))
+
+            self._sweep(X, err, groups, sample)
+            logging.debug('iteration %d: train rmse=%.4f' % (
+                iteration, np.sqrt((err ** 2).mean())))
+            if iteration >= self.burn_in:
+                w0_sum += self.w0_
+                w_sum += self.w_
+                if (iteration - self.burn_in) % step == 0:
+                    V_samples.append(self.V_.copy())
+
+        self.w0_mean_ = w0_sum / max(n_kept, 1)
+        self.w_mean_ = w_sum / max(n_kept, 1)
+        self.n_samples_ = len(V_samples)
+        self.V_samples_ = (np.hstack(V_samples) if V_samples
+                           else np.zeros((X.shape[1], 0)))
+
+    @staticmethod
+    def _sample_prior(theta, rng, mu0=0.0, gamma0=1.0, alpha0=1.0, beta0=1.0):
+        """Sample the (mean, precision) of the Gaussian prior on `theta`."""
+        p = len(theta)
+        mu = theta.mean() if p else mu0
+        lam = rng.gamma(
+            (alpha0 + p + 1) / 2.0,
+            2.0 / (beta0 + ((theta - mu) ** 2).sum() + gamma0 * (mu - mu0) ** 2))
+        mu = rng.normal((theta.sum() + gamma0 * mu0) / (p + gamma0),
+                        np.sqrt(1.0 / ((p + gamma0) * lam)))
+        return mu, lam
+
+    def _fit_sgd(self, X, y, rng):
+        n = X.shape[0]
+        for iteration in range(self.n_iter):
+            order = rng.permutation(n)
+            for start in range(0, n, self.batch_size):
+                rows = order[start:start + self.batch_size]
+                Xb = X[rows]
+                XV = Xb.dot(self.V_)
+                pred = self.w0_ + Xb.dot(self.w_) + 0.5 * (
+                    (XV ** 2).sum(axis=1) -
+                    np.asarray(Xb.multiply(Xb).dot(self.V_ ** 2)).sum(axis=1))
+                g = (pred - y[rows]) / len(rows)
+
+                grad_V = (Xb.T.dot(g[:, None] * XV) -
+                          self.V_ * Xb.multiply(Xb).T.dot(g)[:, None])
+                self.w0_ -= self.learning_rate * (g.sum() + self.reg0 * self.w0_)
+                self.w_ -= self.learning_rate * (
+                    Xb.T.dot(g) + self.reg1 * self.w_)
+                self.V_ -= self.learning_rate * (grad_V + self.reg2 * self.V_)
+
+            logging.debug('epoch %d done' % iteration)
+
@@ -791,7 +791,7 @@ class PandasDatasetSplitter(object):
             test_mask = self.test_cmp(column, val)
             yield self.dataset.split(train_mask, test_mask)
 
-    def iteritems(self, errors='log'):
+    def iteritems(self, errors='log', exclude=()):
         """Iterate over all possible splits, returning each in a tuple with its
         associated value.
 
@@ -802,11 +802,15 @@ class PandasDatasetSplitter(object):
                 If "raise": simply let errors propogate.
                 If "log": log the error with level `logging.ERROR`.
                 If "ignore": log with level `logging.INFO`.
+            exclude (iterable): Values to skip; no split is produced for them.
         Return:
             generator of (val, TrainTestSplit) pairs.
         """
         column = self.column
+        exclude = set(exclude)
         for val in self.unique_values:
+            if val in exclude:
+                continue
             try:
                 split = self.dataset.split(
                     self.train_cmp(column, val), self.test_cmp(column, val))
@@ -829,6 +833,39 @@ class PandasDatasetSplitter(object):
             self.train_cmp(column, val), self.test_cmp(column, val))
 
 
+class FeatureMap(list):
+    """Names of the columns of an encoded feature matrix, in column order.
+
+    Also holds, for each one-hot encoded attribute, its name, its (start, end)
+    column range and the sorted values its columns stand for, so models and
+    encoders can tell which columns are never active together and what each
+    column means without parsing the names.
+    """
+
+    def __init__(self, names=(), onehot_ranges=(), onehot_columns=(),
+                 onehot_values=()):
+        list.__init__(self, names)
+        self.onehot_ranges = list(onehot_ranges)
+        self.onehot_columns = list(onehot_columns)
+        self.onehot_values = list(onehot_values)
+
+    def add_onehot(self, column, values):
+        """Append the one-hot features of `column`, one per sorted value."""
+        start = len(self)
+        self.extend('%s-%d' % (column, value) for value in values)
+        self.onehot_ranges.append((start, len(self)))
+        self.onehot_columns.append(column)
+        self.onehot_values.append(np.asarray(values))
+
+    def shifted(self, labels):
+        """Return a new map with the columns `labels` added at the front."""
+        n = len(labels)
+        return FeatureMap(list(labels) + list(self),
+                          [(start + n, end + n)
+                           for start, end in self.onehot_ranges],
+                          self.onehot_columns, self.onehot_values)
+
+
 class PandasTrainTestSplit(PandasDataset):
 
     @classmethod
@@ -864,7 +901,9 @@ class PandasTrainTestSplit(PandasDataset):
             train = train_df.set_index(index_col)[usecols]
             test = test_df.set_index(index_col)[usecols]
 
-        return cls(train, test, copy.deepcopy(fguide))
+        dset = cls(train, test, copy.deepcopy(fguide))
+        dset.test_rows = test_df.index.values
+        return dset
 
     def __init__(self, train_df, test_df, fguide):
         # Sanity checks
@@ -883,6 +922,10 @@ class PandasTrainTestSplit(PandasDataset):
         self.test = test_df
         self.fguide = fguide
 
+        # Labels of the test rows in the DataFrame they were split from, in
+        # test set order; None if the split was not made from a DataFrame.
+        self.test_rows = None
+
         # Instance variables to store metadata generated during transformations.
         self.column_maps = {}  # mapping from one space to another
         self.imputations = {}  # imputing missing values
@@ -1105,9 +1148,9 @@ class PandasTrainTestSplit(PandasDataset):
                 from the training dataset.
             test_enc (csr_matrix): Sparse matrix with one-hot encoded columns
                 from the testing dataset.
-            fmap (list): Map from the column names to the column indices in the
-                sparse matrix where the encoded features for that column are
-                present.
+            fmap (FeatureMap): Map from the column names to the column indices
+                in the sparse matrix where the encoded features for that
+                column are present.
             encoder (OneHotEncoder): Encoder used to encode the data.
         """
         if not columns:
@@ -1129,12 +1172,12 @@ class PandasTrainTestSplit(PandasDataset):
 
         # Create a feature map for decoding one-hot encoding.
         counts = np.array([both_sets[col].unique().shape[0] for col in columns])
-        fmap = []
+        fmap = FeatureMap()
         for i, column in enumerate(columns):
             unique_elements = np.sort(both_sets[column].unique())
             logging.debug('unique elements for col {}: {}'.format(
                 column, unique_elements))
-            fmap += ['%s-%d' % (column, idx) for idx in unique_elements]
+            fmap.add_onehot(column, unique_elements)
 
         logging.info('after one-hot encoding, found # unique values:')
         for attr, n_values in zip(columns, counts):
@@ -1153,7 +1196,10 @@ class PandasTrainTestSplit(PandasDataset):
             logging.info(
                 'removing %d %s ids from the test set.' % (len(diff), key))
             logging.debug(' '.join(map(str, diff)))
-            self.test = self.test[~self.test[key].isin(diff)]
+            keep = ~self.test[key].isin(diff)
+            self.test = self.test[keep]
+            if self.test_rows is not None:
+                self.test_rows = self.test_rows[keep.values]
 
     def preprocess(self, impute=True, all_null='raise', normalize=True,
                    use_ents=True, ohc_ents=True, use_cats=True, ohc_cats=True,
@@ -1202,7 +1248,9 @@ class PandasTrainTestSplit(PandasDataset):
         The next 3 return values are the same except for the test set. The final
         two values are:
 
-        7.  indices: The indices of each feature in the encoded X matrix.
+        7.  indices: The indices of each feature in the encoded X matrix, as
+            a FeatureMap, which also holds the column range of each one-hot
+            encoded attribute.
         8.  nents: The number of unique entities for each entity.
 
         """
@@ -1243,7 +1291,7 @@ class PandasTrainTestSplit(PandasDataset):
             # TODO: implement use_cats and ohc_cats args.
             n_ohc_total = 0
             nf_ohc = 0
-            fmap = []
+            fmap = FeatureMap()
 
         # Update feature matrices to include entities if they were not included
         # in the one-hot encoding.
@@ -1267,7 +1315,7 @@ class PandasTrainTestSplit(PandasDataset):
 
                 # Add to beginning of feature map.
                 labels = list(self.fguide.entities)
-                fmap = labels + fmap
+                fmap = fmap.shifted(labels)
 
                 # Add entities onto the beginning of the feature matrices.
                 train_enc_cats = sp.sparse.hstack((
@@ -4,11 +4,13 @@ as well as prediction evaluation logic.
 """
 import os
 import abc
+import atexit
 import copy
 import json
 import pydoc
 import shutil
 import inspect
+import tempfile
 import logging
 import warnings
 import importlib
@@ -55,7 +57,7 @@ class Model(object):
     @property
     def model_suffix(self):
         """All scikit-learn estimators have a `get_params` method."""
-        return naming.suffix_from_params(self.fixed_params())
+        return naming.suffix_from_params(self.fixed_params)
 
     @property
     def fixed_params(self):
@@ -134,15 +136,24 @@ class Model(object):
         This assumes the Model subclass exists in this module.
         """
         params = saveload.load_var_tree(savedir)
+        if 'estimator' in params['metadata']:  # saved by StoredSklearnModel
+            return StoredSklearnModel.load(savedir)
+
         model_module = importlib.import_module(params['metadata']['module'])
         model_class = getattr(model_module, params['metadata']['name'])
         inner_model = model_class(**params['fixed'])
 
-        outer_class = globals()[params['metadata']['class']]
-        model = outer_class(inner_model)
+        # Learned params are read from the inner model by `learned_params`, so
+        # they must be restored there for the loaded model to predict. Some are
+        # read-only properties derived from the others; those are skipped.
         for learned_param, val in params['learned'].items():
-            setattr(model, learned_param, val)
-        return model
+            try:
+                setattr(inner_model, learned_param, val)
+            except AttributeError:
+                logging.debug('unable to set learned param %s' % learned_param)
+
+        outer_class = globals()[params['metadata']['class']]
+        return outer_class(inner_model)
 
 
 def key_intersect(dict1, dict2):
@@ -224,24 +235,96 @@ class SklearnModel(Model):
         return self.model.predict(X, **filtered_kwargs)
 
 
+class StoredSklearnModel(SklearnModel):
+    """SklearnModel whose fitted estimator stays pickled in a file and is only
+    unpickled the first time it is used. Saving it records where the file is
+    instead of the learned parameters.
+    """
+
+    def __init__(self, path, model_class, **preprocess_args):
+        """
+        Args:
+            path (str): File the fitted estimator is pickled in.
+            model_class (type): Class of the estimator.
+            preprocess_args (dict): See `Model.__init__`.
+        """
+        Model.__init__(self, None, **preprocess_args)
+        self.path = path
+        self.model_class = model_class
+
+    @property
+    def model(self):
+        if self._model is None:
+            with open(self.path, 'rb') as f:
+                self._model = pickle.load(f)
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    @property
+    def model_name(self):
+        return self.model_class.__name__
+
+    def clone(self):
+        return SklearnModel(self.model, **self.preprocess_args).clone()
+
+    def save(self, savedir, ow=False):
+        """Save a reference to the pickled estimator, relative to `savedir`."""
+        params = {
+            'metadata': {
+                'class': self.__class__.__name__,
+                'name': self.model_name,
+                'module': self.model_class.__module__,
+                'estimator': os.path.relpath(self.path, savedir)
+            }
+        }
+        saveload.save_var_tree(params, savedir, ow)
+
+    @classmethod
+    def load(cls, savedir):
+        """Mirror function for `save`."""
+        metadata = saveload.load_var_tree(savedir)['metadata']
+        model_module = importlib.import_module(metadata['module'])
+        model_class = getattr(model_module, metadata['name'])
+        path = os.path.normpath(os.path.join(savedir, metadata['estimator']))
+        return cls(path, model_class)
+
+
 class SklearnModelMP(mp.Process):
     """Multiprocessing variant of SklearnModel."""
 
-    def __init__(self, model, split, pipe, *args, **kwargs):
+    def __init__(self, model, split, pipe, model_path, *args, **kwargs):
         """Takes a model, a TrainTestSplit, and a pipe connected to the caller.
 
+        Only the predictions (float32) and the source labels of the test rows
+        are sent back through the pipe. The fitted estimator is pickled to
+        `model_path`, where it stays; the parent rebuilds the test data from
+        the dataset it split.
+
         Args:
             model (sklearn.estimator): A model with the scikit-learn estimator
                 interface. This will be fitted to the training set and used to
                 make predictions on the test set.
             split (TrainTestSplit): The training and test data.
             pipe (multiprocessing.Pipe): For communication to the parent
-                process -- to communicate results and learned parameters.
+                process -- to communicate the predictions.
+            model_path (str): File the fitted estimator is pickled to.
         """
         mp.Process.__init__(self, *args, **kwargs)
         self.model = model
         self.split = split
         self.pipe = pipe
+        self.model_path = model_path
+
+    def save_estimator(self):
+        """Pickle the fitted estimator to `model_path` atomically."""
+        tmp_path = '%s.tmp-%d' % (self.model_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.model.model, f, -1)
+        os.rename(tmp_path, self.model_path)
+        return self.model_path
 
     def run(self):
         train_X, train_y, train_eids,\
@@ -256,7 +339,10 @@ class SklearnModelMP(mp.Process):
         self.model.fit(train_X, train_y, **kwargs)
         kwargs['entity_ids'] = test_eids.values
         pred_y = self.model.predict(test_X, **kwargs)
-        self.pipe.send([pred_y, self.split.test, self.split.fguide, self.model.model])
+
+        self.save_estimator()
+        self.pipe.send([np.asarray(pred_y, dtype=np.float32).ravel(),
+                        self.split.test_rows])
         return 0
 
 
@@ -320,6 +406,10 @@ class Results(ResultsBase):
         """Return model params learned during fitting."""
         return self.model.learned_params
 
+    @property
+    def test_columns(self):
+        return self.test_data.columns
+
     def save(self, savedir, ow=False):
         """Save the results, including the test data (with predictions in one
         column), the feature guide, and the learned model.
@@ -381,6 +471,72 @@ class Results(ResultsBase):
         return cls(predicted, test_data, fguide, model)
 
 
+class LeanResults(Results):
+    """Results that reference rows of the source dataset rather than holding
+    a copy of the test data. Only the test row labels, predictions and actual
+    values (float32) are stored; `test_data` joins the feature guide columns
+    back from the source dataset each time it is accessed.
+
+    Note that the joined columns hold the source values, not the mapped,
+    imputed and scaled values a full Results copies from its split.
+    """
+
+    def __init__(self, predicted, rows, actual, fguide, model, dataset):
+        """
+        Args:
+            predicted (array-like): Predictions for the test rows.
+            rows (array-like): Labels of the test rows in `dataset`.
+            actual (array-like): Target values for the test rows.
+            fguide (FeatureGuide): Feature guide of the split.
+            model (Model): The fitted model.
+            dataset (DataFrame): The DataFrame the split was made from.
+        """
+        self.fguide = fguide
+        self._pred_colname = '%s%s' % (fguide.target, self._predicted_suffix)
+        self.rows = np.asarray(rows)
+        self._predicted = np.asarray(predicted, dtype=np.float32).ravel()
+        self._actual = np.asarray(actual, dtype=np.float32).ravel()
+        self.model = model
+        self.dataset = dataset
+
+    @property
+    def predicted(self):
+        return pd.Series(
+            self._predicted, index=self.rows, name=self._pred_colname)
+
+    @property
+    def actual(self):
+        return pd.Series(
+            self._actual, index=self.rows, name=self.fguide.target)
+
+    @property
+    def _source_columns(self):
+        return [name for name in self.fguide.all_names
+                if name in self.dataset.columns]
+
+    @property
+    def test_columns(self):
+        return pd.Index(self._source_columns + [self._pred_colname])
+
+    @property
+    def test_data(self):
+        test_data = self.dataset.loc[self.rows, self._source_columns]
+        test_data.insert(
+            test_data.shape[1], self._pred_colname, self._predicted)
+        return test_data
+
+    @classmethod
+    def load(cls, savedir):
+        """Load results saved by either `Results.save` or `LeanResults.save`.
+        The saved test data becomes the source dataset of the loaded results.
+        """
+        results = Results.load(savedir)
+        dataset = results.test_data.drop(results._pred_colname, axis=1)
+        return cls(results.predicted.values, dataset.index.values,
+                   results.actual.values, results.fguide, results.model,
+                   dataset)
+
+
 # Define regression metrics that take an array of errors.
 def error_rmse(arr):
     return np.sqrt((arr ** 2).sum() / len(arr))
@@ -433,6 +589,11 @@ class RegressionResults(Results):
         return evaluation
 
 
+class LeanRegressionResults(LeanResults, RegressionResults):
+    """LeanResults with evaluation metrics for regression predictions."""
+    pass
+
+
 class ColumnMismatchError(Exception):
     """Raise when aggregating DataFrame objects with mismatched columns."""
     pass
@@ -459,16 +620,16 @@ class ResultsSet(ResultsBase):
         # Use the first Result object as the baseline.
         first_key, first_result = ResultsSet._get_first(results)
 
-        columns0 = np.sort(first_result.test_data.columns)
-        ncols0 = first_result.test_data.shape[1]
+        columns0 = np.sort(first_result.test_columns)
+        ncols0 = len(columns0)
         for key, result in results.iteritems():
-            ncols = result.test_data.shape[1]
+            ncols = len(result.test_columns)
             if ncols != ncols0:
                 raise ColumnMismatchError(
                     '# cols in Result {} test data != # cols in Result {} test'
                     ' data ({} != {})'.format(key, first_key, ncols, ncols0))
             try:
-                columns = np.sort(result.test_data.columns)
+                columns = np.sort(result.test_columns)
                 matched = columns0 == columns
                 mismatched = not matched.all()
             except ValueError:  # shape mismatch
@@ -576,6 +737,11 @@ class ResultsSet(ResultsBase):
             if col_mismatch == 'raise':
                 raise
 
+            # Lean results read their test data from the source dataset, so
+            # there are no frames to fill.
+            if any(isinstance(res, LeanResults) for res in results_list):
+                raise
+
             # else fill using an outer join, which automatically replaces all
             # missing columns in any DataFrame with NaN columns.
             test_data_frames = [res.test_data for res in results_list]
@@ -752,11 +918,13 @@ class SklearnRegressionRunner(object):
 
     # Allow configuratoin through subclass instance variable overrides.
     _results_class = RegressionResults
+    _lean_results_class = LeanRegressionResults
     _results_set_class = RegressionResultsSet
     _model_class = SklearnModel
     _model_class_mp = SklearnModelMP
+    _stored_model_class = StoredSklearnModel
 
-    def __init__(self, model, splitter):
+    def __init__(self, model, splitter, checkpoint_dir=None, lean=False):
         """Wrap up a Model with a TrainTestSplitter with methods for training
         the model on the various train/test splits produced by the splitter.
 
@@ -764,9 +932,106 @@ class SklearnRegressionRunner(object):
             model (Model): The model to train and predict with.
             splitter (TrainTestSplitter): The splitter to use for producing
                 train/test data splits.
+            checkpoint_dir (str): If given, the results for each split are
+                saved under this directory as soon as they are available, and
+                `fit_predict_all` only runs splits without saved results.
+            lean (bool): If True, produce LeanResults, which reference the
+                splitter's dataset instead of copying each split's test data.
         """
         self.model = model
         self.splitter = splitter
+        self.checkpoint_dir = checkpoint_dir
+        self.lean = lean
+
+    @property
+    def results_class(self):
+        if self.lean:
+            return self._lean_results_class
+        return self._results_class
+
+    def _make_results(self, pred_y, test_rows, fguide, model):
+        """Build a Results object of the configured kind for one split. The
+        test data is taken from the splitter's dataset using the source row
+        labels in `test_rows`, so sequential and parallel runs build the same
+        results. Predictions are kept as float32.
+        """
+        dataset = self.splitter.dataset.dataset
+        pred_y = np.asarray(pred_y, dtype=np.float32).ravel()
+        if self.lean:
+            actual = dataset.loc[test_rows, fguide.target]
+            return self._lean_results_class(
+                pred_y, test_rows, actual.values, fguide, model, dataset)
+
+        usecols = [name for name in fguide.all_names
+                   if name in dataset.columns]
+        test = dataset.loc[test_rows, usecols].copy()
+        return self._results_class(pred_y, test, fguide, model)
+
+    @property
+    def checkpoint_model_dir(self):
+        """Directory holding the checkpointed results for this model's
+        parameter settings; one subdirectory per split value.
+        """
+        name = '%s-%s' % (self.model.model_name, self.model.model_suffix)
+        return os.path.join(self.checkpoint_dir, name)
+
+    def checkpoint_path(self, key):
+        return os.path.join(self.checkpoint_model_dir, str(key))
+
+    def checkpoint(self, key, result):
+        """Save the results for split `key` atomically. The results are saved
+        to a temporary directory which is then renamed into place, so a split
+        is only ever considered complete if all of its results were written.
+        """
+        if self.checkpoint_dir is None:
+            return
+
+        path = self.checkpoint_path(key)
+        tmp_path = '%s.tmp-%d' % (path, os.getpid())
+        result.save(tmp_path, ow=True)
+        saveload.ow_dir_if_exists(path)
+        os.rename(tmp_path, path)
+        logging.info('checkpointed results for split {}'.format(key))
+
+    def completed_keys(self):
+        """Return the split values with checkpointed results."""
+        if self.checkpoint_dir is None:
+            return []
+
+        try:
+            names = set(name for name in os.listdir(self.checkpoint_model_dir)
+                        if '.tmp-' not in name)
+        except OSError:  # nothing checkpointed yet
+            return []
+
+        return [val for val in self.splitter.unique_values
+                if str(val) in names]
+
+    def load_checkpoints(self):
+        """Assemble a ResultsSet from the results in the checkpoint directory.
+        """
+        results = {key: self.results_class.load(self.checkpoint_path(key))
+                   for key in self.completed_keys()}
+        return self._results_set_class(results)
+
+    def _prepare_checkpoint_dir(self):
+        """Create the checkpoint directory tree and return the split values
+        that already have results and should be skipped.
+        """
+        if self.checkpoint_dir is None:
+            return []
+
+        for dirname in (self.checkpoint_dir, self.checkpoint_model_dir):
+            try:
+                os.mkdir(dirname)
+            except OSError:
+                pass
+
+        done = self.completed_keys()
+        if done:
+            logging.info('skipping checkpointed splits: {}'.format(
+                ','.join(map(str, done))))
+        return done
 
     def fit_predict(self, split):
         """Take a TrainTestSplit and train a copy of the model with the same
@@ -781,6 +1046,7 @@ class SklearnRegressionRunner(object):
         """
         # Create copy of model with same params.
         model = self.model.clone()
+        fguide = copy.deepcopy(split.fguide)  # as before preprocessing
 
         train_X, train_y, train_eids,\
         test_X, test_y, test_eids, fmap, nents = \
@@ -794,7 +1060,7 @@ class SklearnRegressionRunner(object):
 
         kwargs['entity_ids'] = test_eids.values
         pred_y = model.predict(test_X, **kwargs)
-        return self._results_class(pred_y, split.test, split.fguide, model)
+        return self._make_results(pred_y, split.test_rows, fguide, model)
 
     def fit_predict_for_value(self, val):
         """Get the train/test set for `val`, train a copy of the model with the
@@ -821,6 +1087,9 @@ class SklearnRegressionRunner(object):
         2.  optional reassembly of full data frame with original and predicted
             results.
 
+        If the runner has a `checkpoint_dir`, splits with saved results are
+        skipped and the ResultsSet is assembled from the checkpoint directory.
+
         Args:
             parallel (bool): Run the separate splits using multiple processes
                 if True, else just use single main process. True by default.
@@ -828,9 +1097,14 @@ class SklearnRegressionRunner(object):
         Return: instance of ResultsSet.
         """
         if parallel:
-            return self._fit_predict_all_parallel(errors)
+            results = self._fit_predict_all_parallel(errors)
+        else:
+            results = self._fit_predict_all(errors)
+
+        if self.checkpoint_dir is None:
+            return results
         else:
-            return self._fit_predict_all(errors)
+            return self.load_checkpoints()
 
     def _fit_predict_all(self, errors='log'):
         """Run sequential fit/predict loop for all possible data splits in a
@@ -840,18 +1114,28 @@ class SklearnRegressionRunner(object):
             errors (str): see `mldata.TrainTestSplitter.iteritems`.
         Return: instance of ResultsSet.
         """
+        done = self._prepare_checkpoint_dir()
         results = {}
-        for val, split in self.splitter.iteritems(errors):
+        for val, split in self.splitter.iteritems(errors, exclude=done):
             logging.info('fit/predict for split {}'.format(val))
             results[val] = self.fit_predict(split)
+            self.checkpoint(val, results[val])
 
+        if not results and self.checkpoint_dir is not None:
+            return None  # all results come from the checkpoint directory
         return self._results_set_class(results)
 
-    def _convert_process_results(self, results_tuple):
-        """Override to accept different number of args as result."""
-        pred_y, test, fguide, inner_model = results_tuple
-        model = self._model_class(inner_model)
-        return self._results_class(pred_y, test, fguide, model)
+    def _convert_process_results(self, results_tuple, proc):
+        """Build the results for the split of worker `proc` from what it sent;
+        override to accept different number of args as result. The feature
+        guide comes from the parent's copy of the split, and the estimator is
+        left in its file until it is used.
+        """
+        pred_y, test_rows = results_tuple
+        model = self._stored_model_class(
+            proc.model_path, self.model.model.__class__,
+            **self.model.preprocess_args)
+        return self._make_results(pred_y, test_rows, proc.split.fguide, model)
 
     def _safe_get_results(self, procs, key, timeout=0.1):
         proc, conn = procs[key]
@@ -875,11 +1159,12 @@ class SklearnRegressionRunner(object):
             del procs[key]
 
             try:
-                return self._convert_process_results(result_tuple)
-            except ValueError:
+                return self._convert_process_results(result_tuple, proc)
+            except (ValueError, IOError, OSError, EOFError,
+                    pickle.UnpicklingError) as err:
                 logging.error(
                     'Process for key "{}" returned invalid results: {}'.format(
-                        key, result_tuple))
+                        key, err))
                 return
         else:
             if not proc.is_alive() and proc.exitcode != 0:
@@ -891,11 +1176,37 @@ class SklearnRegressionRunner(object):
 
     def _fit_predict_all_parallel(self, errors='log'):
         """Parallel variant of fit_predict_all."""
+        done = self._prepare_checkpoint_dir()
+        return self._run_processes(errors, done, self.estimator_dir)
+
+    @property
+    def estimator_dir(self):
+        """Directory workers pickle their fitted estimators to, rather than
+        sending them back through the pipes. The estimators stay there and are
+        loaded by the results when needed: under the checkpoint directory if
+        there is one, else in a temporary directory removed at exit.
+        """
+        if self.checkpoint_dir is not None:
+            path = os.path.join(self.checkpoint_model_dir, 'estimators')
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            return path
+
+        if getattr(self, '_estimator_dir', None) is None:
+            self._estimator_dir = tempfile.mkdtemp(prefix='estimators-')
+            atexit.register(shutil.rmtree, self._estimator_dir, True)
+        return self._estimator_dir
+
+    def _run_processes(self, errors, done, store_dir):
+        """Run one process per split not in `done`; see
+        `_fit_predict_all_parallel`.
+        """
         procs = {}
-        for key, split in self.splitter.iteritems(errors):
+        for key, split in self.splitter.iteritems(errors, exclude=done):
             parent_conn, child_conn = mp.Pipe()
+            model_path = os.path.join(store_dir, '%s.pickle' % key)
             proc = self._model_class_mp(
-                self.model.clone(), split, child_conn,
+                self.model.clone(), split, child_conn, model_path,
                 name='{}-{}'.format(self._model_class_mp.__name__, key))
             procs[key] = (proc, parent_conn)
 
@@ -915,6 +1226,7 @@ class SklearnRegressionRunner(object):
                     result = self._safe_get_results(procs, key, timeout)
                     if result is not None:
                         results[key] = result
+                        self.checkpoint(key, result)
                     else:
                         if key not in procs:
                             logging.error(
@@ -940,5 +1252,7 @@ class SklearnRegressionRunner(object):
         logging.info("Failed to get results for: {}".format(
             ','.join(map(str, failed))))
 
+        if not results and self.checkpoint_dir is not None:
+            return None  # all results come from the checkpoint directory
         return self._results_set_class(results)
 
@@ -0,0 +1,462 @@
+"""
+Online prediction for saved models. A fitted Model is exported together with
+the preprocessing state of the split it was trained on (entity id maps,
+imputations, scalers, and the one-hot feature layout). The state is loaded once
+into sorted array lookups, so scoring a batch of (student, course) records is a
+handful of `searchsorted` calls and one call to the model's `predict`.
+
+Records can be scored in-process with `PredictionService.predict` or over a
+local HTTP interface, where concurrent requests are micro-batched:
+
+    $ python serve.py path/to/export --port 8000
+    $ curl -d '{"records": [{"sid": 12, "cid": 40, "termnum": 9}]}' \\
+        localhost:8000/predict
+
+All entity and categorical values are assumed to be numeric, as they are in
+the preprocessed datasets produced by the pipeline.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+try:
+    import Queue as queue
+    import SocketServer as socketserver
+    import BaseHTTPServer as httpserver
+except ImportError:  # python 3
+    import queue
+    import socketserver
+    import http.server as httpserver
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+import saveload
+from model import Model
+
+
+class FeatureEncoder(object):
+    """Reproduce `PandasTrainTestSplit.preprocess` for new records using the
+    preprocessing state of an already preprocessed split.
+
+    Each one-hot encoded column is stored as a pair of arrays: the sorted raw
+    values seen during preprocessing and the feature index each maps to.
+    Values not seen during preprocessing produce no active feature for that
+    column (as with cold-start records).
+    """
+
+    _metadata_fname = 'encoder.json'
+    _arrays_fname = 'encoder.npz'
+
+    def __init__(self, ohc, passthrough, reals, arrays, nf, dense=False):
+        """
+        Args:
+            ohc (list of str): One-hot encoded columns.
+            passthrough (list of str): Entity columns included as a single
+                feature holding the contiguous entity id.
+            reals (list of str): Real-valued columns.
+            arrays (dict): Lookup arrays; see `from_split`.
+            nf (int): Total number of features.
+            dense (bool): Produce dense matrices; only used when the model was
+                trained on real-valued features alone.
+        """
+        self.ohc = list(ohc)
+        self.passthrough = list(passthrough)
+        self.reals = list(reals)
+        self.arrays = arrays
+        self.nf = nf
+        self.dense = dense
+
+    @property
+    def columns(self):
+        """All columns needed to encode a record."""
+        return self.passthrough + self.ohc + self.reals
+
+    @staticmethod
+    def _sorted_lookup(keys, values):
+        keys = np.asarray(keys, dtype=np.float64)
+        order = np.argsort(keys)
+        return keys[order], np.asarray(values)[order]
+
+    @classmethod
+    def from_split(cls, split, fmap, preprocess_args):
+        """Build the encoder from a split after `preprocess` has been run.
+
+        Args:
+            split (PandasTrainTestSplit): The preprocessed split.
+            fmap (FeatureMap): The feature map returned by `preprocess`.
+            preprocess_args (dict): The arguments given to `preprocess`.
+        """
+        fguide = split.fguide
+        use_ents = preprocess_args.get('use_ents', True)
+        ohc_ents = preprocess_args.get('ohc_ents', True)
+        positions = {name: i for i, name in enumerate(fmap)}
+        arrays = {}
+
+        # The one-hot features of each column stand for its sorted values:
+        # the contiguous id for entities and the raw value otherwise.
+        ohc = list(fmap.onehot_columns)
+        for col, (start, end), values in zip(
+                ohc, fmap.onehot_ranges, fmap.onehot_values):
+            reverse_map = split.column_maps.get(col)
+            keys = [value if reverse_map is None else reverse_map[int(value)]
+                    for value in values]
+            arrays['%s-keys' % col], arrays['%s-index' % col] = \
+                cls._sorted_lookup(keys, np.arange(start, end))
+
+        passthrough = []
+        if use_ents and not ohc_ents:
+            passthrough = list(fguide.entities)
+            for col in passthrough:
+                reverse_map = split.column_maps[col]
+                arrays['%s-keys' % col], arrays['%s-index' % col] = \
+                    cls._sorted_lookup(reverse_map.values(), reverse_map.keys())
+
+        # Real-valued features are imputed, then Z-score scaled.
+        reals = [name for name in fguide.real_valueds if name in positions]
+        means, scales = [], []
+        for col in reals:
+            scaler, scaled = split.scalers.get(col, (None, False))
+            if scaled:
+                scale = getattr(scaler, 'scale_', None)
+                if scale is None:  # scikit-learn < 0.17
+                    scale = scaler.std_
+                means.append(np.ravel(scaler.mean_)[0])
+                scales.append(np.ravel(scale)[0])
+            else:
+                means.append(0.0)
+                scales.append(1.0)
+
+        arrays['real-index'] = np.array(
+            [positions[col] for col in reals], dtype=np.float64)
+        arrays['real-fill'] = np.array(
+            [split.imputations.get(col, np.nan) for col in reals],
+            dtype=np.float64)
+        arrays['real-mean'] = np.array(means, dtype=np.float64)
+        arrays['real-scale'] = np.array(scales, dtype=np.float64)
+
+        dense = not use_ents and not preprocess_args.get('use_cats', True)
+        return cls(ohc, passthrough, reals, arrays, len(fmap), dense)
+
+    def save(self, savedir, ow=False):
+        """Save the lookup arrays and metadata to `savedir`."""
+        saveload.make_or_replace_dir(savedir, ow)
+        np.savez(os.path.join(savedir, self._arrays_fname), **self.arrays)
+        metadata = {
+            'ohc': self.ohc,
+            'passthrough': self.passthrough,
+            'reals': self.reals,
+            'nf': self.nf,
+            'dense': self.dense
+        }
+        with open(os.path.join(savedir, self._metadata_fname), 'w') as f:
+            json.dump(metadata, f)
+
+    @classmethod
+    def load(cls, savedir):
+        """Mirror function for `save`."""
+        with open(os.path.join(savedir, cls._metadata_fname)) as f:
+            metadata = json.load(f)
+
+        with np.load(os.path.join(savedir, cls._arrays_fname)) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+
+        return cls(metadata['ohc'], metadata['passthrough'], metadata['reals'],
+                   arrays, metadata['nf'], metadata['dense'])
+
+    def _lookup(self, col, values):
+        """Return (hit mask, looked up values) for raw `values` of `col`."""
+        keys = self.arrays['%s-keys' % col]
+        if not len(keys):
+            return np.zeros(len(values), dtype=bool), np.zeros(len(values))
+
+        pos = np.searchsorted(keys, values).clip(0, len(keys) - 1)
+        hit = keys[pos] == values
+        return hit, self.arrays['%s-index' % col][pos]
+
+    def transform(self, columns):
+        """Encode records into the feature space the model was trained on.
+
+        Args:
+            columns (dict): Map from column name to an array-like of values,
+                one per record. Must include every name in `columns`.
+        Return:
+            X (csr_matrix or ndarray): Encoded feature vectors.
+        """
+        values = {col: np.asarray(columns[col], dtype=np.float64)
+                  for col in self.columns}
+        n = len(values[self.columns[0]]) if self.columns else 0
+        rows = np.arange(n)
+
+        row_parts, col_parts, data_parts = [], [], []
+        for col in self.passthrough:
+            hit, mapped = self._lookup(col, values[col])
+            row_parts.append(rows[hit])
+            col_parts.append(np.repeat(self.passthrough.index(col), hit.sum()))
+            data_parts.append(mapped[hit])
+
+        for col in self.ohc:
+            hit, index = self._lookup(col, values[col])
+            row_parts.append(rows[hit])
+            col_parts.append(index[hit])
+            data_parts.append(np.ones(hit.sum()))
+
+        if self.reals:
+            reals = np.column_stack([values[col] for col in self.reals])
+            missing = np.isnan(reals)
+            reals[missing] = np.take(
+                self.arrays['real-fill'], np.nonzero(missing)[1])
+            reals = (reals - self.arrays['real-mean']) / \
+                self.arrays['real-scale']
+            if self.dense:
+                return reals
+
+            row_parts.append(np.repeat(rows, len(self.reals)))
+            col_parts.append(np.tile(self.arrays['real-index'], n))
+            data_parts.append(reals.ravel())
+
+        if not row_parts:
+            return sp.sparse.csr_matrix((n, self.nf))
+        return sp.sparse.csr_matrix(
+            (np.concatenate(data_parts),
+             (np.concatenate(row_parts),
+              np.concatenate(col_parts).astype(np.int64))),
+            shape=(n, self.nf))
+
+
+class PredictionService(object):
+    """A saved model and its feature encoder, loaded once for scoring."""
+
+    model_dirname = 'model'
+    encoder_dirname = 'encoder'
+
+    @classmethod
+    def export(cls, model, split, savedir, ow=False):
+        """Fit a copy of `model` on the training set of `split` and save it
+        along with the preprocessing state needed to encode new records.
+
+        Args:
+            model (Model): The model to fit and export.
+            split (PandasTrainTestSplit): The split to fit the model on.
+            savedir (str): Directory to export to.
+            ow (bool): Whether to overwrite the directory if it exists.
+        Return:
+            service (PredictionService): Service for the fitted model.
+        """
+        model = model.clone()
+        train_X, train_y, train_eids,\
+        test_X, test_y, test_eids, fmap, nents = \
+            split.preprocess(all_null='drop', **model.preprocess_args)
+
+        # Extraneous kwargs are filtered by the fit method.
+        model.fit(train_X, train_y, entity_ids=train_eids.values,
+                  feature_indices=fmap, n_entities=nents)
+        encoder = FeatureEncoder.from_split(split, fmap, model.preprocess_args)
+
+        saveload.make_or_replace_dir(savedir, ow)
+        model.save(os.path.join(savedir, cls.model_dirname))
+        encoder.save(os.path.join(savedir, cls.encoder_dirname))
+        return cls(model, encoder)
+
+    @classmethod
+    def load(cls, savedir):
+        """Load a service exported with `export`."""
+        model = Model.load(os.path.join(savedir, cls.model_dirname))
+        encoder = FeatureEncoder.load(
+            os.path.join(savedir, cls.encoder_dirname))
+        return cls(model, encoder)
+
+    def __init__(self, model, encoder):
+        self.model = model
+        self.encoder = encoder
+
+    def predict(self, columns):
+        """Predict the target for records given as a dict of columns."""
+        X = self.encoder.transform(columns)
+        return np.ravel(self.model.predict(X))
+
+
+class _Request(object):
+    """A batch of records waiting to be scored by the MicroBatcher."""
+
+    def __init__(self, columns, n):
+        self.columns = columns
+        self.n = n
+        self.done = threading.Event()
+        self.predicted = None
+        self.error = None
+
+
+class MicroBatcher(threading.Thread):
+    """Collect concurrent requests into batches scored with one predict call.
+
+    The first waiting request starts a batch. Further requests are added until
+    the batch holds `max_batch` records or `max_delay` seconds have passed.
+    """
+
+    def __init__(self, service, max_batch=512, max_delay=0.002):
+        threading.Thread.__init__(self, name='MicroBatcher')
+        self.daemon = True
+        self.service = service
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+
+    def submit(self, columns):
+        """Queue the records for scoring and block until they are scored."""
+        names = self.service.encoder.columns
+        columns = {col: np.asarray(columns[col], dtype=np.float64)
+                   for col in names}
+        n = len(columns[names[0]]) if names else 0
+        request = _Request(columns, n)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predicted
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        size = batch[0].n
+        deadline = time.time() + self.max_delay
+        while size < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += request.n
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                columns = {
+                    col: np.concatenate([req.columns[col] for req in batch])
+                    for col in self.service.encoder.columns}
+                predicted = self.service.predict(columns)
+                start = 0
+                for request in batch:
+                    request.predicted = predicted[start:start + request.n]
+                    start += request.n
+            except Exception as err:
+                logging.error('failed to score batch: %s' % err)
+                for request in batch:
+                    request.error = err
+            finally:
+                for request in batch:
+                    request.done.set()
+
+
+class PredictionHandler(httpserver.BaseHTTPRequestHandler):
+    """Score records POSTed as JSON to /predict.
+
+    The body is either {"records": [{column: value, ...}, ...]} or
+    {"columns": {column: [value, ...], ...}}. The response is
+    {"predicted": [value, ...]}, in request order.
+    """
+
+    def _reply(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/predict':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length))
+            if 'columns' in body:
+                columns = body['columns']
+            else:
+                columns = {col: [record.get(col, np.nan)
+                                 for record in body['records']]
+                           for col in self.server.batcher.service.encoder.columns}
+        except (ValueError, KeyError, TypeError) as err:
+            self._reply(400, {'error': 'bad request: %s' % err})
+            return
+
+        try:
+            predicted = self.server.batcher.submit(columns)
+        except Exception as err:
+            self._reply(500, {'error': str(err)})
+            return
+
+        self._reply(200, {'predicted': predicted.tolist()})
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class PredictionServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+    """Threaded HTTP server; each request thread waits on the MicroBatcher."""
+
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        httpserver.HTTPServer.__init__(self, address, PredictionHandler)
+        self.batcher = batcher
+
+
+def serve(savedir, host='127.0.0.1', port=8000, max_batch=512,
+          max_delay=0.002):
+    """Load the exported service in `savedir` and serve it until interrupted.
+    """
+    service = PredictionService.load(savedir)
+    batcher = MicroBatcher(service, max_batch, max_delay)
+    batcher.start()
+
+    server = PredictionServer((host, port), batcher)
+    logging.info('serving %s on %s:%d' % (savedir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Serve predictions from an exported model over HTTP')
+    parser.add_argument(
+        'savedir',
+        help='directory written by PredictionService.export')
+    parser.add_argument(
+        '--host', default='127.0.0.1')
+    parser.add_argument(
+        '-p', '--port',
+        type=int, default=8000)
+    parser.add_argument(
+        '-b', '--max-batch',
+        type=int, default=512,
+        help='max number of records scored in one batch')
+    parser.add_argument(
+        '-d', '--max-delay',
+        type=float, default=0.002,
+        help='max seconds to wait for a batch to fill')
+    parser.add_argument(
+        '-v', '--verbose',
+        type=int, default=1,
+        help='adjust verbosity of logging output')
+    return parser
+
+
+if __name__ == "__main__":
+    import cli
+    args = cli.parse_and_setup(make_parser())
+    serve(args.savedir, args.host, args.port, args.max_batch, args.max_delay)
@@ -0,0 +1,222 @@
+"""
+Hyperparameter sweeps (grid and random search) for a Model over all of the
+train/test splits produced by a splitter. Each split is preprocessed once and
+the resulting matrices are reused for every parameter setting.
+"""
+import os
+import logging
+import collections
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+try:
+    from sklearn.model_selection import ParameterGrid, ParameterSampler
+except ImportError:  # scikit-learn < 0.18
+    from sklearn.grid_search import ParameterGrid, ParameterSampler
+
+import naming
+from model import SklearnRegressionRunner
+
+
+# Preprocessed matrices for each split, keyed by split value. This is filled
+# in the parent before the worker pool is created, so forked workers inherit
+# the matrices instead of having them pickled along with every job.
+_SPLIT_DATA = {}
+
+
+def _fit_predict_preprocessed(job):
+    """Fit the job's model on a cached split and return its error summary.
+
+    Args:
+        job (tuple): (config_id, key, model), where `model` is an unfitted
+            Model with the parameters for this configuration already set.
+    Return:
+        outcome (tuple): (config_id, key, sse, sae, count), or
+            (config_id, key, None, None, 0) if fitting or prediction failed.
+    """
+    config_id, key, model = job
+    train_X, train_y, train_eids,\
+    test_X, test_y, test_eids, fmap, nents = _SPLIT_DATA[key]
+
+    # Extraneous kwargs are filtered by the fit/predict methods.
+    kwargs = {'entity_ids': train_eids.values,
+              'feature_indices': fmap,
+              'n_entities': nents}
+    try:
+        model.fit(train_X, train_y, **kwargs)
+        kwargs['entity_ids'] = test_eids.values
+        pred_y = model.predict(test_X, **kwargs)
+    except Exception as err:
+        logging.error('config {} failed on split {}: {}'.format(
+            config_id, key, err))
+        return (config_id, key, None, None, 0)
+
+    error = np.squeeze(pred_y) - test_y
+    return (config_id, key, (error ** 2).sum(), abs(error).sum(), len(error))
+
+
+def summarize_sweep(table):
+    """Aggregate a sweep table over splits, one row per configuration.
+
+    Args:
+        table (DataFrame): As returned by `SklearnRegressionSweep.sweep`.
+    Return:
+        summary (DataFrame): Overall RMSE and MAE for each configuration,
+            along with the number of splits evaluated, sorted by RMSE.
+    """
+    grouped = table.groupby('config')
+    sums = grouped[['sse', 'sae', 'count']].sum()
+    summary = pd.DataFrame({
+        'params': grouped['params'].first(),
+        'rmse': np.sqrt(sums['sse'] / sums['count']),
+        'mae': sums['sae'] / sums['count'],
+        'count': sums['count'],
+        'nsplits': grouped['split'].count()
+    })
+    return summary.sort('rmse')
+
+
+class SklearnRegressionSweep(SklearnRegressionRunner):
+    """Evaluate many parameter settings of a Model on all splits."""
+
+    def preprocess_all(self, errors='log'):
+        """Preprocess every split produced by the splitter exactly once.
+
+        Args:
+            errors (str): see `mldata.TrainTestSplitter.iteritems`.
+        Return:
+            splits (OrderedDict): Map from split value to the tuple returned by
+                `PandasTrainTestSplit.preprocess`, ordered by split value.
+        """
+        preprocess_args = self.model.preprocess_args
+        splits = {}
+        for key, split in self.splitter.iteritems(errors):
+            logging.info('preprocessing split {}'.format(key))
+            splits[key] = split.preprocess(all_null='drop', **preprocess_args)
+        return collections.OrderedDict(sorted(splits.items()))
+
+    def grid_search(self, param_grid, **kwargs):
+        """Sweep over all combinations in `param_grid`; see `sweep`."""
+        return self.sweep(ParameterGrid(param_grid), **kwargs)
+
+    def random_search(self, param_distributions, n_iter=10,
+                      random_state=None, **kwargs):
+        """Sweep over `n_iter` settings sampled from `param_distributions`;
+        see `sweep`.
+        """
+        candidates = ParameterSampler(
+            param_distributions, n_iter, random_state=random_state)
+        return self.sweep(candidates, **kwargs)
+
+    def _configure(self, params):
+        model = self.model.clone()
+        model.model.set_params(**params)
+        return model
+
+    def sweep(self, candidates, processes=None, abandon_after=None,
+              abandon_margin=0.1, outfile=None, errors='log'):
+        """Evaluate each parameter setting in `candidates` on every split.
+
+        Jobs are (params x split) pairs run on a pool of worker processes. If
+        `abandon_after` is given, the first `abandon_after` splits (in sorted
+        order) are run for all settings first. Any setting whose RMSE over
+        those splits exceeds the best by more than `abandon_margin` (relative)
+        is abandoned and not run on the remaining splits.
+
+        Args:
+            candidates (iterable of dict): Parameter settings for the inner
+                estimator, passed to its `set_params` method.
+            processes (int): Number of worker processes; defaults to the
+                number of CPUs.
+            abandon_after (int): Number of leading splits to run before
+                abandoning clearly worse settings. None disables abandonment.
+            abandon_margin (float): Relative RMSE margin over the best setting
+                beyond which a setting is abandoned.
+            outfile (str): If given, each result row is appended to this csv
+                file as soon as it arrives.
+            errors (str): see `mldata.TrainTestSplitter.iteritems`.
+        Return:
+            table (DataFrame): One row per (setting, split) evaluated, with
+                columns for each parameter, the split value, and the summed
+                squared/absolute errors, RMSE, MAE and test count.
+        """
+        candidates = list(candidates)
+        if not candidates:
+            raise ValueError('no parameter settings to sweep over')
+
+        models = [self._configure(params) for params in candidates]
+        names = [naming.suffix_from_params(params) for params in candidates]
+
+        global _SPLIT_DATA
+        _SPLIT_DATA = self.preprocess_all(errors)
+        keys = list(_SPLIT_DATA.keys())
+        if abandon_after is None or abandon_after >= len(keys):
+            waves = [keys]
+        else:
+            waves = [keys[:abandon_after], keys[abandon_after:]]
+
+        rows = []
+        write_header = outfile is not None and not os.path.exists(outfile)
+        pool = mp.Pool(processes)
+        try:
+            active = range(len(candidates))
+            for wave_num, wave in enumerate(waves):
+                jobs = [(config_id, key, models[config_id])
+                        for key in wave for config_id in active]
+                logging.info('running {} sweep jobs for splits {}'.format(
+                    len(jobs), ','.join(map(str, wave))))
+
+                for outcome in pool.imap_unordered(
+                        _fit_predict_preprocessed, jobs):
+                    config_id, key, sse, sae, count = outcome
+                    if not count:
+                        continue
+
+                    row = candidates[config_id].copy()
+                    row.update({
+                        'config': config_id,
+                        'params': names[config_id],
+                        'split': key,
+                        'sse': sse,
+                        'sae': sae,
+                        'count': count,
+                        'rmse': np.sqrt(sse / count),
+                        'mae': sae / count
+                    })
+                    rows.append(row)
+                    logging.info('config {} ({}) on split {}: rmse={:.4f}'\
+                                 .format(config_id, names[config_id], key,
+                                         row['rmse']))
+                    if outfile is not None:
+                        pd.DataFrame([row]).to_csv(
+                            outfile, mode='a', index=False,
+                            header=write_header)
+                        write_header = False
+
+                if not rows:
+                    logging.error('no successful results in first wave')
+                    break
+                if wave_num == 0 and len(waves) > 1:
+                    active = self._survivors(rows, active, abandon_margin)
+        finally:
+            pool.close()
+            pool.join()
+            _SPLIT_DATA = {}
+
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def _survivors(rows, active, margin):
+        """Return the configs in `active` whose RMSE so far is within `margin`
+        of the best; configs with no successful results are dropped.
+        """
+        summary = summarize_sweep(pd.DataFrame(rows))
+        threshold = summary['rmse'].min() * (1 + margin)
+        keep = set(summary.index[summary['rmse'] <= threshold])
+        abandoned = [config_id for config_id in active if config_id not in keep]
+        if abandoned:
+            logging.info('abandoning configs: {}'.format(
+                ','.join(map(str, abandoned))))
+        return [config_id for config_id in active if config_id in keep]
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from fm import FactorizationMachine
+from mldata import FeatureMap
+
+
+def make_onehot_data(n_rows=200, seed=0):
+    """Two one-hot encoded attributes (6 and 4 values) and two real-valued
+    features, with random targets.
+
+    Return:
+        X (sp.sparse.csr_matrix): Feature vectors.
+        y (np.ndarray): Targets.
+        fmap (FeatureMap): Feature map of X with the one-hot ranges.
+    """
+    rng = np.random.RandomState(seed)
+    widths = (6, 4)
+    blocks = []
+    for width in widths:
+        codes = rng.randint(0, width, n_rows)
+        blocks.append(sp.sparse.csr_matrix(
+            (np.ones(n_rows), (np.arange(n_rows), codes)),
+            shape=(n_rows, width)))
+    reals = rng.normal(size=(n_rows, 2))
+    X = sp.sparse.hstack(blocks + [reals]).tocsr()
+    y = rng.normal(size=n_rows)
+
+    names = (['a-%d' % j for j in range(6)] + ['b-%d' % j for j in range(4)] +
+             ['r1', 'r2'])
+    fmap = FeatureMap(names, [(0, 6), (6, 10)])
+    return X, y, fmap
+
+
+class TestGroupedUpdates(unittest.TestCase):
+    """Updating the columns of a one-hot attribute together must give the
+    same fit as updating every column on its own.
+    """
+
+    def setUp(self):
+        self.X, self.y, self.fmap = make_onehot_data()
+
+    def fit_als(self, feature_indices):
+        fm = FactorizationMachine('als', n_iter=5, rank=3, reg1=0.1,
+                                  reg2=0.1, random_state=0)
+        return fm.fit(self.X, self.y, feature_indices=feature_indices)
+
+    def test_als_grouped_matches_single_columns(self):
+        grouped = self.fit_als(self.fmap)
+        single = self.fit_als(None)
+
+        np.testing.assert_allclose(grouped.w0_, single.w0_)
+        np.testing.assert_allclose(grouped.w_, single.w_)
+        np.testing.assert_allclose(grouped.V_, single.V_)
+        np.testing.assert_allclose(grouped.predict(self.X),
+                                   single.predict(self.X))
+
+
+if __name__ == "__main__":
+    unittest.main()
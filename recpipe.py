@@ -1,5 +1,9 @@
 import os
 import csv
+import shutil
+import logging
+import collections
+import multiprocessing as mp
 import subprocess as sub
 
 import luigi
@@ -21,35 +25,264 @@ class LuigiDataFile(luigi.ExternalTask):
 
 
 class BasicLuigiTask(luigi.Task):
-    """Uses class name as output file."""
-    ext = 'csv'
+    """Uses class name as output file. Outputs are binary FrameTargets, which
+    downstream tasks read without any text parsing.
+    """
+    ext = 'npz'
     def output(self):
         fname = fname_from_cname(self.__class__.__name__)
-        return luigi.LocalTarget(os.path.join(
+        return FrameTarget(os.path.join(
             'data', '%s.%s' % (fname, self.ext)))
 
 
-class BuildIdMap(BasicLuigiTask):
-    """Produce a contiguous id mapping for all ids."""
-    ids = []
+class IdMap(object):
+    """Contiguous id mapping for the distinct values of one or more columns.
+
+    Each column is factorized against its levels (its distinct non-null
+    values) and the level codes of each id's key are stored in id order. For
+    lookups, the column codes (with null as the code after the last level)
+    are combined into one integer per row using a mixed radix and matched
+    against the sorted composite codes of the known keys, so mapping a table
+    is a few `searchsorted` calls.
+
+    Maps built with `from_frame` assign ids in sorted order of the keys, with
+    nulls sorting last. Keys added later with `extend` get new ids after the
+    existing ones, so ids already assigned never change.
+    """
+
+    def __init__(self, cols, levels, entries):
+        """
+        Args:
+            cols (list of str): Names of the columns the ids are built from.
+            levels (list of np.ndarray): Distinct non-null values of each
+                column; the code of a value is its position.
+            entries (np.ndarray): (# ids x # cols) level codes of the key for
+                each id, with -1 for null values.
+        """
+        self.cols = list(cols)
+        self.levels = levels
+        self.entries = entries.reshape(-1, len(self.cols))
+        self._index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _index(self):
+        """Build the sorted lookup structures from levels and entries."""
+        self._level_order = [np.argsort(levels, kind='mergesort')
+                             for levels in self.levels]
+        codes = self._combine(self.entries)
+        self._id_order = np.argsort(codes, kind='mergesort')
+        self._codes = codes[self._id_order]
+
+    @staticmethod
+    def _keys(values, numeric):
+        """Convert values to the type they are compared as."""
+        return values.astype(np.float64 if numeric else str)
+
+    def _combine(self, level_codes):
+        """Combine per-column level codes into one composite code per row;
+        rows with an unknown value (-2) get -1.
+        """
+        codes = np.zeros(len(level_codes), dtype=np.int64)
+        for j, levels in enumerate(self.levels):
+            col_codes = level_codes[:, j].copy()
+            col_codes[col_codes == -1] = len(levels)  # nulls sort last
+            codes = codes * (len(levels) + 1) + col_codes
+        codes[(level_codes == -2).any(axis=1)] = -1
+        return codes
+
+    def level_codes(self, columns):
+        """Return the (# rows x # cols) level codes of the given values, with
+        -1 for nulls and -2 for values not among the levels.
+
+        Args:
+            columns (list of array-like): One array of values per column, in
+                the same order as `cols`.
+        """
+        nrows = len(columns[0])
+        codes = np.empty((nrows, len(self.cols)), dtype=np.int64)
+        for j, (values, levels) in enumerate(zip(columns, self.levels)):
+            values = np.asarray(values)
+            present = ~pd.isnull(values)
+            col_codes = np.empty(nrows, dtype=np.int64)
+            col_codes.fill(-1)
+
+            if len(levels):
+                order = self._level_order[j]
+                sorted_levels = levels[order]
+                keys = self._keys(values[present], levels.dtype.kind == 'f')
+                pos = np.searchsorted(sorted_levels, keys)\
+                        .clip(0, len(levels) - 1)
+                found = sorted_levels[pos] == keys
+                col_codes[present] = np.where(found, order[pos], -2)
+            else:
+                col_codes[present] = -2
+
+            codes[:, j] = col_codes
+        return codes
+
+    @classmethod
+    def from_frame(cls, df, cols):
+        """Build the id mapping for the distinct rows of `df[cols]`."""
+        levels = []
+        for colname in cols:
+            values = df[colname].values
+            present = values[~pd.isnull(values)]
+            numeric = values.dtype.kind in 'biuf'
+            levels.append(np.unique(cls._keys(present, numeric)))
+
+        idmap = cls(cols, levels, np.empty((0, len(cols)), dtype=np.int64))
+        level_codes = idmap.level_codes([df[col].values for col in cols])
+        codes, first = np.unique(
+            idmap._combine(level_codes), return_index=True)
+        return cls(cols, levels, level_codes[first])
+
+    def extend(self, columns):
+        """Add keys not yet in the map, giving them new ids after the existing
+        ones (in sorted order among themselves).
+
+        Args:
+            columns (list of array-like): see `level_codes`.
+        Return:
+            n_new (int): Number of ids added.
+        """
+        levels = list(self.levels)
+        for j, values in enumerate(columns):
+            values = np.asarray(values)
+            values = values[~pd.isnull(values)]
+            numeric = (levels[j].dtype.kind == 'f' if len(levels[j]) else
+                       values.dtype.kind in 'biuf')
+            keys = np.unique(self._keys(values, numeric))
+            new = keys[~np.in1d(keys, levels[j])]
+            if len(new):
+                levels[j] = np.concatenate((levels[j], new))
+
+        extended = self.__class__(self.cols, levels, self.entries)
+        level_codes = extended.level_codes(columns)
+        unknown = np.isnan(extended.lookup(columns))
+        codes, first = np.unique(
+            extended._combine(level_codes[unknown]), return_index=True)
+
+        self.levels = levels
+        self.entries = np.concatenate(
+            (self.entries, level_codes[unknown][first]))
+        self._index()
+        return len(first)
+
+    def lookup(self, columns):
+        """Return the id for each row as a float array, NaN where the values
+        are not in the mapping.
+
+        Args:
+            columns (list of array-like): see `level_codes`.
+        """
+        codes = self._combine(self.level_codes(columns))
+        ids = np.empty(len(codes))
+        ids.fill(np.nan)
+        if len(self):
+            pos = np.searchsorted(self._codes, codes).clip(0, len(self) - 1)
+            found = (codes >= 0) & (self._codes[pos] == codes)
+            ids[found] = self._id_order[pos[found]]
+        return ids
+
+    def to_arrays(self, name):
+        """Return the arrays describing the map, keyed by `name`."""
+        arrays = {'%s__cols' % name: np.array(self.cols),
+                  '%s__entries' % name: self.entries}
+        for i, levels in enumerate(self.levels):
+            arrays['%s__levels__%d' % (name, i)] = levels
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        """Mirror function for `to_arrays`."""
+        cols = list(arrays['%s__cols' % name])
+        levels = [arrays['%s__levels__%d' % (name, i)]
+                  for i in range(len(cols))]
+        return cls(cols, levels, arrays['%s__entries' % name])
+
+
+class DimensionIndex(object):
+    """A dimension table indexed on its key columns for positional joins.
+
+    The keys are mapped to contiguous ids with an IdMap, and the row of the
+    table holding each key is stored by id. Joining a fact table is then a key
+    lookup followed by a `take` of each dimension column, with no copy of the
+    fact table and no hash join. Keys are assumed to be unique in the table;
+    if they are not, the first row with each key is used (a merge would
+    instead duplicate the fact rows).
+    """
+
+    def __init__(self, table, keys):
+        """
+        Args:
+            table (pd.DataFrame): The dimension table.
+            keys (list of str): Columns the table is joined on.
+        """
+        self.table = table
+        self.keys = list(keys)
+        self.idmap = IdMap.from_frame(table, self.keys)
+        ids = self.idmap.lookup([table[key].values for key in self.keys])
+        _, self.rows = np.unique(ids.astype(np.int64), return_index=True)
+
+    def join(self, fact, suffixes=('_x', '_y')):
+        """Left join the non-key columns of the table onto `fact`, in place.
+        Columns present in both are suffixed as `DataFrame.merge` does.
+        """
+        ids = self.idmap.lookup([fact[key].values for key in self.keys])
+        found = ~np.isnan(ids)
+        rows = self.rows[ids[found].astype(np.int64)]
+
+        for colname in self.table.columns:
+            if colname in self.keys:
+                continue
+
+            values = self.table[colname].values
+            if found.all():
+                joined = values.take(rows)
+            else:
+                kind = values.dtype.kind
+                dtype = (np.float64 if kind in 'iuf' else object)
+                joined = np.empty(len(fact), dtype=dtype)
+                joined.fill(np.nan)
+                joined[found] = values.take(rows)
+
+            if colname in fact:
+                fact.rename(columns={colname: colname + suffixes[0]},
+                            inplace=True)
+                colname += suffixes[1]
+            fact[colname] = joined
+        return fact
+
+
+class BuildIdMaps(BasicLuigiTask):
+    """Produce contiguous id mappings for all ids drawn from one source file.
+    The source is read once and all maps are stored in a single npz archive.
+    """
+    source = None  # name of the data source the maps are built from
+    maps = {}  # map from attribute name to columns the ids are built from
 
     def run(self):
+        usecols = sorted(set(sum(self.maps.values(), [])))
         with self.input().open() as f:
-            data = pd.read_csv(f)
-
-        # prevent ids from being written as floats when we have nan values.
-        isfloat = \
-            [data[colname].apply(lambda val: isinstance(val, np.float)).any()
-             for colname in self.ids]
-        have_floats = np.array(isfloat).any()
-        float_fmt = '%.6f' if have_floats else '%.0f'
-
-        # Map sorted values to contiguous numerical indices.
-        idmap = data[self.ids].sort(self.ids)\
-                              .drop_duplicates()\
-                              .reset_index()[self.ids]
-        with self.output().open('w') as out:
-            idmap.to_csv(out, index_label='index', float_format=float_fmt)
+            data = pd.read_csv(f, usecols=usecols)
+
+        self.write_maps({attr: IdMap.from_frame(data, cols)
+                         for attr, cols in self.maps.items()})
+
+    def write_maps(self, idmaps):
+        """Write the id maps (keyed by attribute) to the output archive."""
+        arrays = {}
+        for attr, idmap in idmaps.items():
+            arrays.update(idmap.to_arrays(attr))
+        savez_atomic(self.output().path, arrays)
+
+    def read_maps(self):
+        """Load all id maps from the output archive, keyed by attribute."""
+        with np.load(self.output().path) as arrays:
+            return {attr: IdMap.from_arrays(arrays, attr)
+                    for attr in self.maps}
 
 
 # All external data files.
@@ -97,20 +330,23 @@ IDMAPS = {
     'degrees': {}
 }
 
-# Build id-mapping tasks at global scope.
+# Build id-mapping tasks at global scope, one for each data source.
+# IDMAP_TASKS maps each attribute name to the task that builds its id map.
 IDMAP_TASKS = {}
 for src_name, mapdict in IDMAPS.items():
+    if not mapdict:
+        continue
+
     data_task = DATA_TASKS[src_name]
     base_name = '%s%s' % (src_name[0].upper(), src_name[1:])
-    for attr, cols in mapdict.items():
-        instance = data_task()
-        # print src_name, attr, ','.join(cols), data_task, instance.output().path
-        class_name = '%s%s%sMap' % (base_name, attr[0].upper(), attr[1:])
-        globals()[class_name] = type(
-            class_name, (BuildIdMap,),
-            {'ids': cols,
-             'reqtask': data_task,
-             'requires': lambda self: self.reqtask()})
+    class_name = '%sIdMaps' % base_name
+    globals()[class_name] = type(
+        class_name, (BuildIdMaps,),
+        {'maps': mapdict,
+         'source': src_name,
+         'reqtask': data_task,
+         'requires': lambda self: self.reqtask()})
+    for attr in mapdict:
         IDMAP_TASKS[attr] = globals()[class_name]
 
 
@@ -145,72 +381,323 @@ grade2pts = {
 }
 
 
-def use_idmap(df, idmap, newname, oldcols, remove=False):
-    """Use the given idmap to create a column with `newname` in the `df` by
-    merging on `oldcols`.
+def map_ids(df, idmaps, attributes):
+    """Map the set-categorical values in the df to numerical indices. Adds a
+    new column to the DataFrame for each attribute and returns the frame.
+    Optionally removes the columns used to produce the mappings.
+
+    Args:
+        df (pd.DataFrame): Data to map; modified in place.
+        idmaps (dict): Map from attribute name to its IdMap.
+        attributes (dict): Map from attribute name (the name of the new column)
+            to a flag indicating whether the columns the ids are built from
+            should be removed afterwards.
     """
-    tmpname = '_new_%s' % newname
-    idmap[tmpname] = idmap.index
-    df = df.merge(idmap, how='left', left_on=newname, right_on=oldcols)
-    df[newname] = df[tmpname]
-    del df[tmpname]
-    if remove:
-        for colname in oldcols:
-            del df[colname]
+    # Look up all ids before removing anything, since maps may share columns.
+    for idname in attributes:
+        idmap = idmaps[idname]
+        df[idname] = idmap.lookup([df[colname].values
+                                   for colname in idmap.cols])
+
+    # Remove columns used to create mapping, if requeseted.
+    for idname, remove in attributes.items():
+        if remove:
+            for colname in idmaps[idname].cols:
+                if colname in df:
+                    del df[colname]
+
     return df
 
 
-def map_ids(df, idname, remove=False):
-    """Map the set-categorical values in the df to numerical indices. Adds a new
-    column to the DataFrame and returns the new frame. Optionally removes the
-    columns used to produce the mapping. `idname` is the name of the new column
-    which will contain the mapped values. This should be present in IDMAPS.
+def extract_clevel(cnums):
+    """Extract the course level (first digit) from a Series of course numbers.
+    Course numbers without any digits have a NaN course level.
+    """
+    levels = cnums.astype(str).str.extract(r'(\d)')
+    if isinstance(levels, pd.DataFrame):  # newer pandas always expand
+        levels = levels[0]
+    return levels.astype(float)
+
+
+class TermGroups(object):
+    """Rows of a table grouped by (entity, term), for per-term aggregates and
+    their running totals over each entity's terms.
+
+    The rows are sorted once by (entity, term); each (entity, term) group is
+    then a contiguous segment of the sort order. Aggregates are computed per
+    group with segment reductions, giving compact arrays ordered by (entity,
+    term). Running totals and previous-term values are computed on those
+    arrays and `scatter` maps them back to the rows by position. Rows with a
+    null entity or term belong to no group and get NaN values.
     """
-    # Lookup id-mapping class in global table.
-    klass = IDMAP_TASKS[idname]
-    task = klass()
 
-    # Shouldn't really need this here.
-    if not task.complete():
-        task.run()
+    def __init__(self, entities, terms):
+        """
+        Args:
+            entities (array-like): Entity id of each row.
+            terms (array-like): Term number of each row.
+        """
+        entities = np.asarray(entities, dtype=np.float64)
+        terms = np.asarray(terms, dtype=np.float64)
+        self.nrows = len(entities)
+
+        rows = np.nonzero(~(np.isnan(entities) | np.isnan(terms)))[0]
+        self.order = rows[np.lexsort((terms[rows], entities[rows]))]
+        sorted_ents = entities[self.order]
+        sorted_terms = terms[self.order]
+
+        # Segment starts of each group in the sort order.
+        new_group = np.ones(len(self.order), dtype=bool)
+        new_group[1:] = ((sorted_ents[1:] != sorted_ents[:-1]) |
+                         (sorted_terms[1:] != sorted_terms[:-1]))
+        self.starts = np.nonzero(new_group)[0]
+        self.group_of_row = np.cumsum(new_group) - 1
+
+        # Group index of each entity's first term.
+        self.entities = sorted_ents[self.starts]
+        new_entity = np.ones(len(self.starts), dtype=bool)
+        new_entity[1:] = self.entities[1:] != self.entities[:-1]
+        self.entity_starts = np.nonzero(new_entity)[0]
+        self.entity_of_group = np.cumsum(new_entity) - 1
 
-    # Load idmap from file.
-    with task.output().open() as f:
-        idmap = pd.read_csv(f, index_col=0)
+    @property
+    def ngroups(self):
+        return len(self.starts)
 
-    # Create tmp column to store new column.
-    tmpname = '_new_%s' % idname
-    idmap[tmpname] = idmap.index
+    @property
+    def last_groups(self):
+        """Group index of each entity's last term."""
+        return np.append(self.entity_starts[1:], self.ngroups) - 1
+
+    def sum(self, values):
+        """Sum `values` (one per row) within each group, skipping nulls."""
+        if not self.ngroups:
+            return np.array([], dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)[self.order]
+        values[np.isnan(values)] = 0
+        return np.add.reduceat(values, self.starts)
+
+    def count(self):
+        """Number of rows in each group."""
+        return np.diff(np.append(self.starts, len(self.order)))
+
+    def cumsum(self, group_values):
+        """Running total of `group_values` over each entity's terms, including
+        the current term.
+        """
+        totals = np.cumsum(group_values)
+        before = np.zeros(len(self.entity_starts))
+        before[1:] = totals[self.entity_starts[1:] - 1]
+        return totals - before[self.entity_of_group]
+
+    def shift(self, group_values):
+        """Value from each entity's previous term; NaN for its first term."""
+        shifted = np.empty(self.ngroups)
+        shifted[1:] = group_values[:-1]
+        shifted[self.entity_starts] = np.nan
+        return shifted
+
+    def rank(self):
+        """1-based number of each term among the entity's terms."""
+        return (np.arange(self.ngroups) -
+                self.entity_starts[self.entity_of_group] + 1)
+
+    def scatter(self, group_values):
+        """Map per-group values back to the rows, in original row order."""
+        values = np.empty(self.nrows)
+        values.fill(np.nan)
+        values[self.order] = np.asarray(group_values)[self.group_of_row]
+        return values
+
+
+class FeatureState(object):
+    """Running per-student and per-course accumulators for the engineered
+    features, as of each entity's last term in the preprocessed data. This is
+    enough to compute the features for the records of a later term without
+    revisiting earlier terms.
+
+    Each field is an array indexed by the contiguous sid (or cid), holding
+    NaN for entities without any records.
+    """
 
-    # Ensure data types match up after merge.
-    for colname in klass.ids:
-        dtype = df[colname].dtype.type
-        idmap[colname] = idmap[colname].values.astype(dtype)
+    student_fields = ['termnum', 'total_qpts', 'total_chrs', 'term_gpa',
+                      'term_chrs', 'cum_gpa', 'sterm']
+    course_fields = ['termnum', 'num_enrolled', 'total_enrolled',
+                     'total_grdpts_sum', 'term_cgpa', 'cum_cgpa']
 
-    # Move values from tmp column to `idname` column and delete tmp.
-    df = df.merge(idmap, how='left', on=klass.ids)
-    df[idname] = df[tmpname]
-    del df[tmpname]
+    def __init__(self, students, courses):
+        """
+        Args:
+            students (dict): Map from each of `student_fields` to its array.
+            courses (dict): Map from each of `course_fields` to its array.
+        """
+        self.students = students
+        self.courses = courses
 
-    # Remove columns used to create mapping, if requeseted.
-    if remove:
-        for colname in klass.ids:
-            del df[colname]
+    @property
+    def last_termnum(self):
+        termnums = np.concatenate(
+            (self.students['termnum'], self.courses['termnum']))
+        termnums = termnums[~np.isnan(termnums)]
+        return termnums.max() if len(termnums) else -np.inf
+
+    @staticmethod
+    def _last_values(data, entity, fields):
+        """Values of `fields` at each entity's last term, indexed by id."""
+        groups = TermGroups(data[entity].values, data['termnum'].values)
+        rows = groups.order[groups.starts[groups.last_groups]]
+        ids = groups.entities[groups.last_groups].astype(np.int64)
+
+        state = {}
+        for field in fields:
+            values = np.empty(ids.max() + 1 if len(ids) else 0)
+            values.fill(np.nan)
+            values[ids] = data[field].values[rows]
+            state[field] = values
+        return state
+
+    @classmethod
+    def from_frame(cls, data):
+        """Extract the state from data with engineered features (the output
+        of `PreprocessedData.engineer_features`).
+        """
+        return cls(cls._last_values(data, 'sid', cls.student_fields),
+                   cls._last_values(data, 'cid', cls.course_fields))
+
+    def save(self, path):
+        """Save the state to an npz archive, atomically."""
+        arrays = {}
+        for prefix, state in (('students', self.students),
+                              ('courses', self.courses)):
+            for field, values in state.items():
+                arrays['%s__%s' % (prefix, field)] = values
+        savez_atomic(path, arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Mirror function for `save`."""
+        with np.load(path) as arrays:
+            students = {field: arrays['students__%s' % field]
+                        for field in cls.student_fields}
+            courses = {field: arrays['courses__%s' % field]
+                       for field in cls.course_fields}
+        return cls(students, courses)
+
+    @staticmethod
+    def _grow(state, ids):
+        """Extend the arrays in `state` so they can be indexed by `ids`."""
+        size = ids.max() + 1 if len(ids) else 0
+        for field, values in state.items():
+            if len(values) < size:
+                grown = np.empty(size)
+                grown.fill(np.nan)
+                grown[:len(values)] = values
+                state[field] = grown
+
+    def _append_students(self, data):
+        """Student features for the records of one term; updates the state.
+        """
+        groups = TermGroups(data['sid'].values, data['termnum'].values)
+        sids = groups.entities.astype(np.int64)
+        state = self.students
+        self._grow(state, sids)
+
+        term_qpts = groups.sum(data['qpts'].values)
+        term_chrs = groups.sum(data['chrs'].values)
+        total_qpts = np.nan_to_num(state['total_qpts'][sids]) + term_qpts
+        total_chrs = np.nan_to_num(state['total_chrs'][sids]) + term_chrs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term_gpa = term_qpts / term_chrs
+            cum_gpa = total_qpts / total_chrs
+
+        features = {
+            'term_qpts': term_qpts,
+            'total_qpts': total_qpts,
+            'term_chrs': term_chrs,
+            'total_chrs': total_chrs,
+            'term_gpa': term_gpa,
+            'cum_gpa': cum_gpa,
+            'lterm_gpa': state['term_gpa'][sids],
+            'lterm_chrs': state['term_chrs'][sids],
+            'lterm_cum_gpa': state['cum_gpa'][sids],
+            'lterm_total_chrs': state['total_chrs'][sids],
+            'sterm': np.nan_to_num(state['sterm'][sids]) + 1
+        }
 
-    return df
+        for field in self.student_fields[1:]:
+            state[field][sids] = features[field]
+        state['termnum'][sids] = data['termnum'].values[groups.order[
+            groups.starts]]
+        return {name: groups.scatter(values)
+                for name, values in features.items()}
+
+    def _append_courses(self, data):
+        """Course features for the records of one term; updates the state."""
+        groups = TermGroups(data['cid'].values, data['termnum'].values)
+        cids = groups.entities.astype(np.int64)
+        state = self.courses
+        self._grow(state, cids)
+
+        num_enrolled = groups.count().astype(np.float64)
+        total_enrolled = \
+            np.nan_to_num(state['total_enrolled'][cids]) + num_enrolled
+        term_grdpts_sum = groups.sum(data['grdpts'].values)
+        total_grdpts_sum = \
+            np.nan_to_num(state['total_grdpts_sum'][cids]) + term_grdpts_sum
+
+        features = {
+            'num_enrolled': num_enrolled,
+            'total_enrolled': total_enrolled,
+            'term_grdpts_sum': term_grdpts_sum,
+            'total_grdpts_sum': total_grdpts_sum,
+            'term_cgpa': term_grdpts_sum / num_enrolled,
+            'cum_cgpa': total_grdpts_sum / total_enrolled,
+            'lterm_cgpa': state['term_cgpa'][cids],
+            'lterm_cum_cgpa': state['cum_cgpa'][cids],
+            'lterm_num_enrolled': state['num_enrolled'][cids],
+            'lterm_total_enrolled': state['total_enrolled'][cids]
+        }
 
+        for field in self.course_fields[1:]:
+            state[field][cids] = features[field]
+        state['termnum'][cids] = data['termnum'].values[groups.order[
+            groups.starts]]
+        return {name: groups.scatter(values)
+                for name, values in features.items()}
+
+    def append(self, data):
+        """Compute the engineered features for records of terms after the last
+        term in the state, one term at a time, updating the state as it goes.
+
+        Args:
+            data (pd.DataFrame): Cleaned records, as produced by
+                `PreprocessedData.assemble`; modified in place.
+        Raises:
+            ValueError: if any record is from a term at or before the last
+                term in the state.
+        Return:
+            data (pd.DataFrame): The records with the engineered features.
+        """
+        termnums = data['termnum'].values
+        terms = np.unique(termnums[~np.isnan(termnums)])
+        if len(terms) and terms[0] <= self.last_termnum:
+            raise ValueError(
+                'term %d is not after the last term in the state (%d)' % (
+                    terms[0], self.last_termnum))
 
-def extract_clevel(cnum):
-    """Extract the course level from the course number."""
-    if cnum == np.nan:
-        return np.nan
-    cnum = str(cnum).strip()
-    if not cnum:
-        return np.nan
-    digits = filter(lambda c: c.isdigit(), cnum)
-    if not digits:
-        return np.nan
-    return digits[0]
+        data['qpts'] = data['chrs'] * data['grdpts']
+        features = collections.defaultdict(
+            lambda: np.repeat(np.nan, len(data)))
+        for term in terms:
+            rows = np.nonzero(termnums == term)[0]
+            term_data = data.iloc[rows]
+            for appender in (self._append_students, self._append_courses):
+                for name, values in appender(term_data).items():
+                    features[name][rows] = values
+
+        for name, values in features.items():
+            data[name] = values
+        return data
 
 
 class PreprocessedData(BasicLuigiTask):
@@ -235,7 +722,7 @@ class PreprocessedData(BasicLuigiTask):
     # Finally, create dict of all data source tasks and attribute mapping tasks
     # to be required by this task.
     data_tasks = {src_name: task() for src_name, task in DATA_TASKS.items()}
-    idmap_classes = [IDMAP_TASKS[attr] for attr in cvals]
+    idmap_classes = set(IDMAP_TASKS[attr] for attr in cvals)
     idmap_tasks = {klass.__name__: klass() for klass in idmap_classes}
 
     cvals += ['cohort', 'sterm']
@@ -249,60 +736,140 @@ class PreprocessedData(BasicLuigiTask):
     def grade2pts(self):
         return grade2pts
 
-    def fill_grdpts(self, series):
-        """Fill in missing values for grade quality points."""
+    def fill_grdpts(self, courses):
+        """Fill in grade quality points by mapping GRADE through `grade2pts`.
+        Where GRADE is missing or not in the map, keep the existing grdpts.
+
+        Return:
+            grdpts (np.ndarray): Quality points, one per row of `courses`.
+        """
         # TODO: we can fill in missing lab grades with lecture grades if we can
         # match them up.
-        if series['GRADE'] != np.nan:
-            return self.grade2pts[series['GRADE']]
-        else:
-            return series['grdpts']
+        grades = courses['GRADE'].astype('category')
+        categories = grades.cat.categories
+        known = np.array([grade in self.grade2pts for grade in categories])
+        pts = np.array([self.grade2pts.get(grade, np.nan)
+                        for grade in categories], dtype=np.float64)
+
+        codes = grades.cat.codes.values
+        use_map = codes >= 0  # code -1 means GRADE is null
+        use_map[use_map] = known[codes[use_map]]
+
+        grdpts = courses['grdpts'].values.astype(np.float64)
+        grdpts[use_map] = pts[codes[use_map]]
+        return grdpts
+
+    # Columns to read from each data source; None reads all columns.
+    source_cols = {
+        'courses': ['id', 'TERMBNR', 'DISC', 'CNUM', 'GRADE', 'HRS',
+                    'grdpts', 'INSTR_LNAME', 'INSTR_FNAME', 'class',
+                    'instr_rank', 'instr_tenure'],
+        'students': ['id', 'cohort', 'TERMBNR', 'PMAJR', 'term_earn_hrs'],
+        'demographics': None,
+        'admissions': ['id', 'cohort', 'Permanent_Address_ZIP', 'HSGPA',
+                       'SAT_Total_1600', 'HS_CEEB_Code']
+    }
 
-    def run(self):
-        courses_cols = ['id', 'TERMBNR', 'DISC', 'CNUM', 'GRADE', 'HRS',
-                        'grdpts', 'INSTR_LNAME', 'INSTR_FNAME', 'class',
-                        'instr_rank', 'instr_tenure']
-        with self.input()['courses'].open() as f:
-            courses = pd.read_csv(f, usecols=courses_cols)
+    # Dimension sources and the keys courses records are joined to them on,
+    # in join order (admissions is joined on the cohort from students).
+    dimensions = [
+        ('students', ['id', 'TERMBNR']),
+        ('demographics', ['id']),
+        ('admissions', ['id', 'cohort'])
+    ]
 
-        # fill in missing values for quality points
-        courses.grdpts = courses.apply(self.fill_grdpts, axis=1)
+    # Number of courses records joined and cleaned at a time.
+    chunksize = 200000
 
-        # Get course level from CNUM.
-        courses['clevel'] = courses['CNUM'].apply(extract_clevel)
+    @property
+    def state_path(self):
+        """Path of the FeatureState saved alongside the output."""
+        base, ext = os.path.splitext(self.output().path)
+        return '%s-state.npz' % base
+
+    def max_termnum(self, default=MAX_NUM_COHORTS):
+        """Last term in the data, read from its saved FeatureState, or
+        `default` if the data has not been produced yet.
+        """
+        if not os.path.exists(self.state_path):
+            return default
+        last = FeatureState.load(self.state_path).last_termnum
+        return int(last) if np.isfinite(last) else default
+
+    def read_sources(self, targets, chunksize=None):
+        """Read the data sources used from the given targets.
+
+        Args:
+            targets (dict): Map from data source name to its luigi target.
+            chunksize (int): If given, the courses source is returned as an
+                iterator of DataFrames of this many records each.
+        Return:
+            sources (dict): Map from data source name to its DataFrame.
+        """
+        sources = {}
+        for src_name, usecols in self.source_cols.items():
+            if src_name == 'courses' and chunksize:
+                sources[src_name] = pd.read_csv(
+                    targets[src_name].path, usecols=usecols,
+                    chunksize=chunksize)
+            else:
+                with targets[src_name].open() as f:
+                    sources[src_name] = pd.read_csv(f, usecols=usecols)
+        return sources
 
-        # add student data first.
-        students_cols = ['id', 'cohort', 'TERMBNR', 'PMAJR', 'term_earn_hrs']
-        with self.input()['students'].open() as f:
-            students = pd.read_csv(f, usecols=students_cols)
+    def read_idmaps(self):
+        """Load the id maps for all attributes, keyed by attribute."""
+        idmaps = {}
+        for task in self.idmap_tasks.values():
+            idmaps.update(task.read_maps())
+        return idmaps
 
-        data = courses.merge(students, how='left', on=('id', 'TERMBNR'))
+    def assemble(self, sources, idmaps):
+        """Join the data sources into one cleaned table of enrollment records
+        with contiguous ids, ready for feature engineering.
 
-        # add demographics data next
-        with self.input()['demographics'].open() as f:
-            demog = pd.read_csv(f)
+        The dimension sources are indexed once and the courses records are
+        joined and cleaned a chunk at a time, so peak memory stays close to
+        the size of the output.
 
-        data = data.merge(demog, how='left', on='id')
+        Args:
+            sources (dict): DataFrames returned by `read_sources`.
+            idmaps (dict): Map from attribute name to its IdMap.
+        """
+        dims = [DimensionIndex(sources[src_name], keys)
+                for src_name, keys in self.dimensions]
 
-        # add admissions data to data frame
-        admiss_cols = ['id', 'cohort', 'Permanent_Address_ZIP', 'HSGPA',
-                       'SAT_Total_1600', 'HS_CEEB_Code']
-        with self.input()['admissions'].open() as f:
-            admiss = pd.read_csv(f, usecols=admiss_cols)
+        courses = sources['courses']
+        if isinstance(courses, pd.DataFrame):
+            courses = [courses]
+
+        data = pd.concat(
+            [self.assemble_chunk(chunk, dims, idmaps) for chunk in courses],
+            ignore_index=True)
+
+        # only keep most recent grade
+        data = data.sort(['termnum', 'sid'])
+        data = data.drop_duplicates(('sid','cid'), take_last=True)
+        return data
+
+    def assemble_chunk(self, courses, dims, idmaps):
+        """Join and clean one chunk of courses records; see `assemble`."""
+        # fill in missing values for quality points
+        courses['grdpts'] = self.fill_grdpts(courses)
 
-        # Merge with admissions data on (id, cohort).
-        data = data.merge(admiss, how='left', on=('id', 'cohort'))
+        # Get course level from CNUM.
+        courses['clevel'] = extract_clevel(courses['CNUM'])
+
+        # add student data first, then demographics, then admissions.
+        data = courses
+        for dim in dims:
+            data = dim.join(data)
 
         # Map set-categorical ids to contiguous numerical indices.
-        for idname, remove_flag in self.attributes.items():
-            data = map_ids(data, idname, remove=remove_flag)
+        data = map_ids(data, idmaps, self.attributes)
 
         # Map cohort column values to same numerical index used for TERMBNR.
-        with self.input()['CoursesTermnumMap'].open() as f:
-            idmap = pd.read_csv(f, index_col=0)
-
-        data = use_idmap(
-            data, idmap, 'cohort', oldcols=['TERMBNR'], remove=True)
+        data['cohort'] = idmaps['termnum'].lookup([data['cohort'].values])
 
         # remove unneeded columns not deleted during mapping procedure
         unneeded = ['DISC', 'CNUM']
@@ -317,159 +884,282 @@ class PreprocessedData(BasicLuigiTask):
         }, inplace=True)
 
         # remove records for missing grades
-        data = data[~data['grdpts'].isnull()]
+        return data[~data['grdpts'].isnull()]
 
-        # only keep most recent grade
-        data = data.sort(['termnum', 'sid'])
-        data = data.drop_duplicates(('sid','cid'), take_last=True)
+    def run(self):
+        sources = self.read_sources(self.input(), self.chunksize)
+        data = self.assemble(sources, self.read_idmaps())
 
         # Feature engineering.
         data = self.engineer_features(data)
 
+        # Keep the running accumulators so later terms can be appended
+        # without recomputing the features for the full history.
+        FeatureState.from_frame(data).save(self.state_path)
+
         # Narrow down features to those which can be used.
         allvals = self.cvals + self.rvals
         data = data[allvals]
 
         # Write cleaned up data.
-        with self.output().open('w') as out:
-            data.to_csv(out, index=False)
+        self.output().write(data)
 
         return data
 
     def engineer_features(self, data):
-        """Engineer new features from the existing data."""
+        """Engineer new features from the existing data.
 
+        Student features (GPA) are aggregated over (sid, termnum) groups and
+        course features (difficulty) over (cid, termnum) groups. Each set is
+        computed on the compact per-group arrays of a `TermGroups` and then
+        scattered back to the rows.
+        """
         # Compute quality points for each record.
         data['qpts'] = data['chrs'] * data['grdpts']
 
-        # Compute total quality points per term.
-        data['term_qpts'] = data.groupby(['sid', 'termnum'])\
-                                 [['qpts']].transform('sum')
-        tmp = data[['sid', 'termnum', 'term_qpts']]\
-                .drop_duplicates(['sid', 'termnum'])\
-                .sort(['sid', 'termnum'])
-        tmp['total_qpts'] = tmp.groupby('sid')[['term_qpts']]\
-                               .transform('cumsum')
-        del tmp['term_qpts']
-        data = data.merge(tmp, how='left', on=['sid', 'termnum'])
-
-        # Next compute total hours earned each term and across terms.
-        data['term_chrs'] = data.groupby(['sid', 'termnum'])\
-                                 [['chrs']].transform('sum')
-        tmp = data[['sid', 'termnum', 'term_chrs']]\
-                .drop_duplicates(['sid', 'termnum'])\
-                .sort(['sid', 'termnum'])
-        tmp['total_chrs'] = tmp.groupby('sid')[['term_chrs']]\
-                               .transform('cumsum')
-        del tmp['term_chrs']
-        data = data.merge(tmp, how='left', on=['sid', 'termnum'])
-
-        # Now we can compute term gpa...
-        data['term_gpa'] = data['term_qpts'] / data['term_chrs']
-
-        # and the running gpa for each student.
-        data['cum_gpa'] = data['total_qpts'] / data['total_chrs']
-
-        # Finally, shift several attributes forward so the feature vectors
-        # include information from the last term to use for predicting values in
-        # the current term. Leave out quality points because gpa is a summary.
-        merge_on = ['sid', 'termnum']
-        tmp = data.drop_duplicates(merge_on).sort(merge_on)
-        cols = ['term_gpa', 'term_chrs', 'cum_gpa', 'total_chrs']
-        shifted = tmp.groupby('sid')[cols].shift(1)
-        keep = ['lterm_gpa', 'lterm_chrs', 'lterm_cum_gpa', 'lterm_total_chrs']
-        shifted.columns = keep
-        keep += merge_on
-        tmp = tmp.merge(shifted, how='left', right_index=True, left_index=True)
-        tmp = tmp[keep]
-        data = data.merge(tmp, how='left', on=merge_on)
+        # Total quality points and hours earned each term and across terms.
+        students = TermGroups(data['sid'].values, data['termnum'].values)
+        term_qpts = students.sum(data['qpts'].values)
+        term_chrs = students.sum(data['chrs'].values)
+        total_qpts = students.cumsum(term_qpts)
+        total_chrs = students.cumsum(term_chrs)
+
+        # Now we can compute term gpa and the running gpa for each student.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term_gpa = term_qpts / term_chrs
+            cum_gpa = total_qpts / total_chrs
+
+        # Shift several attributes forward so the feature vectors include
+        # information from the last term to use for predicting values in the
+        # current term. Leave out quality points because gpa is a summary.
+        student_features = [
+            ('term_qpts', term_qpts),
+            ('total_qpts', total_qpts),
+            ('term_chrs', term_chrs),
+            ('total_chrs', total_chrs),
+            ('term_gpa', term_gpa),
+            ('cum_gpa', cum_gpa),
+            ('lterm_gpa', students.shift(term_gpa)),
+            ('lterm_chrs', students.shift(term_chrs)),
+            ('lterm_cum_gpa', students.shift(cum_gpa)),
+            ('lterm_total_chrs', students.shift(total_chrs))
+        ]
+        for name, values in student_features:
+            data[name] = students.scatter(values)
 
         # Now we're done with student GPA features. Let's move on to course GPA,
         # AKA course difficulty as evidenced by student grdpts over time.
-
-        # First, we add total # students enrolled at each term and across them.
-        data['num_enrolled'] = data.groupby(['cid', 'termnum'])['cid']\
-                                   .transform('count')
-
-        # Add total number of students enrolled so far at each term.
-        tmp = data[['cid', 'termnum', 'num_enrolled']]\
-                .drop_duplicates(['cid', 'termnum'])\
-                .sort(['cid', 'termnum'])
-        tmp['total_enrolled'] = tmp.groupby('cid')[['num_enrolled']]\
-                                   .transform('cumsum')
-        del tmp['num_enrolled']
-        data = data.merge(tmp, how='left', on=['cid', 'termnum'])
-
-        # Now sum grdpts together for each term.
-        data['term_grdpts_sum'] = data.groupby(['cid', 'termnum'])\
-                                   [['grdpts']].transform('sum')
-        tmp = data[['cid', 'termnum', 'term_grdpts_sum']]\
-                .drop_duplicates(['cid', 'termnum'])\
-                .sort(['cid', 'termnum'])
-        tmp['total_grdpts_sum'] = tmp.groupby('cid')[['term_grdpts_sum']]\
-                                    .transform('cumsum')
-        del tmp['term_grdpts_sum']
-        data = data.merge(tmp, how='left', on=['cid', 'termnum'])
-
-        # Now we can compute course avg. gpa at each term...
-        data['term_cgpa'] = data['term_grdpts_sum'] / data['num_enrolled']
-
-        # and the running avg course gpa.
-        data['cum_cgpa'] = data['total_grdpts_sum'] / data['total_enrolled']
-
-        # Finally, shift some feature values forward one to make the previous
-        # term's values accessible for prediction in the current term.
-        merge_on = ['cid', 'termnum']
-        tmp = data.drop_duplicates(merge_on).sort(merge_on)
-        cols = ['term_cgpa', 'cum_cgpa', 'num_enrolled', 'total_enrolled']
-        shifted = tmp.groupby('cid')[cols].shift(1)
-        keep = ['lterm_cgpa', 'lterm_cum_cgpa', 'lterm_num_enrolled',
-                'lterm_total_enrolled']
-        shifted.columns = keep
-        keep += merge_on
-        tmp = tmp.merge(shifted, how='left', right_index=True, left_index=True)
-        tmp = tmp[keep]
-        data = data.merge(tmp, how='left', on=merge_on)
+        courses = TermGroups(data['cid'].values, data['termnum'].values)
+        num_enrolled = courses.count().astype(np.float64)
+        total_enrolled = courses.cumsum(num_enrolled)
+        term_grdpts_sum = courses.sum(data['grdpts'].values)
+        total_grdpts_sum = courses.cumsum(term_grdpts_sum)
+
+        # Course avg. gpa at each term and the running avg course gpa.
+        term_cgpa = term_grdpts_sum / num_enrolled
+        cum_cgpa = total_grdpts_sum / total_enrolled
+
+        course_features = [
+            ('num_enrolled', num_enrolled),
+            ('total_enrolled', total_enrolled),
+            ('term_grdpts_sum', term_grdpts_sum),
+            ('total_grdpts_sum', total_grdpts_sum),
+            ('term_cgpa', term_cgpa),
+            ('cum_cgpa', cum_cgpa),
+            ('lterm_cgpa', courses.shift(term_cgpa)),
+            ('lterm_cum_cgpa', courses.shift(cum_cgpa)),
+            ('lterm_num_enrolled', courses.shift(num_enrolled)),
+            ('lterm_total_enrolled', courses.shift(total_enrolled))
+        ]
+        for name, values in course_features:
+            data[name] = courses.scatter(values)
 
         # Add student term (sterm).
-        cols = ['sid', 'termnum']
-        tmp = data.drop_duplicates(cols)[cols].sort(cols)
-        tmp['tmp'] = 1
-        tmp['sterm'] = tmp.groupby('sid').transform('cumsum')['tmp']
-        del tmp['tmp']
-        data = data.merge(tmp, how='left', on=cols)
+        data['sterm'] = students.scatter(students.rank())
+        return data
+
+
+def term_names(term_dirs):
+    """Names of the space-separated new-term directories, in order."""
+    return [os.path.basename(os.path.normpath(term_dir))
+            for term_dir in term_dirs.split()]
+
+
+def preprocessed_data(appended_terms=''):
+    """Return the task producing the preprocessed data with the new terms in
+    `appended_terms` (space-separated directories, oldest first) appended.
+    """
+    if appended_terms.split():
+        return AppendTerm(term_dirs=appended_terms)
+    return PreprocessedData()
+
+
+class AppendTerm(PreprocessedData):
+    """Append the records of new terms to the preprocessed data.
+
+    The raw files for each new term are read from its directory, using the
+    same file names as the full data sources. The courses and students files
+    are required; the demographics and admissions files are read from the
+    full data sources if they are not present. The id maps are extended with
+    any new values, and the engineered features of the new records are
+    computed from the previous version's FeatureState alone.
+
+    Each set of appended terms is a new version of the preprocessed data: its
+    own data, FeatureState and id maps, written next to those of the version
+    it extends, which are never modified. The version for `term_dirs`
+    requires the version for all but its last directory, down to
+    PreprocessedData itself. The data is written last, so the task is only
+    complete once all three outputs are in place, and a failed run can simply
+    be repeated.
+
+    Unlike a full rebuild, earlier records of courses retaken in the new terms
+    are kept, since dropping them would change the features of every record
+    after them.
+    """
+    term_dirs = luigi.Parameter(
+        description='space-separated directories of new terms, oldest first')
+    required_sources = ('courses', 'students')
+
+    @property
+    def term_dir(self):
+        """Directory of the last new term, the one appended by this task."""
+        return self.term_dirs.split()[-1]
+
+    def requires(self):
+        return preprocessed_data(' '.join(self.term_dirs.split()[:-1]))
+
+    def output(self):
+        base, ext = os.path.splitext(PreprocessedData().output().path)
+        return FrameTarget('%s-%s%s' % (
+            base, '-'.join(term_names(self.term_dirs)), ext))
+
+    @property
+    def idmaps_path(self):
+        """Path of the id maps for this version of the data."""
+        base, ext = os.path.splitext(self.output().path)
+        return '%s-idmaps.npz' % base
+
+    def read_idmaps(self):
+        """Load the id maps for all attributes, keyed by attribute."""
+        with np.load(self.idmaps_path) as arrays:
+            return {attr: IdMap.from_arrays(arrays, attr)
+                    for task in self.idmap_tasks.values()
+                    for attr in task.maps}
+
+    def write_idmaps(self, idmaps):
+        arrays = {}
+        for attr, idmap in idmaps.items():
+            arrays.update(idmap.to_arrays(attr))
+        savez_atomic(self.idmaps_path, arrays)
+
+    def source_targets(self):
+        """Return the luigi targets to read each data source from.
+
+        Raises:
+            IOError: if a required source is not present in `term_dir`.
+        """
+        targets = {}
+        for src_name in self.source_cols:
+            path = os.path.join(self.term_dir, DATA_SOURCES[src_name])
+            if os.path.exists(path):
+                targets[src_name] = luigi.LocalTarget(path)
+            elif src_name in self.required_sources:
+                raise IOError('new term data not found: %s' % path)
+            else:
+                targets[src_name] = self.data_tasks[src_name].output()
+        return targets
+
+    def extend_idmaps(self, idmaps, sources):
+        """Extend the id maps (keyed by attribute) in place with the values
+        in `sources` and return the number of new ids.
+        """
+        n_new = 0
+        for task in self.idmap_tasks.values():
+            frame = sources[task.source]
+            for attr in task.maps:
+                idmap = idmaps[attr]
+                n_new += idmap.extend(
+                    [frame[colname].values for colname in idmap.cols])
+        return n_new
+
+    def run(self):
+        previous = self.requires()
+        sources = self.read_sources(self.source_targets())
+        idmaps = previous.read_idmaps()
+        n_new = self.extend_idmaps(idmaps, sources)
+        logging.info('%d new ids in %s' % (n_new, self.term_dir))
+
+        # Only the new terms' records are assembled; features come from the
+        # state of the terms already in the previous version.
+        data = self.assemble(sources, idmaps)
+        state = FeatureState.load(previous.state_path)
+        data = state.append(data)
+
+        allvals = self.cvals + self.rvals
+        data = pd.concat((previous.output().read(), data[allvals]),
+                         ignore_index=True)
+
+        self.write_idmaps(idmaps)
+        state.save(self.state_path)
+        self.output().write(data)
 
         return data
 
 
+class PreprocessedDataCsv(luigi.Task):
+    """Export the preprocessed data as CSV for inspection."""
+
+    def requires(self):
+        return PreprocessedData()
+
+    def output(self):
+        base, ext = os.path.splitext(self.input().path)
+        return luigi.LocalTarget('%s.csv' % base)
+
+    def run(self):
+        with self.output().open('w') as out:
+            self.input().export_csv(out)
+
+
 class TrainTestFilter(object):
-    """Wrapper class to filter data to train/test sets using cohort/term."""
-    term_max = MAX_NUM_COHORTS  # some number greater than max term id
+    """Wrapper class to filter data to train/test sets using cohort/term.
+
+    A term range without an end (term_end of None) takes every term from its
+    start on, however many terms have been appended to the data.
+    """
+    term_max = MAX_NUM_COHORTS  # open term ends are named with this
 
     def __init__(self, filt):
         if ':' in filt:
             cohort, term = filt.split(':')
             self.cohort_start, self.cohort_end = self._split(cohort)
+            if self.cohort_end is None:
+                self.cohort_end = self.term_max
             self.term_start, self.term_end = self._split(term)
         else:
             self.cohort_start, self.cohort_end = map(int, filt.split('-'))
-            self.term_start, self.term_end = (0, self.term_max)
+            self.term_start, self.term_end = (0, None)
 
     def _split(self, config):
         if '-' in config:
             return map(int, config.split('-'))
         else:
-            return (int(config), self.term_max)
+            return (int(config), None)
 
     def __str__(self):
+        # Open term ends keep the name they had as term_max, so output names
+        # do not change.
+        term_end = self.term_max if self.term_end is None else self.term_end
         return '%d_%dT%d_%d' % (
-            self.cohort_start, self.cohort_end, self.term_start, self.term_end)
+            self.cohort_start, self.cohort_end, self.term_start, term_end)
 
     def mask(self, data):
-        return ((data['cohort'] >= self.cohort_start) &
+        mask = ((data['cohort'] >= self.cohort_start) &
                 (data['cohort'] <= self.cohort_end) &
-                (data['termnum'] >= self.term_start) &
-                (data['termnum'] <= self.term_end))
+                (data['termnum'] >= self.term_start))
+        if self.term_end is not None:
+            mask &= (data['termnum'] <= self.term_end)
+        return mask
 
     def train(self, data):
         return data[self.mask(data)]
@@ -489,6 +1179,10 @@ class UsesTrainTestSplit(luigi.Task):
     remove_cold_start = luigi.IntParameter(
         default=1,
         description="remove all cold-start records from test set")
+    appended_terms = luigi.Parameter(
+        default='',
+        description='space-separated directories of new terms appended to '
+                    'the preprocessed data (see AppendTerm), oldest first')
 
     base = 'data'  # directory to write files to
     ext = 'tsv'    # final file extension for output files
@@ -515,6 +1209,10 @@ class UsesTrainTestSplit(luigi.Task):
         if self.remove_cold_start:
             parts.append('nocs')
 
+        # indicate the version of the preprocessed data used
+        if self.appended_terms.split():
+            parts.append('+'.join(term_names(self.appended_terms)))
+
         # include optional class-specific suffix
         if self.suffix:
             parts.append(self.suffix)
@@ -566,25 +1264,29 @@ class DataSplitterBaseTask(UsesFeatures):
     """Functionality to split train/test data, no run method."""
 
     def requires(self):
-        return self.data_source
+        return preprocessed_data(self.appended_terms)
 
     def read_data(self):
-        with self.input().open() as f:
-            return pd.read_csv(f)
+        return self.input().read()
 
     def split_data(self):
         data = self.read_data()
 
-        # now do train/test split; drop duplicates in case filters overlap
-        train = pd.concat([f.train(data) for f in self.filters]).drop_duplicates()
-        test = pd.concat([f.test(data) for f in self.filters]).drop_duplicates()
+        # now do train/test split; a record is in the train set if any filter
+        # selects it and in the test set if any filter excludes it.
+        masks = np.array([f.mask(data).values for f in self.filters])
+        train_mask = masks.any(axis=0)
+        test_mask = ~masks.all(axis=0)
 
         # sometimes cohorts have nan values, and other times students from later
         # cohorts take courses before they've officially enrolled.
         start = max([f.cohort_end for f in self.filters])
-        oddball_mask = test.termnum <= start
-        train = pd.concat((train, test[oddball_mask]))
-        test = test[~oddball_mask]
+        oddball_mask = test_mask & (data.termnum <= start).values
+        train_mask |= oddball_mask
+        test_mask &= ~oddball_mask
+
+        train = data[train_mask]
+        test = data[test_mask]
 
         # # remove W/S/NC from test set; it never makes sense to test on these
         # toremove = ['W', 'S', 'NC']
@@ -597,32 +1299,169 @@ class DataSplitterBaseTask(UsesFeatures):
         return (train, test)
 
 
-class UserCourseGradeLibFM(DataSplitterBaseTask):
-    """Output user-course grade matrix in libFM format."""
+# Encoded lines and cold-start mask shared with test-writing worker processes.
+# Set in the parent before the pool is created, so forked workers inherit them
+# instead of having them pickled along with each job.
+_TERM_LINES = None
+_TERM_KEEP = None
+
+
+def _write_test_file(job):
+    """Write one term's test file from the shared encoded lines.
+
+    Args:
+        job (tuple): (termnum, start, end, test_target), where rows
+            [start, end) are the term's test records (before cold-start
+            removal).
+    Return:
+        termnum (int): The term written.
+    """
+    termnum, start, end, testf = job
+    keep = _TERM_KEEP[start:end]
+
+    # luigi writes to a temporary file and moves it into place on close.
+    with testf.open('w') as ftest:
+        if start and keep.any():
+            write_lines(ftest, _TERM_LINES[start:end][keep])
+    return termnum
+
+
+class UserCourseGradeBlocks(DataSplitterBaseTask):
+    """Encode the full feature superset of a train/test split once, as sparse
+    feature blocks. Every feature combination written by
+    `UserCourseGradeLibFM` for the split is a projection of these blocks, so
+    the data is read, split and encoded only once per split.
+
+    The records are laid out as in `_partition`. Along with the blocks, the
+    store holds the number of initial train records and the cold-start masks
+    for the all-term and next-term tasks.
+    """
+    suffix = 'superset'
+    ext = 'npz'
+
+    def output(self):
+        return luigi.LocalTarget(self.output_base_fname() % 'blocks')
+
+    def _partition(self):
+        """Split the data and lay it out so each term's train set is a prefix.
+
+        The initial train set comes first, followed by the test set sorted by
+        termnum, so the train set for any term is every record before the
+        term's first record.
+        """
+        train, test = self.split_data()
+        test = test.sort('termnum', kind='mergesort')
+        self._data = pd.concat((train, test))
+        self._ntrain = len(train)
+        self._test_terms = test.termnum.values
+
+    @property
+    def data(self):
+        """Train set followed by test set sorted by termnum."""
+        try: return self._data
+        except AttributeError: self._partition()
+        return self._data
+
+    @property
+    def ntrain(self):
+        """Number of records in the initial train set."""
+        self.data  # make sure the layout exists
+        return self._ntrain
+
+    def term_starts(self):
+        """Position in `data` of the first record of each test record's term.
+        """
+        self.data  # make sure the layout exists
+        return self._ntrain + np.searchsorted(
+            self._test_terms, self._test_terms, side='left')
+
+    def cold_start_mask(self, starts):
+        """Return a mask of the test records to keep: all of them, or, if
+        cold-start removal was requested, those whose sid and cid both appear
+        in `data` before the position in `starts`, i.e. in their train set.
+
+        Args:
+            starts (np.ndarray): For each test record, the number of records
+                in its train set.
+        """
+        data = self.data
+        ntrain = self.ntrain
+        keep = np.ones(len(data) - ntrain, dtype=bool)
+        if not self.remove_cold_start:
+            return keep
+
+        for key in ['sid', 'cid']:
+            values = data[key].values
+            ids = values[ntrain:]
+            known = ~np.isnan(ids)
+            uniques, first = np.unique(values, return_index=True)
+            pos = np.searchsorted(uniques, ids[known])
+            seen = np.zeros(len(ids), dtype=bool)
+            seen[known] = first[pos] < starts[known]
+            keep &= seen
+        return keep
+
+    def run(self):
+        data = self.data
+        logging.info('encoding feature blocks for %d records' % len(data))
+        blocks = FeatureBlocks.from_frame(
+            data, target='grdpts', cvals=['sid', 'cid'] + self.cvals,
+            rvals=self.rvals)
+
+        arrays = blocks.to_arrays()
+        ntrain = self.ntrain
+        arrays['ntrain'] = np.array(ntrain)
+        arrays['keep_all'] = self.cold_start_mask(
+            np.repeat(ntrain, len(data) - ntrain))
+        arrays['keep_next'] = self.cold_start_mask(self.term_starts())
+        savez_atomic(self.output().path, arrays)
+
+
+class UserCourseGradeLibFM(UsesFeatures):
+    """Output user-course grade matrix in libFM format. The files are
+    projections of the feature blocks stored for the split by
+    `UserCourseGradeBlocks` onto the selected features.
+    """
     task = luigi.Parameter(
         default='next',
         description='prediction task; next = next-term, all = all-terms')
+    term_workers = luigi.IntParameter(
+        default=1,
+        description='number of processes writing next-term files')
     ext = 'libfm'
 
-    @property
-    def train(self):
-        try: return self._train
-        except: self._train, self._test = self.split_data()
-        return self._train
+    def requires(self):
+        return UserCourseGradeBlocks(
+            train_filters=self.train_filters,
+            discard_nongrade=self.discard_nongrade,
+            remove_cold_start=self.remove_cold_start,
+            appended_terms=self.appended_terms)
+
+    def read_blocks(self):
+        """Load the feature blocks and split layout for this split."""
+        with np.load(self.input().path) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        self._blocks = FeatureBlocks.from_arrays(arrays)
+        self._ntrain = int(arrays['ntrain'])
+        self._keep_all = arrays['keep_all']
+        self._keep_next = arrays['keep_next']
 
-    @train.setter
-    def train(self, train):
-        self._train = train
+    @property
+    def blocks(self):
+        try: return self._blocks
+        except AttributeError: self.read_blocks()
+        return self._blocks
 
     @property
-    def test(self):
-        try: return self._test
-        except: self._train, self._test = self.split_data()
-        return self._test
+    def ntrain(self):
+        """Number of records in the initial train set."""
+        self.blocks  # make sure the layout is loaded
+        return self._ntrain
 
-    @test.setter
-    def test(self, test):
-        self._test = test
+    def term_end(self, termnum):
+        """Position just past the last record of term `termnum`."""
+        test_terms = self.blocks.terms[self.ntrain:]
+        return self.ntrain + np.searchsorted(test_terms, termnum, side='right')
 
     def all_term_output(self):
         fname = self.output_base_fname()
@@ -653,74 +1492,122 @@ class UserCourseGradeLibFM(DataSplitterBaseTask):
 
     @property
     def term_range(self):
-        """All terms for which prediction should be performed."""
+        """All terms for which prediction should be performed: from the term
+        after the last training cohort through the last term in the data
+        version used.
+        """
         start = max([f.cohort_end for f in self.filters])
-        end = MAX_NUM_COHORTS
+        end = preprocessed_data(self.appended_terms).max_termnum()
         return range(start + 1, end + 1)
 
-    @property
-    def write_libfm_data(self):
-        def write_libfm_data(ftrain, ftest, train, test):
-            write_libfm(ftrain, ftest, train, test, target='grdpts',
-                        userid='sid', itemid='cid', cvals=self.cvals_to_write,
-                        rvals=self.rvals_to_write,
-                        prev_cgrades=self.prev_cgrades)
-        return write_libfm_data
-
-    def transfer_term(self, termnum):
-        """Move data for the given term from the test set to the train set."""
-        tomove_mask = self.test.termnum == termnum
-        self.train = pd.concat((self.train, self.test[tomove_mask]))
-        self.test = self.test[~tomove_mask]
-
-    def handle_cold_start(self, test):
-        """If requested, remove cold start, else do nothing."""
-        if self.remove_cold_start:
-            for key in ['sid', 'cid']:
-                diff = np.setdiff1d(test[key].values, self.train[key].values)
-                diff_mask = test[key].isin(diff)
-                test = test[~diff_mask]
-        return test
+    def libfm_lines(self):
+        """Project the stored blocks onto the selected features and encode
+        every record of the split as a libFM line.
+        """
+        return self.blocks.lines(cvals=self.cvals_to_write,
+                                 rvals=self.rvals_to_write,
+                                 userid='sid', itemid='cid',
+                                 prev_cgrades=self.prev_cgrades)
 
     def produce_all_term_data(self):
         """Produce train/test data for all-term prediction task."""
-        # remove cold start records if requested
-        test = self.test.copy()
-        test = self.handle_cold_start(test)
+        matrix, onehot_end = self.blocks.matrix(
+            cvals=self.cvals_to_write, rvals=self.rvals_to_write,
+            userid='sid', itemid='cid', prev_cgrades=self.prev_cgrades)
+        target = self.blocks.target
+        ntrain = self.ntrain
+        keep = self._keep_all  # cold-start removal, if requested
+        test_rows = ntrain + np.flatnonzero(keep)
 
         outputs = self.output()
         trainf, testf = outputs['train'], outputs['test']
         with trainf.open('w') as ftrain, testf.open('w') as ftest:
-            self.write_libfm_data(ftrain, ftest, self.train, test)
-
-        # Write the term-to-id guide
-        test = test.sort(('termnum'))
-        test['rownum'] = np.arange(len(test))
-        guide = test.groupby('termnum').max()['rownum']
+            if ntrain and len(test_rows):
+                logging.info('writing train file')
+                write_rows(ftrain, matrix[:ntrain], target[:ntrain],
+                           onehot_end)
+                logging.info('writing test file')
+                write_rows(ftest, matrix[test_rows], target[test_rows],
+                           onehot_end)
+
+        # Write the term-to-id guide; test records are sorted by termnum.
+        terms = self.blocks.terms[ntrain:][keep]
+        rownum = pd.Series(np.arange(len(terms)), name='rownum')
+        guide = rownum.groupby(terms).max()
         with self.output()['guide'].open('w') as f:
             guide.to_csv(f, index_label='termnum', header=True)
 
     def produce_next_term_data(self):
-        """Produce multiple train/test splits; one for each term to predict."""
+        """Produce multiple train/test splits; one for each term to predict.
+
+        Every record is encoded to its libFM line once, using a feature layout
+        computed over the train and test sets together. Each term's train file
+        is then all lines before that term's records, and its test file is the
+        term's own lines, less any cold-start records. Train files are written
+        in term order, each extending the one before it; the test files are
+        independent given the lines, so they are written meanwhile by a pool
+        of `term_workers` processes.
+
+        The train files stay serial on purpose. Their lines are already
+        formatted, so writing them is dominated by the bytes copied, and each
+        train file must contain all the earlier ones. Writing the per-term
+        increments in parallel and concatenating them afterwards copies every
+        increment a second time, which costs more than the parallel writes
+        save.
+        """
+        global _TERM_LINES, _TERM_KEEP
+        _TERM_LINES = self.libfm_lines()
+        _TERM_KEEP = np.zeros(len(_TERM_LINES), dtype=bool)
+        _TERM_KEEP[self.ntrain:] = self._keep_next
+
         outputs = self.output()
+        jobs = []
+        start = self.ntrain
         for termnum in self.term_range:  # includes (end term + 1)
-            test = self.test[self.test.termnum == termnum]
-
-            # remove cold start recordsif requested
-            test = self.handle_cold_start(test)
-
-            term_outputs = outputs[termnum]
-            trainf, testf = term_outputs['train'], term_outputs['test']
-            with trainf.open('w') as ftrain, testf.open('w') as ftest:
-                self.write_libfm_data(ftrain, ftest, self.train, test)
-
-            self.transfer_term(termnum)  # modify train/test sets in place
-            # intentionally skip writing the last time this is run
-
-        # TODO: this code converts the same records to libFM format multiple
-        # times. Each subsequent train set contains records in the last train
-        # set. These could be cached to avoid all of the string format
-        # conversion overhead.
+            end = self.term_end(termnum)
+            jobs.append((termnum, start, end, outputs[termnum]['test']))
+            start = end
+
+        try:
+            if self.term_workers > 1:
+                pool = mp.Pool(self.term_workers)
+                try:
+                    tests = pool.imap_unordered(_write_test_file, jobs)
+                    self._write_train_files(jobs, outputs)
+                    for termnum in tests:
+                        logging.info('wrote test file for term %d' % termnum)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for job in jobs:
+                    _write_test_file(job)
+                self._write_train_files(jobs, outputs)
+        finally:
+            _TERM_LINES = _TERM_KEEP = None
+
+    def _write_train_files(self, jobs, outputs):
+        """Write each term's train file by copying the previous train file
+        written and appending the lines between the two, so every line is
+        joined only once. Non-empty train files end with a newline so the
+        next one can be appended to directly. Terms with no test records get
+        empty files.
+        """
+        prefix_path, prefix_end = None, 0
+        for termnum, start, end, _ in jobs:
+            trainf = outputs[termnum]['train']
+            with trainf.open('w') as ftrain:
+                if not (start and _TERM_KEEP[start:end].any()):
+                    continue
+
+                if prefix_path is not None:
+                    with open(prefix_path) as fprefix:
+                        shutil.copyfileobj(fprefix, ftrain)
+                write_lines(ftrain, _TERM_LINES[prefix_end:start])
+                if start > prefix_end:
+                    ftrain.write('\n')
+            prefix_path, prefix_end = trainf.path, start
+            logging.info('wrote train file for term %d' % termnum)
 
     def run(self):
         """Write the train/test data in libFM format."""
@@ -7,7 +7,7 @@ import luigi
 import numpy as np
 import pandas as pd
 
-from methods import libfm
+import test_params as libfm
 from util import *
 import summary
 from recpipe import UserCourseGradeLibFM, UsesFeatures
@@ -38,6 +38,9 @@ class UsesLibFM(UsesFeatures):
     dim = luigi.IntParameter(
         default=7,
         description='dimensionality to use for matrix factorization')
+    timeout = luigi.IntParameter(
+        default=0,
+        description='seconds after which a libFM run is killed; 0 = never')
 
     suffix = ''
     prefix = ''
@@ -127,6 +130,15 @@ class UsesLibFM(UsesFeatures):
                 train_fname, test_fname, outfile=outfile, **self.common_kwargs)
         return libfm_predict
 
+    @property
+    def submit_libfm(self):
+        """Start libFM without waiting; the job's result is the predictions."""
+        def submit_libfm(train_fname, test_fname, outfile):
+            return libfm.submit_libfm(
+                train_fname, test_fname, outfile=outfile,
+                timeout=self.timeout or None, **self.common_kwargs)
+        return submit_libfm
+
 
 class RunLibFM(UsesLibFM):
     """General-purpose wrapper that spawns a subprocess to run libFM."""
@@ -184,14 +196,18 @@ class RunLibFM(UsesLibFM):
         logging.info('%s: next-term prediction for %d terms' % (
             self.__class__.__name__, len(inputs)))
 
-        # Run libFM to predict grades for each term
+        # Run libFM to predict grades for each term; the runs overlap.
+        jobs = OrderedDict()
         for termnum in inputs:
             logging.info('predicting grades for term %d' % termnum)
             train = inputs[termnum]['train'].path
-            test_file = inputs[termnum]['test']
-            test = test_file.path
+            test = inputs[termnum]['test'].path
             outfile = outputs['predict'][termnum].path
-            predicted = self.libfm_predict(train, test, outfile)
+            jobs[termnum] = self.submit_libfm(train, test, outfile)
+
+        for termnum, job in jobs.items():
+            predicted = job.result()
+            test_file = inputs[termnum]['test']
 
             # Now calculate absolute deviation of predictions from actuals
             with test_file.open() as f:
@@ -274,7 +290,12 @@ class RunLibFM(UsesLibFM):
 
 
 class RunFeatureCombinations(RunLibFM):
-    """Run with various feature combinations; allow |F| choose nfeats."""
+    """Run with various feature combinations; allow |F| choose nfeats.
+
+    All of the combinations for a split share one `UserCourseGradeBlocks`
+    task, so the data is split and encoded once; each combination's libFM
+    files are only a projection of the stored feature blocks.
+    """
     nfeats = luigi.IntParameter(
         default=1, description='how many params to use in combinations')
 
@@ -1,21 +1,17 @@
 import os
-import subprocess as sub
 import argparse
 import logging
 
 import numpy as np
 
-
-LIBFM = 'libfm-1.42.src/bin/libFM'
+from methods.wlibfm import LibFMFailed, default_runner
 
 
-class LibFMFailed(Exception):
-    """LibFM returned a non-zero exit code."""
-    pass
+LIBFM = 'libfm-1.42.src/bin/libFM'
 
 
 def compose_libfm_args(train, test, iter=20, std=0.2, dim=8, bias=False,
-                       outfile='', bin=LIBFM):
+                       outfile='', bin=LIBFM, task='r'):
     """Put together libFM args in a list suitable for use with Popen.
 
     :param str train:   Path for training data file, in libFM format.
@@ -24,13 +20,14 @@ def compose_libfm_args(train, test, iter=20, std=0.2, dim=8, bias=False,
     :param int dim:     Dimensionality of low-rank approximation to use.
     :param bool bias:   Use global and per-feature bias terms.
     :param str outfile: Output predictions to a file with this name.
+    :param str task:    r=regression, c=classification.
     :return:            List of args to use for running libFM.
 
     """
     bias = int(bias)
     args = [
         bin,
-        '-task', 'r',
+        '-task', task,
         '-train', train,
         '-test', test,
         '-iter', str(iter),
@@ -43,65 +40,65 @@ def compose_libfm_args(train, test, iter=20, std=0.2, dim=8, bias=False,
     return args
 
 
+def submit_libfm(train, test, iter=20, std=0.2, dim=8, bias=False,
+                 outfile='', runner=None, timeout=None, task='r'):
+    """Start libFM on a shared runner without waiting for it, so that many
+    runs can overlap. See `compose_libfm_args` for the libFM args.
+
+    :param LibFMRunner runner: Runner to use; the shared one by default.
+    :param float timeout:      Seconds after which libFM is killed.
+    :rtype:  methods.wlibfm.LibFMJob
+    :return: The job; a future for the predictions written to `outfile`.
+    """
+    args = compose_libfm_args(train, test, iter=iter, std=std, dim=dim,
+                              bias=bias, outfile=outfile, task=task)
+    runner = runner if runner is not None else default_runner()
+    return runner.submit(args, outfile, timeout)
+
+
 def run_libfm(train, test, iter=20, std=0.2, dim=8, bias=False,
-              outfile=''):
+              outfile='', task='r'):
     """Run libFM and return final train/test results.
 
     :return: Final error for (train, test) sets.
     """
-    kwargs = {k: v for k, v in locals().items() if not k in ['train', 'test']}
-    args = compose_libfm_args(train, test, **kwargs)
-    cmd = ' '.join(args)
-    logging.debug(cmd)
+    job = submit_libfm(train, test, iter, std, dim, bias, outfile, task=task)
+    return job_errors(job)
 
-    proc = sub.Popen(cmd, shell=True, stdout=sub.PIPE)
-    retcode = proc.wait()
-    if retcode:
-        raise LibFMFailed("libFM failed to execute.\n%s" % cmd)
 
-    output = proc.communicate()[0]
-    lines = output.split('\n')
-    rows = [row.split('\t')[1:] for row in lines[-iter:] if row]
-    train_err = '%.6f' % float(rows[-1][0].split('=')[1])
-    test_err = '%.6f' % float(rows[-1][1].split('=')[1])
-    return [train_err, test_err]
+def job_errors(job):
+    """Wait for a libFM job and return its final (train, test) errors."""
+    job.result()
+    return ['%.6f' % err for err in job.errors]
 
 
-def libfm_predict(train, test, outfile, iter=20, std=0.2, dim=8, bias=False):
+def libfm_predict(train, test, outfile, iter=20, std=0.2, dim=8, bias=False,
+                  task='r'):
     """Run libFM, output predictions to file, read file and return predictions
     as an array of floats.
 
     :rtype: numpy.ndarray of floats.
     :return: The predictions for the test examples.
     """
-    kwargs = {k: v for k, v in locals().items()
-              if not k in ['train', 'test']}
-    kwargs['outfile'] = outfile
-    args = compose_libfm_args(train, test, **kwargs)
-    cmd = ' '.join(args)
-    logging.debug(cmd)
-
-    proc = sub.Popen(cmd, shell=True, stdout=sub.PIPE)
-    retcode = proc.wait()
-    if retcode:
-        raise LibFMFailed("libFM failed to execute.\n%s" % cmd)
-
-    # read output and return predictions
-    with open(outfile) as f:
-        return np.array([float(num) for num in f if num])
+    job = submit_libfm(train, test, iter, std, dim, bias, outfile, task=task)
+    return job.result()
 
 
 def test_dim(start, end, *args, **kwargs):
     """Run libFM regression once for each dimension value in range(start, end+1).
-    See `run_libfm` for *args and **kwargs.
+    The runs for all dimensions are submitted at once and overlap. See
+    `run_libfm` for *args and **kwargs.
 
     :param int start: The first dimension in the range.
     :param int end: The last dimension in the range (inclusive).
     :return: List of (dim, train_err, test_err) for all dimensions tested.
     """
+    jobs = [(dim, submit_libfm(*args, dim=dim, **kwargs))
+            for dim in range(start, end+1)]
+
     results = []
-    for dim in range(start, end+1):
-        out = run_libfm(*args, dim=dim, **kwargs)
+    for dim, job in jobs:
+        out = job_errors(job)
         out.insert(0, str(dim))
         logging.info('\t'.join(out))
         results.append(out)
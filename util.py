@@ -2,8 +2,13 @@
 Useful utility functions.
 
 """
+import os
+import collections
+
 import luigi
 import luigi.worker
+import numpy as np
+import pandas as pd
 
 
 def schedule_task(task, verbose=False):
@@ -61,3 +66,65 @@ def fname_from_cname(cname):
     return '-'.join(map(lambda s: s.lower(), words))
 
 
+def savez_atomic(path, arrays):
+    """Save the dict of arrays to an npz archive at `path`. The archive is
+    written to a temporary file and renamed into place, so a partially
+    written archive is never seen at `path`.
+    """
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+
+def frame_to_arrays(df):
+    """Convert a DataFrame to a dict of typed column arrays for storage.
+
+    Numeric, boolean and datetime columns are stored with their own dtypes.
+    Object columns are stored as unicode string arrays alongside a mask of
+    the null entries, so they come back as strings with NaN for nulls.
+    """
+    arrays = {'columns': np.array([unicode(col) for col in df.columns])}
+    for i, colname in enumerate(df.columns):
+        values = df.iloc[:, i].values
+        if values.dtype.kind == 'O':
+            null = pd.isnull(values)
+            values = np.where(null, u'', values).astype(np.unicode_)
+            arrays['null%d' % i] = null
+        arrays['col%d' % i] = values
+    return arrays
+
+
+def frame_from_arrays(arrays):
+    """Mirror function for `frame_to_arrays`."""
+    columns = list(arrays['columns'])
+    data = collections.OrderedDict()
+    for i, colname in enumerate(columns):
+        values = arrays['col%d' % i]
+        null_key = 'null%d' % i
+        if null_key in arrays:
+            values = values.astype(object)
+            values[arrays[null_key]] = np.nan
+        data[colname] = values
+    return pd.DataFrame(data, columns=columns)
+
+
+class FrameTarget(luigi.LocalTarget):
+    """A local file holding a DataFrame in a typed columnar binary format (an
+    npz archive with one array per column). Reads skip text parsing entirely
+    and preserve the column dtypes.
+    """
+
+    def read(self):
+        """Read the DataFrame from the target."""
+        with np.load(self.path) as archive:
+            return frame_from_arrays(
+                {name: archive[name] for name in archive.files})
+
+    def write(self, df):
+        """Write the DataFrame to the target, atomically."""
+        savez_atomic(self.path, frame_to_arrays(df))
+
+    def export_csv(self, f):
+        """Write the target's DataFrame as CSV to the open file `f`."""
+        self.read().to_csv(f, index=False)